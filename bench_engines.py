@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Side-by-side benchmark of the server engines.
+# Starts server.py once per engine, plays the same number of full games against it with simulated players,
+# and prints games/sec for each engine, then shots/sec and turn round-trip latency (see bot.py) to explain it.
+#
+#   python bench_engines.py -m 200
+#   python bench_engines.py -m 200 --engines selectors asyncio --uvloop
+#   python bench_engines.py -m 2000 --engines selectors --workers 4
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bot import run_players, percentile
+
+BOARD = "11111...../2222....../333......./444......./55......../........../........../........../........../.........."
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server didn't start listening on port {port}.")
+
+def bench_engine(engine, port, matches, delta, uvloop, workers):
+    command = [sys.executable, os.path.abspath("server.py"), "-p", str(port), "--engine", engine]
+    if uvloop:
+        command.append("--uvloop")
+    if workers > 1 and engine == "selectors":
+        command += ["--workers", str(workers)]
+    # Run the server in a scratch directory so its log doesn't land in the checkout
+    with tempfile.TemporaryDirectory() as workdir:
+        server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            # Every game is two bots with the same board shooting at random, see bot.py
+            options = argparse.Namespace(board=BOARD, delta=delta, strategy="random", think=0, games=1, reconnect=False)
+            start = time.perf_counter()
+            stats = asyncio.run(run_players("127.0.0.1", port, matches * 2, options))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        "engine": engine,
+        "games/s": matches / elapsed,
+        "shots/s": stats.shots / elapsed,
+        "p50 ms": percentile(stats.latencies, 0.50) * 1000,
+        "p99 ms": percentile(stats.latencies, 0.99) * 1000,
+        "seconds": elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the selectors and asyncio server engines')
+    parser.add_argument('-m', type=int, default=100, help='Games to play against each engine, all at once (default: 100)')
+    parser.add_argument('-p', type=int, default=5050, help='First port to run the servers on (default: 5050)')
+    parser.add_argument('--engines', nargs='+', default=['selectors', 'asyncio'], help='Engines to compare')
+    parser.add_argument('--delta', action='store_true', help='Have the players ask for board delta updates')
+    parser.add_argument('--uvloop', action='store_true', help='Run the asyncio engine on uvloop if it is installed')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for the selectors engine (default: 1)')
+    args = parser.parse_args()
+
+    results = []
+    for offset, engine in enumerate(args.engines):
+        results.append(bench_engine(engine, args.p + offset, args.m, args.delta, args.uvloop, args.workers))
+
+    columns = ["engine", "games/s", "shots/s", "p50 ms", "p99 ms", "seconds"]
+    print("".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print("".join(f"{result[column]:>12}" if isinstance(result[column], str) else f"{result[column]:>12.2f}" for column in columns))
+    if len(results) > 1:
+        # Games finished is what players get out of an engine, the rest only explains it
+        ranked = sorted(results, key=lambda result: result["games/s"], reverse=True)
+        print(f"{ranked[0]['engine']} played the most games/s: " + ", ".join(
+            f"{ranked[0]['games/s'] / result['games/s']:.2f}x {result['engine']}" for result in ranked[1:]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the code that runs on every turn, without sockets or stdin.
+# Server side code runs on fake sockets and a fake selector, and everything printed goes to a writer that throws it
+# away. Each benchmark reports calls/sec and the peak memory allocated during one call (tracemalloc).
+#
+#   python bench_micro.py                      run everything
+#   python bench_micro.py -k client            only benchmarks with "client" in their name
+#   python bench_micro.py --save               store the results as the baseline (bench_baseline.json)
+#   python bench_micro.py --check              fail if anything got slower or allocates more than --threshold
+#
+# Logging isn't configured here, so logger.info() calls cost what they do with logging off.
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import client
+import render
+import server
+from board import Board, fleet_error, random_board
+from game import Lobby, PlayerSession
+from timers import TimingWheel
+from protocol import FrameDecoder, encode_frame, delta_message, parse_request
+
+try:
+    import ai
+except ImportError:
+    # The computer opponent needs NumPy
+    ai = None
+
+BASELINE_FILE = "bench_baseline.json"
+BOARD = "11111...../2222....../333......./444......./55......../........../........../........../........../.........."
+# Water on BOARD, so a match never ends however many times these are shot at, plus one Carrier cell that can't sink it
+SHOTS = [letter + str(number) for number in range(6, 11) for letter in "ABCDEFGHIJ"] + ["A1"]
+SHOT_CELLS = [number * 10 + column for number in range(5, 10) for column in range(10)] + [0]
+# Spectators in the fan-out benchmark
+SPECTATORS = 1000
+
+class Discard(io.TextIOBase):
+    # Stands in for stdout, takes everything and keeps nothing
+    def write(self, text):
+        return len(text)
+
+class FakeSelector:
+    def register(self, fileobj, events, data=None):
+        pass
+
+    def modify(self, fileobj, events, data=None):
+        pass
+
+    def unregister(self, fileobj):
+        pass
+
+class FakeSocket:
+    # Accepts every write in full, and hands out the frames given to feed() one per recv_into()
+    def __init__(self):
+        self.incoming = []
+
+    def feed(self, data):
+        self.incoming.append(data)
+
+    def recv_into(self, view):
+        data = self.incoming.pop()
+        view[:len(data)] = data
+        return len(data)
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def send(self, data):
+        return len(data)
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+class FakeSession(PlayerSession):
+    # Game logic only, whatever it sends is dropped
+    def queue_message(self, req):
+        pass
+
+    def write(self):
+        pass
+
+    def close(self):
+        pass
+
+    def close_when_flushed(self):
+        self.closing = True
+
+def started_match():
+    # Two seated players whose game has started, the one going first first
+    lobby = Lobby()
+    players = [FakeSession(lobby, ("127.0.0.1", 5000 + seat)) for seat in (0, 1)]
+    for player in players:
+        player.join_game(BOARD)
+    players[0].send_buffer.clear()
+    players[1].send_buffer.clear()
+    match = players[0].match
+    return [players[match.first], players[match.second]]
+
+# Each benchmark sets up its state and returns the function to time
+
+def bench_game_pass_turn():
+    players = started_match()
+    shots = itertools.cycle(SHOT_CELLS)
+    def run():
+        players[0].pass_turn(next(shots))
+        players[0].send_buffer.clear()
+    return run
+
+def bench_game_check_game_state():
+    players = started_match()
+    def run():
+        players[0].check_game_state(0, 1, 2)
+        players[0].send_buffer.clear()
+    return run
+
+def bench_game_message_decode():
+    # Both players' attacks, in turn
+    players = started_match()
+    shots = itertools.cycle([("1" + shot).encode("utf-8") for shot in SHOTS])
+    turn = itertools.cycle(players)
+    def run():
+        player = next(turn)
+        player.message_decode(next(shots))
+        player.send_buffer.clear()
+    return run
+
+def bench_game_message_decode_invalid():
+    # Garbage that gets an error reply, with the error budget topped up so it is never disconnected
+    players = started_match()
+    requests = itertools.cycle([b"1Z99", b"9", b"1A", b"0\xff", b"3x"])
+    def run():
+        players[0].error_budget = 10
+        players[0].message_decode(next(requests))
+        players[0].send_buffer.clear()
+    return run
+
+def bench_game_join_game():
+    lobby = Lobby()
+    def run():
+        # One call is a whole pairing, both players joining
+        first = FakeSession(lobby, None)
+        second = FakeSession(lobby, None)
+        first.join_game(BOARD)
+        second.join_game(BOARD)
+        lobby.matches.clear()
+        lobby.seats.clear()
+    return run
+
+def bench_server_read_turn():
+    # A whole turn on the selectors engine: read the frame, run the turn and write both players' messages
+    server.lobby = Lobby()
+    selector = FakeSelector()
+    players = []
+    for seat in (0, 1):
+        players.append(server.ClientConnection(selector, FakeSocket(), ("127.0.0.1", 5000 + seat)))
+        players[-1].sock.feed(encode_frame(b"0" + BOARD.encode("utf-8")))
+        players[-1].read()
+    frames = itertools.cycle([encode_frame(("1" + shot).encode("utf-8")) for shot in SHOTS])
+    match = players[0].match
+    turn = itertools.cycle([match.first, match.second])
+    def run():
+        player = players[next(turn)]
+        player.sock.feed(next(frames))
+        player.read()
+    return run
+
+def bench_server_spectator_fanout():
+    # A turn in a match with SPECTATORS watching, every shot goes out to all of them
+    server.lobby = Lobby()
+    selector = FakeSelector()
+    players = []
+    for seat in (0, 1):
+        players.append(server.ClientConnection(selector, FakeSocket(), ("127.0.0.1", 5000 + seat)))
+        players[-1].sock.feed(encode_frame(b"0" + BOARD.encode("utf-8")))
+        players[-1].read()
+    for number in range(SPECTATORS):
+        spectator = server.ClientConnection(selector, FakeSocket(), ("127.0.0.1", 6000 + number))
+        spectator.sock.feed(encode_frame(b"9"))
+        spectator.read()
+    frames = itertools.cycle([encode_frame(("1" + shot).encode("utf-8")) for shot in SHOTS])
+    match = players[0].match
+    turn = itertools.cycle([match.first, match.second])
+    def run():
+        player = players[next(turn)]
+        player.sock.feed(next(frames))
+        player.read()
+    return run
+
+def bench_board_shoot():
+    board = Board(random_board())
+    cells = itertools.cycle(range(100))
+    def run():
+        board.shoot(next(cells))
+    return run
+
+def bench_board_random_board():
+    def run():
+        random_board()
+    return run
+
+def bench_board_fleet_error():
+    def run():
+        fleet_error(BOARD)
+    return run
+
+def bench_ai_next_cell():
+    # The computer opponent picking a shot and learning what it hit
+    target = Board(random_board())
+    targeting = None
+    def run():
+        nonlocal target, targeting
+        if targeting is None or target.all_sunk():
+            target, targeting = Board(random_board()), ai.Targeting("hard")
+        cell = targeting.next_cell()
+        hit, sunk = target.shoot(cell)
+        targeting.record(cell, hit, sunk)
+    return run
+
+def bench_timers_schedule_cancel():
+    # A turn's timeout being replaced, with 100k other timers pending
+    wheel = TimingWheel()
+    for i in range(100000):
+        wheel.schedule(60 + i % 600, print)
+    def run():
+        wheel.schedule(60, print).cancel()
+    return run
+
+def bench_protocol_parse_request():
+    requests = itertools.cycle([b"1A1", b"1J10", b"1Z99", b"3"])
+    def run():
+        parse_request(next(requests))
+    return run
+
+def bench_protocol_frames():
+    # One read holding ten delta messages
+    data = b"".join(encode_frame(delta_message(0, seq, "3", seq % 100, True, None)) for seq in range(10))
+    decoder = FrameDecoder()
+    def run():
+        decoder.feed(data)
+        for frame in decoder.frames():
+            pass
+    return run
+
+def bench_client_placement_validator():
+    board = "........../........../........../........../........../........../........../........../........../.........."
+    def run():
+        client.placement_validator(board, "C2", "down", 4, 2)
+    return run
+
+def bench_client_input_sanitizing():
+    player = client.Client(FakeSelector(), FakeSocket(), ("127.0.0.1", 5000), None)
+    def run():
+        player.input_sanitizing("J10")
+    return run
+
+def bench_render_format_board():
+    def run():
+        render.print_board(BOARD)
+    return run
+
+def bench_render_plain_frame():
+    # One board of the two changes every frame, like after a shot
+    renderer = render.Renderer()
+    boards = itertools.cycle([BOARD, BOARD.replace("1", "x", 1)])
+    def run():
+        renderer.draw([("Your ships and enemy attacks:", BOARD), ("Your attacks:", next(boards))])
+    return run
+
+def bench_render_ansi_frame():
+    # Same, but only the changed cell is redrawn
+    renderer = render.Renderer(ansi=True)
+    boards = itertools.cycle([BOARD, BOARD.replace("1", "x", 1)])
+    renderer.last = [("Your ships and enemy attacks:", BOARD), ("Your attacks:", BOARD)]
+    def run():
+        renderer.draw([("Your ships and enemy attacks:", BOARD), ("Your attacks:", next(boards))])
+    return run
+
+def bench_client_message_decode():
+    # A delta update for the attack board, which the client applies and prints
+    player = client.Client(FakeSelector(), FakeSocket(), ("127.0.0.1", 5000), None)
+    player.ship_board = bytearray(BOARD, "utf-8")
+    player.attack_board = bytearray(BOARD, "utf-8")
+    # Hit and miss in turn, so the board changes and is drawn every time
+    hits = itertools.cycle([False, True])
+    def run():
+        player.message_decode(delta_message(0, player.board_seq + 1, "3", 55, next(hits), None))
+    return run
+
+BENCHMARKS = {name[len("bench_"):].replace("_", ".", 1): function for name, function in globals().items() if name.startswith("bench_")}
+if ai is None:
+    del BENCHMARKS["ai.next_cell"]
+
+def measure(setup, min_time, repeat):
+    run = setup()
+    # Find a number of calls that takes about min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append(time.perf_counter() - start)
+
+    # Memory allocated at the peak of a single call
+    peaks = []
+    tracemalloc.start()
+    for _ in range(50):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {"ops": number / min(timings), "peak_bytes": statistics.median(peaks)}
+
+def compare(results, baseline, threshold):
+    """Names of the benchmarks that got slower or allocate more than threshold (a fraction) past the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["ops"] < base["ops"] * (1 - threshold):
+            regressions.append(f"{name}: {result['ops']:.0f} ops/s, baseline {base['ops']:.0f}")
+        # Small allocations move around by a few bytes from run to run
+        if result["peak_bytes"] > base["peak_bytes"] * (1 + threshold) + 64:
+            regressions.append(f"{name}: {result['peak_bytes']:.0f} peak bytes/call, baseline {base['peak_bytes']:.0f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the per-turn game and client code')
+    parser.add_argument('-k', default='', help='Only run benchmarks with this in their name')
+    parser.add_argument('--time', type=float, default=0.2, help='Seconds per timing run (default: 0.2)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per benchmark, the fastest counts (default: 5)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'Baseline file (default: {BASELINE_FILE})')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='Exit with an error if anything regressed past --threshold')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed regression as a fraction (default: 0.2)')
+    args = parser.parse_args()
+    if args.save and args.check:
+        parser.error("--check would compare the results with themselves after --save, run them separately")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'benchmark':<34}{'ops/s':>14}{'peak B/call':>14}{'vs baseline':>14}")
+    for name, setup in BENCHMARKS.items():
+        if args.k not in name:
+            continue
+        with contextlib.redirect_stdout(Discard()):
+            results[name] = measure(setup, args.time, args.repeat)
+        change = ""
+        if name in baseline:
+            change = f"{results[name]['ops'] / baseline[name]['ops'] - 1:+.1%}"
+        print(f"{name:<34}{results[name]['ops']:>14.0f}{results[name]['peak_bytes']:>14.0f}{change:>14}")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("saved baseline to", args.baseline)
+
+    if args.check:
+        if not baseline:
+            print("no baseline to check against, run with --save first")
+            sys.exit(1)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
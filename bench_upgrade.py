@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Hot upgrade under load.
+# Starts server.py with --upgrade-socket, has simulated players (see bot.py) play against it, and part way through
+# starts a second server.py with --take-over. Every game has to finish and no connection may be refused, while the
+# longest turn shows how long the players were kept waiting by the upgrade.
+#
+#   python bench_upgrade.py -m 200
+#   python bench_upgrade.py -m 500 -g 5 --think 20 --upgrade-after 2
+
+import argparse
+import asyncio
+import errno
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_engines import BOARD, wait_for_port
+from bot import run_players, percentile
+
+class ConnectProbe(threading.Thread):
+    # Opens a connection every interval for the whole run and counts the ones that don't get through
+    def __init__(self, port, interval=0.005):
+        super().__init__(daemon=True)
+        self.port = port
+        self.interval = interval
+        self.attempts = 0
+        self.refused = 0
+        self.slowest = 0.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            self.attempts += 1
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=5).close()
+            except OSError as e:
+                if e.errno == errno.ECONNREFUSED or isinstance(e, socket.timeout):
+                    self.refused += 1
+            self.slowest = max(self.slowest, time.perf_counter() - start)
+            self.stopped.wait(self.interval)
+
+def server_command(port, path, take_over=False):
+    command = [sys.executable, os.path.abspath("server.py"), "-p", str(port), "--upgrade-socket", path, "--quiet"]
+    if take_over:
+        command.append("--take-over")
+    return command
+
+def upgrade(workdir, port, path, delay, result):
+    # Start the new server once the load is going, and wait for it to say how long it took
+    time.sleep(delay)
+    new = subprocess.Popen(server_command(port, path, take_over=True), cwd=workdir, stdout=subprocess.PIPE, text=True)
+    result["new"] = new
+    result["took over"] = new.stdout.readline().strip()
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade the server in the middle of a load test')
+    parser.add_argument('-m', type=int, default=100, help='Games played at once (default: 100)')
+    parser.add_argument('-g', '--games', type=int, default=3, help='Games each pair of players plays on its connections (default: 3)')
+    parser.add_argument('-p', type=int, default=5060, help='Port to run the server on (default: 5060)')
+    parser.add_argument('--think', type=float, default=10, metavar='MS', help='Average time a player takes before each shot (default: 10)')
+    parser.add_argument('--upgrade-after', type=float, default=1.0, metavar='SECONDS', help='When to start the new server (default: 1)')
+    parser.add_argument('--delta', action='store_true', help='Have the players ask for board delta updates')
+    args = parser.parse_args()
+
+    # Run the servers in a scratch directory so their logs don't land in the checkout
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "upgrade.sock")
+        old = subprocess.Popen(server_command(args.p, path), cwd=workdir, stdout=subprocess.PIPE, text=True)
+        result = {}
+        probe = ConnectProbe(args.p)
+        try:
+            wait_for_port(args.p)
+            probe.start()
+            upgrader = threading.Thread(target=upgrade, args=(workdir, args.p, path, args.upgrade_after, result))
+            upgrader.start()
+            options = argparse.Namespace(board=BOARD, delta=args.delta, strategy="random", think=args.think / 1000,
+                                         games=args.games, reconnect=False)
+            start = time.perf_counter()
+            stats = asyncio.run(run_players("127.0.0.1", args.p, args.m * 2, options))
+            elapsed = time.perf_counter() - start
+            upgrader.join()
+            probe.stopped.set()
+            probe.join()
+            # The old server exits once it has handed everything over
+            old_exit = old.wait(timeout=10)
+            handed_off = old.stdout.read().strip().splitlines()
+        finally:
+            probe.stopped.set()
+            for server in (old, result.get("new")):
+                if server is not None and server.poll() is None:
+                    server.terminate()
+                    server.wait()
+
+    expected = args.m * args.games
+    print("old server:", handed_off[-1] if handed_off else "(nothing)", "- exit code", old_exit)
+    print("new server:", result.get("took over") or "(nothing)")
+    print(f"games {stats.matches}/{expected}, aborted {stats.aborted}, "
+          f"refused {probe.refused}/{probe.attempts} connects (slowest {probe.slowest * 1000:.1f} ms)")
+    print(f"turns p50 {percentile(stats.latencies, 0.50) * 1000:.2f} ms, p99 {percentile(stats.latencies, 0.99) * 1000:.2f} ms, "
+          f"longest {max(stats.latencies, default=0) * 1000:.2f} ms, {elapsed:.2f} s")
+    if stats.matches != expected or stats.aborted or probe.refused or old_exit != 0:
+        print("FAILED")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
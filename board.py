@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Game state for one player's board, stored as bitmasks.
+# Cells are numbered row by row, so A1 is cell 0, J1 is cell 9 and J10 is cell 99, and each cell is one bit.
+# The "/"-separated board string (11 characters per row) is only used at the protocol edge.
+
+import random
+
+EMPTY_BOARD = "........../........../........../........../........../........../........../........../........../.........."
+SHIP_TYPES = ("Carrier", "Battleship", "Cruiser", "Submarine", "Destroyer")
+# Ship sizes from the README, in SHIP_TYPES order (ship number - 1)
+SHIP_LENGTHS = (5, 4, 3, 3, 2)
+BOARD_SIZE = 10
+CELL_COUNT = BOARD_SIZE * BOARD_SIZE
+
+HIT = ord("x")
+MISS = ord("o")
+
+def cell_to_text_index(cell):
+    # Every row in the board string ends with a "/", so skip one extra character per row
+    return cell + cell // BOARD_SIZE
+
+# ---------------- Ship placement index ----------------
+# Every legal placement of a ship of each length, as a cell bitmask, built once. A fleet is legal when each ship's cells
+# form one of these masks, so checking a board or placing a ship at random never walks the cells one by one.
+
+def build_placements(length):
+    masks = []
+    # Left to right
+    for row in range(BOARD_SIZE):
+        for column in range(BOARD_SIZE - length + 1):
+            masks.append(((1 << length) - 1) << (row * BOARD_SIZE + column))
+    # Top to bottom
+    vertical = sum(1 << (i * BOARD_SIZE) for i in range(length))
+    for row in range(BOARD_SIZE - length + 1):
+        for column in range(BOARD_SIZE):
+            masks.append(vertical << (row * BOARD_SIZE + column))
+    return masks
+
+PLACEMENTS = {length: build_placements(length) for length in set(SHIP_LENGTHS)}
+PLACEMENT_SET = {length: frozenset(masks) for length, masks in PLACEMENTS.items()}
+# Where each placement's cells are in the board string
+PLACEMENT_TEXT = {mask: [cell_to_text_index(cell) for cell in range(CELL_COUNT) if mask >> cell & 1] for masks in PLACEMENTS.values() for mask in masks}
+
+# str.translate tables for reading masks out of the board's cells (the board string without its "/"s)
+CELL_CHARACTERS = ".12345"
+DELETE_CELL_CHARACTERS = str.maketrans("", "", CELL_CHARACTERS)
+TAKEN_TABLE = str.maketrans(CELL_CHARACTERS, "011111")
+SHIP_TABLES = [None] + [str.maketrans(CELL_CHARACTERS, "".join("1" if character == str(ship) else "0" for character in CELL_CHARACTERS)) for ship in range(1, len(SHIP_LENGTHS) + 1)]
+
+def cells_mask(cells, table):
+    # "1"/"0" per cell after translating, reversed so cell 0 is the lowest bit
+    return int(cells.translate(table)[::-1], 2)
+
+def fleet_error(ship_board):
+    """Why a board string isn't a legal fleet (bad size or characters, a ship missing, bent, too long or short, or
+    placed twice), or None if it is."""
+    if len(ship_board) != len(EMPTY_BOARD) or ship_board[BOARD_SIZE::BOARD_SIZE + 1] != "/" * (BOARD_SIZE - 1):
+        return "The board has to be 10 rows of 10 cells separated by /."
+    cells = ship_board.replace("/", "")
+    if len(cells) != CELL_COUNT or cells.translate(DELETE_CELL_CHARACTERS):
+        return "The board can only hold . and the ship numbers 1-5."
+    for ship, length in enumerate(SHIP_LENGTHS, 1):
+        if cells_mask(cells, SHIP_TABLES[ship]) not in PLACEMENT_SET[length]:
+            return f"The {SHIP_TYPES[ship - 1]} ({ship}) has to be one straight line of {length} cells."
+    return None
+
+def place_ships(ship_board=EMPTY_BOARD, ships=None, rng=random):
+    """ship_board with ships (ship numbers, all of them by default) placed at random where there is room."""
+    if ships is None:
+        ships = range(1, len(SHIP_LENGTHS) + 1)
+    text = bytearray(ship_board.encode("utf-8"))
+    taken = cells_mask(ship_board.replace("/", ""), TAKEN_TABLE)
+    for ship in ships:
+        masks = PLACEMENTS[SHIP_LENGTHS[ship - 1]]
+        mask = rng.choice(masks)
+        tries = 1
+        while mask & taken:
+            if tries == 100:
+                # Crowded board, pick from the placements that are actually free
+                free = [mask for mask in masks if not mask & taken]
+                if not free:
+                    raise ValueError(f"No room left for the {SHIP_TYPES[ship - 1]}.")
+                mask = rng.choice(free)
+                break
+            mask = rng.choice(masks)
+            tries += 1
+        taken |= mask
+        for text_index in PLACEMENT_TEXT[mask]:
+            text[text_index] = ord("0") + ship
+    return text.decode("utf-8")
+
+def random_board(rng=random):
+    """A board string with every ship placed at random, in the same format the client sends."""
+    return place_ships(rng=rng)
+
+class Board:
+    def __init__(self, ship_board):
+        # One mask per ship ("Carrier", "Battleship", "Cruiser", "Submarine", "Destroyer") and the number of its cells not hit yet
+        self.ship_masks = [0, 0, 0, 0, 0]
+        self.cells_left = [0, 0, 0, 0, 0]
+        # Ship number (1-5) on each cell, 0 for water, so a shot finds its ship without searching
+        self.cell_ships = bytearray(CELL_COUNT)
+        self.ships = 0
+        self.hits = 0
+        self.misses = 0
+
+        for text_index, value in enumerate(ship_board):
+            row, column = divmod(text_index, BOARD_SIZE + 1)
+            if column == BOARD_SIZE or row >= BOARD_SIZE:
+                continue
+            if value in "12345":
+                ship = int(value)
+                cell = row * BOARD_SIZE + column
+                self.ship_masks[ship - 1] |= 1 << cell
+                self.cells_left[ship - 1] += 1
+                self.cell_ships[cell] = ship
+                self.ships |= 1 << cell
+        # A ship that was never placed can't be sunk, so it doesn't count towards the game ending
+        self.ships_left = sum(1 for count in self.cells_left if count)
+
+        # Text forms sent to the players, kept up to date one byte per shot
+        # ship_text is the owner's view (ships, enemy hits and misses), attack_text is what the attacker sees
+        self.ship_text = bytearray(ship_board.encode("utf-8"))
+        self.attack_text = bytearray(EMPTY_BOARD.encode("utf-8"))
+
+    def shoot(self, cell):
+        """Attack a cell, returns (hit, sunk) where sunk is the index of a ship this shot sank, or None."""
+        if cell < 0 or cell >= CELL_COUNT:
+            raise ValueError(f"Cell {cell} is not on the board.")
+        bit = 1 << cell
+        text_index = cell_to_text_index(cell)
+        ship = self.cell_ships[cell]
+        if not ship:
+            #miss
+            self.misses |= bit
+            self.ship_text[text_index] = MISS
+            self.attack_text[text_index] = MISS
+            return False, None
+
+        #hit
+        self.ship_text[text_index] = HIT
+        self.attack_text[text_index] = HIT
+        if self.hits & bit:
+            # Already hit this cell before, nothing new was damaged
+            return True, None
+        self.hits |= bit
+        self.cells_left[ship - 1] -= 1
+        if self.cells_left[ship - 1] == 0:
+            self.ships_left -= 1
+            return True, ship - 1
+        return True, None
+
+    def state(self):
+        """Everything from_state needs to rebuild the board, as plain values."""
+        return [self.ship_masks, self.hits, self.misses, self.ship_board(), self.attack_board()]
+
+    @classmethod
+    def from_state(cls, state):
+        # Rebuilds a board from state() without parsing the ship board again, for boards handed to another process
+        ship_masks, hits, misses, ship_text, attack_text = state
+        board = cls.__new__(cls)
+        board.ship_masks = list(ship_masks)
+        board.cells_left = [bin(mask & ~hits).count("1") for mask in ship_masks]
+        board.cell_ships = bytearray(CELL_COUNT)
+        board.ships = 0
+        for ship, mask in enumerate(ship_masks):
+            board.ships |= mask
+            while mask:
+                low = mask & -mask
+                board.cell_ships[low.bit_length() - 1] = ship + 1
+                mask ^= low
+        board.hits = hits
+        board.misses = misses
+        board.ships_left = sum(1 for count in board.cells_left if count)
+        board.ship_text = bytearray(ship_text.encode("utf-8"))
+        board.attack_text = bytearray(attack_text.encode("utf-8"))
+        return board
+
+    def is_sunk(self, ship):
+        return self.cells_left[ship] == 0
+
+    def all_sunk(self):
+        return self.ships_left == 0
+
+    def ship_board(self):
+        return self.ship_text.decode("utf-8")
+
+    def attack_board(self):
+        return self.attack_text.decode("utf-8")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Headless players for load testing a server (python bot.py -p <port> -n <players>).
+# Each bot places its ships at random, fires at the enemy board with the chosen strategy whenever the server asks for
+# a move, and asks for another game on the same connection (like the client's "play again") until it has played
+# --games, or with --reconnect opens a new connection for every game.
+# When every bot is done it prints matches/sec, messages/sec and the turn round trip latency, from the attack being
+# sent to the server asking for the next one (so it takes in the opponent's move and their --think time), or to the
+# end of the game.
+#
+#   python bot.py -p 5050 -n 2000 -g 5
+#   python bot.py -p 5050 -n 20000 --processes 4 --strategy hunt --think 200 --delta
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+from board import BOARD_SIZE, CELL_COUNT, cell_to_text_index, random_board
+from protocol import FrameDecoder, encode_frame, parse_delta, DELTA_FEATURE
+
+LETTERS = "ABCDEFGHIJ"
+
+def cell_name(cell):
+    # 0 -> "A1", 99 -> "J10"
+    return LETTERS[cell % BOARD_SIZE] + str(cell // BOARD_SIZE + 1)
+
+class RandomStrategy:
+    # Every cell once, in random order
+    def __init__(self, rng):
+        self.cells = rng.sample(range(CELL_COUNT), CELL_COUNT)
+
+    def next_cell(self):
+        return self.cells.pop()
+
+    def record(self, cell, hit):
+        pass
+
+class SequentialStrategy(RandomStrategy):
+    # A1, B1, ... J10
+    def __init__(self, rng):
+        self.cells = list(range(CELL_COUNT - 1, -1, -1))
+
+class HuntStrategy(RandomStrategy):
+    # Random shots until something is hit, then the cells around every hit
+    def __init__(self, rng):
+        super().__init__(rng)
+        self.shot = bytearray(CELL_COUNT)
+        self.targets = []
+
+    def next_cell(self):
+        while True:
+            cell = self.targets.pop() if self.targets else self.cells.pop()
+            if not self.shot[cell]:
+                self.shot[cell] = 1
+                return cell
+
+    def record(self, cell, hit):
+        if not hit:
+            return
+        row, column = divmod(cell, BOARD_SIZE)
+        if row > 0:
+            self.targets.append(cell - BOARD_SIZE)
+        if row < BOARD_SIZE - 1:
+            self.targets.append(cell + BOARD_SIZE)
+        if column > 0:
+            self.targets.append(cell - 1)
+        if column < BOARD_SIZE - 1:
+            self.targets.append(cell + 1)
+
+STRATEGIES = {"random": RandomStrategy, "sequential": SequentialStrategy, "hunt": HuntStrategy}
+
+class Stats:
+    def __init__(self):
+        self.matches = 0
+        self.games = 0
+        self.aborted = 0
+        self.shots = 0
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+
+    def merge(self, other):
+        self.matches += other.matches
+        self.games += other.games
+        self.aborted += other.aborted
+        self.shots += other.shots
+        self.sent += other.sent
+        self.received += other.received
+        self.latencies += other.latencies
+
+class BotPlayer(asyncio.Protocol):
+    # One bot's connection, for games games one after another. done gets the number played when it closes.
+    def __init__(self, options, stats, rng, done, games):
+        self.options = options
+        self.games = games
+        self.played = 0
+        self.stats = stats
+        self.rng = rng
+        self.done = done
+        self.transport = None
+        self.recv_buffer = FrameDecoder()
+        self.strategy = STRATEGIES[options.strategy](rng)
+        self.last_cell = None
+        self.sent_at = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        board = self.options.board or random_board(self.rng)
+        join = b"0" + board.encode("utf-8")
+        if self.options.delta:
+            join += b";" + DELTA_FEATURE.encode("utf-8")
+        self.send(join)
+
+    def send(self, message):
+        self.stats.sent += 1
+        self.transport.write(encode_frame(message))
+
+    def data_received(self, data):
+        self.recv_buffer.feed(data)
+        for frame in self.recv_buffer.frames():
+            self.stats.received += 1
+            self.message_decode(frame)
+
+    def message_decode(self, data):
+        action = data[0]
+        if self.sent_at is not None and action in b"145":
+            # Asked for our next move, or the game is over: that closes the turn
+            self.stats.latencies.append(time.perf_counter() - self.sent_at)
+            self.sent_at = None
+        if action == ord("1"):
+            if self.options.think:
+                asyncio.get_running_loop().call_later(self.rng.uniform(0, 2 * self.options.think), self.fire)
+            else:
+                self.fire()
+        elif action == ord("3"):
+            # Our attack board, the last shot's cell says if it hit
+            if self.last_cell is not None:
+                self.strategy.record(self.last_cell, data[2 + cell_to_text_index(self.last_cell)] == ord("x"))
+        elif action == ord("6"):
+            seq, board_type, cell, mark, sunk = parse_delta(str(data[2:], "utf-8"))
+            if board_type == "3":
+                self.strategy.record(cell, mark == "x")
+        elif action == ord("4"):
+            self.stats.games += 1
+            self.played += 1
+            if bytes(data[2:]) == b"You Win!":
+                # Count every match once, from the winner's side
+                self.stats.matches += 1
+            if self.played < self.games:
+                # Same fleet, fresh shots
+                self.strategy = STRATEGIES[self.options.strategy](self.rng)
+                self.last_cell = None
+                self.send(b"2")
+            else:
+                self.transport.close()
+        elif action == ord("5"):
+            self.stats.aborted += 1
+            # Counts as played, so a bot can't keep starting games that get called off
+            self.played += 1
+            self.transport.close()
+
+    def fire(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.last_cell = self.strategy.next_cell()
+        self.stats.shots += 1
+        self.sent_at = time.perf_counter()
+        self.send(("1" + cell_name(self.last_cell)).encode("utf-8"))
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if not self.done.done():
+            self.done.set_result(self.played)
+
+async def play(host, port, options, stats, rng):
+    loop = asyncio.get_running_loop()
+    played = 0
+    while played < options.games:
+        done = loop.create_future()
+        games = 1 if options.reconnect else options.games - played
+        await loop.create_connection(lambda: BotPlayer(options, stats, rng, done, games), host, port)
+        # A connection the server closed before a game ended still counts for one, so this always finishes
+        played += max(1, await done)
+
+async def run_players(host, port, players, options, seed=None):
+    """Run players bots at once until each has played options.games games, returns their Stats."""
+    stats = Stats()
+    rng = random.Random(seed)
+    await asyncio.gather(*(play(host, port, options, stats, random.Random(rng.random())) for i in range(players)))
+    return stats
+
+def run_process(host, port, players, options, seed):
+    # Entry point for one process of a --processes run
+    return asyncio.run(run_players(host, port, players, options, seed))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def report(stats, elapsed):
+    return {
+        "matches": stats.matches,
+        "aborted": stats.aborted,
+        "matches/s": stats.matches / elapsed,
+        "msgs/s": (stats.sent + stats.received) / elapsed,
+        "shots/s": stats.shots / elapsed,
+        "p50 ms": percentile(stats.latencies, 0.50) * 1000,
+        "p99 ms": percentile(stats.latencies, 0.99) * 1000,
+        "p999 ms": percentile(stats.latencies, 0.999) * 1000,
+        "seconds": elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated players for load testing the Battleship server')
+    parser.add_argument('-i', default='127.0.0.1', help='Server IP (default: 127.0.0.1)')
+    parser.add_argument('-p', type=int, required=True, help='Server port')
+    parser.add_argument('-n', type=int, default=100, help='Number of bots playing at once (default: 100)')
+    parser.add_argument('-g', '--games', type=int, default=1, help='Games each bot plays, one after another (default: 1)')
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES), default='random', help='How bots pick their shots (default: random)')
+    parser.add_argument('--think', type=float, default=0, metavar='MS', help='Average time a bot takes before each shot (default: 0)')
+    parser.add_argument('--delta', action='store_true', help='Ask for board delta updates')
+    parser.add_argument('--reconnect', action='store_true', help='Open a new connection for every game instead of playing again on the same one')
+    parser.add_argument('--board', help='Use this board for every bot instead of placing ships at random')
+    parser.add_argument('--processes', type=int, default=1, help='Split the bots over this many processes (default: 1)')
+    parser.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+    parser.add_argument('--json', action='store_true', help='Print the results as one JSON object')
+    options = parser.parse_args()
+    options.think /= 1000
+    if options.n * options.games % 2:
+        parser.error("-n times --games has to be even, or the last bot never gets an opponent")
+
+    rng = random.Random(options.seed)
+    start = time.perf_counter()
+    if options.processes > 1:
+        shares = [options.n // options.processes + (i < options.n % options.processes) for i in range(options.processes)]
+        with multiprocessing.Pool(options.processes) as pool:
+            results = pool.starmap(run_process, [(options.i, options.p, share, options, rng.random()) for share in shares])
+        stats = Stats()
+        for result in results:
+            stats.merge(result)
+    else:
+        stats = asyncio.run(run_players(options.i, options.p, options.n, options, rng.random()))
+    result = report(stats, time.perf_counter() - start)
+
+    if options.json:
+        print(json.dumps(result))
+        return
+    for name, value in result.items():
+        print(f"{name:>10}: {value:.2f}" if isinstance(value, float) else f"{name:>10}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import time
 import socket
 import selectors
 import traceback
@@ -8,27 +10,30 @@ import struct
 import logging
 import argparse
 
+from board import SHIP_LENGTHS, SHIP_TYPES, cell_to_text_index, place_ships
+from log_pipeline import setup_logging
+from render import Renderer, print_board
+from protocol import FrameDecoder, encode_frame, parse_delta, parse_snapshot, DELTA_FEATURE, COMPUTER_FEATURE
+
 class Client:
     def __init__(self, sel, sock, serverAddr, request):
         self.selector = sel
         self.sock = sock
         self.serverAddr = serverAddr
-        self.recv_buffer = []
+        self.recv_buffer = FrameDecoder()
         self.send_buffer = []
         self.request = request
         self.response_created = False
-        self.numbers_to_letters = {
-            0: 'A',
-            1: 'B',
-            2: 'C',
-            3: 'D',
-            4: 'E',
-            5: 'F',
-            6: 'G',
-            7: 'H',
-            8: 'I',
-            9: 'J'
-        }
+        # Our own copy of both boards when the server sends delta updates
+        self.ship_board = None
+        self.attack_board = None
+        self.board_seq = 0
+        # Both players' waters when watching a match
+        self.waters = None
+        # Times in a row we connected again to resume the game, see connection_lost
+        self.attempt = 0
+        # A game ended and they haven't asked for the next one yet
+        self.between_games = False
 
     def set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -73,83 +78,168 @@ class Client:
             self.sock = None
 
     def message_decode(self, data):
-        decodedData = data.decode("utf-8")
-        for i in range(decodedData.count("~")):
-            info = decodedData[2:decodedData.index("~")]
-            logger.info("Received %s from %s", info, self.serverAddr)
-            if decodedData[0] == "0": # Info message from the server
-                print(info)
-            elif decodedData[0] == "1": # Request for information from the server
-                print(info)
-                # Read the data, its time to write
-                self.set_selector_events_mask("w")
-            elif decodedData[0] == "2": # Message containing ship board
-                print("Your ships and enemy attacks:")
-                self.print_formatted_board(info)
-            elif decodedData[0] == "3": # Message containing attack board
-                print("Your attacks:")
-                self.print_formatted_board(info)
-            elif decodedData[0] == "4":
-                print(info)
-                inp = input("Would you like to play again? y/n: ")
-                if inp.lower() == "y":
-                    sel.unregister(self.sock)
-                    req = b"0" + board.encode("utf-8") 
-                    start_game_connection(host, port, req)
-                    print("Connecting to the server to play again!")
-                    logger.info("Connecting to the server to play again.")
-                else:
-                    print("Exiting program...")
-                    logger.info("Exiting program.")
-                    sys.exit()
-            elif decodedData[0] == "5": # Message saying the server stopped, and the reason why
-                print(info)
-                print("Exiting program...")
-                logger.info("Exiting program.")
-                sys.exit()
-            else:
-                print("There was an error receiving data from the server.")
-                logger.info("Unexpected error getting info from the server from: %s", self.serverAddr)
-            
-            decodedData = decodedData[decodedData.index("~") + 1:]
-
-    def print_formatted_board(self, board):
-        formatted_board = board.replace("/", "\n")
-        # Column labels
-        print("   ", end="")
-        for i in range(10):
-            print(self.numbers_to_letters[i] + " ", end="")
-        print()
-
-        row = 0
-        for i in formatted_board:
-            # Row labels
-            if row % 11 == 0:
-                if row // 11 == 9: # if the last row
-                    print(str((row // 11) + 1) + " ", end="")
-                else: # all other rows
-                    print(str((row // 11) + 1) + "  ", end="")
-            row += 1
-
-            if i == "\n":
-                print(i, end="")
-            else:
-                print(i + " ", end="")
-        print()
-    
+        # data is one complete message from the server, the frame decoder already split them up
+        global resume_token, messages_seen
+        decodedData = str(data, "utf-8")
+        info = decodedData[2:]
+        logger.info("Received %s from %s", info, self.serverAddr)
+        if decodedData[0] == "0": # Info message from the server
+            print(info)
+        elif decodedData[0] == "1": # Request for information from the server
+            print(info)
+            # Keep reading from the server while they type, the answer is sent from attack_input
+            line_reader.prompt("What tile would you like to attack? ", self.attack_input)
+        elif decodedData[0] == "2": # Message containing ship board
+            self.ship_board = bytearray(info, "utf-8")
+            self.show_boards()
+        elif decodedData[0] == "3": # Message containing attack board
+            self.attack_board = bytearray(info, "utf-8")
+            self.show_boards()
+        elif decodedData[0] == "6" and watch is not None: # A shot in the match we are watching
+            self.apply_spectator_delta(int(decodedData[1]), info)
+        elif decodedData[0] == "7" and watch is not None: # Snapshot of both players' waters
+            self.board_seq, first_waters, second_waters = parse_snapshot(info)
+            self.waters = [bytearray(first_waters, "utf-8"), bytearray(second_waters, "utf-8")]
+            self.show_boards()
+        elif decodedData[0] == "6": # Change to one of our boards
+            self.apply_board_delta(int(decodedData[1]), info)
+        elif decodedData[0] == "7": # Snapshot of both of our boards
+            self.board_seq, ship_board, attack_board = parse_snapshot(info)
+            self.ship_board = bytearray(ship_board, "utf-8")
+            self.attack_board = bytearray(attack_board, "utf-8")
+            self.show_boards()
+        elif decodedData[0] == "4" and watch is not None: # The match we were watching is over
+            print(info)
+            print("Exiting program...")
+            logger.info("Exiting program.")
+            sys.exit()
+        elif decodedData[0] == "4":
+            print(info)
+            resume_token = None
+            self.between_games = True
+            # The connection stays open for the next game
+            line_reader.prompt("Would you like to play again? y/n: ", self.play_again_input)
+        elif decodedData[0] == "5": # Message saying the server stopped, and the reason why
+            print(info)
+            if self.between_games:
+                # Between games, they can still say they want to play again on a new connection
+                self.close()
+                return
+            print("Exiting program...")
+            logger.info("Exiting program.")
+            sys.exit()
+        elif decodedData[0] == "8": # Resume token for this game, the messages after it are counted
+            resume_token = info
+            messages_seen = 0
+        else:
+            print("There was an error receiving data from the server.")
+            logger.info("Unexpected error getting info from the server from: %s", self.serverAddr)
+
+    def apply_board_delta(self, player, info):
+        seq, board_type, cell, mark, sunk = parse_delta(info)
+        if self.ship_board is None or seq != self.board_seq + 1:
+            # We missed an update, so our copy of the boards can't be trusted anymore
+            self.request_resync()
+            return
+        self.board_seq = seq
+        if board_type == "2":
+            self.ship_board[cell_to_text_index(cell)] = ord(mark)
+            self.show_boards()
+            if sunk is not None:
+                print("Player " + str(2 - player) + " sunk your " + SHIP_TYPES[sunk] + "!")
+        else:
+            self.attack_board[cell_to_text_index(cell)] = ord(mark)
+            self.show_boards()
+            if sunk is not None:
+                print("You sunk Player " + str(2 - player) + "'s " + SHIP_TYPES[sunk] + "!")
+
+    def apply_spectator_delta(self, player, info):
+        # player fired at the other player's waters
+        seq, board_type, cell, mark, sunk = parse_delta(info)
+        if self.waters is None or seq != self.board_seq + 1:
+            self.request_resync()
+            return
+        self.board_seq = seq
+        target = 1 - player
+        self.waters[target][cell_to_text_index(cell)] = ord(mark)
+        self.show_boards()
+        if sunk is not None:
+            print("Player " + str(player + 1) + " sunk Player " + str(target + 1) + "'s " + SHIP_TYPES[sunk] + "!")
+
+    def request_resync(self):
+        # Ask the server for a full snapshot of both boards
+        print("Board update out of order, asking the server for the full boards.")
+        logger.info("Board update out of order, requesting a resync from %s", self.serverAddr)
+        self.sock.send(encode_frame(b"3"))
+
+    def show_boards(self):
+        # The renderer works out what changed since it last drew them
+        if watch is not None:
+            renderer.draw([("Player 1's waters:", self.waters[0].decode("utf-8")),
+                           ("Player 2's waters:", self.waters[1].decode("utf-8"))])
+            return
+        renderer.draw([("Your ships and enemy attacks:", None if self.ship_board is None else self.ship_board.decode("utf-8")),
+                       ("Your attacks:", None if self.attack_board is None else self.attack_board.decode("utf-8"))])
+
     def read(self):
+        global messages_seen
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            count = self.recv_buffer.recv_into(self.sock)
         except BlockingIOError as error:
             pass
+        except ConnectionError:
+            self.connection_lost()
         else:
-            if data:
-                # process data
-                self.message_decode(data)
+            if count:
+                self.attempt = 0
+                # process every complete message, a partial one stays buffered until the rest arrives
+                for data in self.recv_buffer.frames():
+                    if resume_token is not None and data[:1] != b"8":
+                        messages_seen += 1
+                    self.message_decode(data)
+                    if self.sock is None:
+                        break
             else:
-                raise RuntimeError("Peer closed.") # Change to handle server closing and client disconnecting
-            
+                self.connection_lost()
+
+    def connection_lost(self):
+        global resuming, resume_at
+        # In a game the server holds our seat for a while, so connect again and pick up where we left off
+        if resume_token is None:
+            if self.between_games:
+                # Closed between games, a new connection is made if they want to play again
+                self.close()
+                return
+            raise RuntimeError("Peer closed.")
+        if self.attempt >= RESUME_ATTEMPTS:
+            print("Couldn't get back into the game. Exiting program...")
+            logger.info("Gave up resuming the game after %s attempts, exiting program.", self.attempt)
+            sys.exit()
+        print("Lost the connection to the server, trying to get back into the game...")
+        logger.info("Lost the connection to %s, resuming the game after %s messages", self.serverAddr, messages_seen)
+        self.close()
+        if self.attempt:
+            # Give the server a moment, the main loop calls resume once it's time and keeps reading stdin meanwhile
+            resuming, resume_at = self, time.monotonic() + RESUME_DELAY
+        else:
+            self.resume()
+
+    def resume(self):
+        client = start_game_connection(host, port, ("5" + resume_token + ":" + str(messages_seen)).encode("utf-8"))
+        client.take_over(self)
+
+    def take_over(self, old):
+        # Carry the game on from the connection that dropped
+        self.attempt = old.attempt + 1
+        self.ship_board = old.ship_board
+        self.attack_board = old.attack_board
+        self.board_seq = old.board_seq
+        # A move typed while we were reconnecting, sent after the resume request
+        self.send_buffer.extend(old.send_buffer)
+        if line_reader.handler == old.attack_input:
+            line_reader.handler = self.attack_input
+
     # Sends whatever data is in the request variable to the server
     def write(self):
         for req in self.send_buffer: # if there is something to send
@@ -157,13 +247,15 @@ class Client:
             print("sending", repr(req), "to", self.serverAddr)
             logger.info("sending %s to %s", repr(req), self.serverAddr)
             try:
-                # Send the data to the specified player
-                self.sock.send(req)
+                # Send the data to the server, prefixed with its length
+                self.sock.send(encode_frame(req))
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                pass
+            except OSError:
+                self.send_buffer.clear()
+                self.connection_lost()
+                return
 
         # Clear request and buffer after all information has been sent
         self.send_buffer.clear()
@@ -196,73 +288,149 @@ class Client:
             return None
         return input
 
-    def get_request_data(self):
-        if self.request == None:
-            retry_prompt = True
-            while(retry_prompt):
-                playerInput = input("What tile would you like to attack? ")
-                safe_input = self.input_sanitizing(playerInput)
-                if safe_input is not None:
-                    retry_prompt = False
-                    self.request = ("1" + str(playerInput)).encode("utf-8")
-                    self.send_buffer.append(self.request)
+    def attack_input(self, playerInput):
+        if self.sock is None and resuming is not self:
+            return
+        safe_input = self.input_sanitizing(playerInput)
+        if safe_input is None:
+            line_reader.prompt("What tile would you like to attack? ", self.attack_input)
+            return
+        # After the request this connection was opened with, if that hasn't gone out yet
+        self.send_buffer.append(("1" + str(playerInput)).encode("utf-8"))
+        if self.sock is not None:
+            # Sent once the socket is ready, see process
+            self.set_selector_events_mask("w")
+
+    def play_again_input(self, inp):
+        if inp.lower() == "y":
+            line_reader.prompt("Would you like to keep the same ships? y/n: ", self.same_fleet_input)
         else:
-            self.send_buffer.append(self.request)
+            print("Exiting program...")
+            logger.info("Exiting program.")
+            sys.exit()
+
+    def same_fleet_input(self, inp):
+        if inp.lower() == "n":
+            place_fleet(auto_place, self.play_again)
+        else:
+            self.play_again(None)
+
+    def play_again(self, new_board):
+        # new_board is None to keep the same ships
+        global board
+        if new_board is not None:
+            board = new_board
+        self.between_games = False
+        if self.sock is None:
+            # The server hung up after the game
+            start_game_connection(host, port, join_request(board))
+            print("Connecting to the server to play again!")
+            logger.info("Connecting to the server to play again.")
+            return
+        # Asked on the same connection, with nothing after the action to play with the same ships
+        self.send_buffer.append(b"2" if new_board is None else b"2" + join_request(board)[1:])
+        self.ship_board = None
+        self.attack_board = None
+        self.board_seq = 0
+        print("Asking the server for another game!")
+        logger.info("Asking the server for another game.")
+        self.set_selector_events_mask("w")
+
+    def get_request_data(self):
+        if self.request is not None:
+            self.send_buffer.insert(0, self.request)
 
     def process(self, mask):
         if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE:
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
             self.get_request_data()
             self.write()
 
+class LineReader:
+    # Reads stdin from the same select() loop as the server socket, so messages from the server (like the opponent
+    # leaving) still come in and get shown while the player is typing. Only watched while a prompt is waiting for
+    # an answer.
+    def __init__(self, sel):
+        self.selector = sel
+        self.buffer = b""
+        self.handler = None
+
+    def prompt(self, text, handler):
+        """Show text and call handler with the next line typed, without blocking."""
+        if not STDIN_SELECTABLE:
+            # select() can't watch stdin here (Windows), so wait for the line like input() always did
+            handler(input(text))
+            return
+        print(text, end="", flush=True)
+        if self.handler is None:
+            self.selector.register(sys.stdin, selectors.EVENT_READ, data=self)
+        self.handler = handler
+        # Typed ahead of the prompt
+        self.deliver()
+
+    def close(self):
+        if self.handler is not None:
+            self.selector.unregister(sys.stdin)
+            self.handler = None
+
+    def read_line(self, text):
+        """Wait for the next line typed, like input(), for when there is nothing else to watch."""
+        if not STDIN_SELECTABLE:
+            return input(text)
+        print(text, end="", flush=True)
+        while b"\n" not in self.buffer:
+            self.fill()
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line.decode("utf-8", "replace").strip()
+
+    def fill(self):
+        # Every read of stdin goes through here. input() would pull lines into sys.stdin's own buffer, where
+        # select() can't see them and os.read() can't get them back.
+        # The terminal hands over whole lines, but a pipe may not, so keep what comes after the last newline
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            print("\nExiting program...")
+            logger.info("Standard input closed, exiting program.")
+            sys.exit()
+        self.buffer += data
+
+    def process(self, mask):
+        self.fill()
+        self.deliver()
+
+    def deliver(self):
+        if self.handler is not None and b"\n" in self.buffer:
+            line, _, self.buffer = self.buffer.partition(b"\n")
+            handler = self.handler
+            self.close()
+            # The handler may prompt again, which hands it the next line if there is one
+            handler(line.decode("utf-8", "replace").strip())
+
 
 # =================================================
 # ========== START OF THE CLIENT PROGRAM ==========
 sel = selectors.DefaultSelector()
 
-# Set up logging for client
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename="client.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-
-# non-class usage for initialize. can probably use for class as well but I dont want to break anything rn
-def print_formatted_board(board):
-        
-        numbers_to_letters = {
-            0: 'A',
-            1: 'B',
-            2: 'C',
-            3: 'D',
-            4: 'E',
-            5: 'F',
-            6: 'G',
-            7: 'H',
-            8: 'I',
-            9: 'J'
-        }
-
-        formatted_board = board.replace("/", "\n")
-        # Column labels
-        print("   ", end="")
-        for i in range(10):
-            print(numbers_to_letters[i] + " ", end="")
-        print()
-
-        row = 0
-        for i in formatted_board:
-            # Row labels
-            if row % 11 == 0:
-                if row // 11 == 9: # if the last row
-                    print(str((row // 11) + 1) + " ", end="")
-                else: # all other rows
-                    print(str((row // 11) + 1) + "  ", end="")
-            row += 1
-
-            if i == "\n":
-                print(i, end="")
-            else:
-                print(i + " ", end="")
-        print()
+# select() only takes sockets on Windows
+STDIN_SELECTABLE = os.name != "nt"
+line_reader = LineReader(sel)
+# Difficulty of the computer opponent, None to play another person
+computer = None
+# Match number to watch ("" for the newest one), None to play
+watch = None
+# Draws the boards, --ansi turns on redrawing them in place
+renderer = Renderer()
+# Token to get back into the game with if the connection drops, and the messages we got since it came
+resume_token = None
+messages_seen = 0
+# Tries at connecting again before giving up on the game, a second apart after the first
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 1.0
+# Connection that dropped and is waiting for its next try at resuming, and when that try is due
+resuming = None
+resume_at = 0.0
 
 def placement_validator(board, coordinate, direction, size, boat_number):
     board = list(board)
@@ -316,33 +484,80 @@ def placement_validator(board, coordinate, direction, size, boat_number):
                     return None
     return ''.join(board)
                 
-def initialize_board():
-    ship_types = ("Carrier", "Battleship", "Cruiser", "Submarine", "Destroyer")
-    ship_lengths = (5,4,4,3,2)
-    board = "........../........../........../........../........../........../........../........../........../.........."
-    print("First, lets place your ships. You have a Carrier (Length 5), Battleship (Length 4), Cruiser (Length 3), Submarine (Length 3), and Destroyer (Length 2)")
-    print("Your empty board looks like this: ")
-    print_formatted_board("".join(board))
-    print("For each ship, pick a starting coordinate and direction (up, down, left, right)")
-    print("ie: C2 down")
-    for i in range(5):
-        retry_prompt = True
-        while(retry_prompt):
-            user_input = input(f"Input a starting coordinate and direction for your {ship_types[i]} (Length {ship_lengths[i]}).\n")
-            if user_input.count(" ") == 1:
-                coordinate, direction = user_input.split()
-                validate_value = placement_validator(board, coordinate.upper().strip(), direction.lower().strip(), ship_lengths[i], i+1)
-            else:
-                print("Your input is invalid. For each ship, pick a starting coordinate and direction (up, down, left, right)")
-                print("ie: C2 down")
-                validate_value = None
-            if validate_value is not None:
-                board = validate_value
-                retry_prompt = False
-                print("Your board now looks like this:")
-                print_formatted_board(board)
+class FleetPlacer:
+    # Places the ships one typed line at a time, so the same steps can be driven by a blocking loop before we connect
+    # (initialize_board) or by LineReader prompts while a connection is open (place_fleet)
+    def __init__(self):
+        self.board = "........../........../........../........../........../........../........../........../........../.........."
+        self.ship = 0
+        print("First, lets place your ships. You have a Carrier (Length 5), Battleship (Length 4), Cruiser (Length 3), Submarine (Length 3), and Destroyer (Length 2)")
+        print("Your empty board looks like this: ")
+        print_board(self.board)
+        print("For each ship, pick a starting coordinate and direction (up, down, left, right)")
+        print("ie: C2 down")
+        print("Or type auto to place the rest of your ships at random")
+
+    def question(self):
+        return f"Input a starting coordinate and direction for your {SHIP_TYPES[self.ship]} (Length {SHIP_LENGTHS[self.ship]}).\n"
+
+    def answer(self, user_input):
+        """Place the next ship from a typed line, returns True once every ship is placed."""
+        if user_input.strip().lower() == "auto":
+            self.board = place_ships(self.board, range(self.ship + 1, 6))
+            print("Your board now looks like this:")
+            print_board(self.board)
+            return True
+        if user_input.count(" ") == 1:
+            coordinate, direction = user_input.split()
+            validate_value = placement_validator(self.board, coordinate.upper().strip(), direction.lower().strip(), SHIP_LENGTHS[self.ship], self.ship + 1)
+        else:
+            print("Your input is invalid. For each ship, pick a starting coordinate and direction (up, down, left, right)")
+            print("ie: C2 down")
+            validate_value = None
+        if validate_value is not None:
+            self.board = validate_value
+            self.ship += 1
+            print("Your board now looks like this:")
+            print_board(self.board)
+        return self.ship == len(SHIP_LENGTHS)
+
+def random_fleet():
+    board = place_ships()
+    print("Your ships were placed at random:")
+    print_board(board)
     return board
 
+def initialize_board(auto_place=False):
+    # Only before we connect, it waits on stdin and nothing else
+    if auto_place:
+        return random_fleet()
+    placer = FleetPlacer()
+    while not placer.answer(line_reader.read_line(placer.question())):
+        pass
+    return placer.board
+
+def place_fleet(auto_place, done):
+    # initialize_board from LineReader prompts, so the server is still read while they place their ships.
+    # done is called with the board.
+    if auto_place:
+        done(random_fleet())
+        return
+    placer = FleetPlacer()
+
+    def answer(user_input):
+        if placer.answer(user_input):
+            done(placer.board)
+        else:
+            line_reader.prompt(placer.question(), answer)
+    line_reader.prompt(placer.question(), answer)
+
+def join_request(board):
+    # Ask for board delta updates instead of full boards after every shot, and for the computer as opponent if wanted
+    features = [DELTA_FEATURE]
+    if computer is not None:
+        features.append(COMPUTER_FEATURE + "=" + computer)
+    return b"0" + board.encode("utf-8") + b";" + ",".join(features).encode("utf-8")
+
 def start_game_connection(host, port, request):
     addr = (host, int(port))
     print("starting connection to", addr)
@@ -355,62 +570,87 @@ def start_game_connection(host, port, request):
     # Creates a client object, which handles sending data to the server and receiving data as well
     client = Client(sel, sock, addr, request)
     sel.register(sock, events, data=client)
+    return client
     
 # -------------------- START TO GAME ------------------------
-print("\nWelcome to Battleship!")
-logger.info("Starting program.")
-
-parser = argparse.ArgumentParser(description='Server for Battleship terminal game')
-parser.add_argument('-i', help='Server IP', required=True)
-parser.add_argument('-p', help='Server port', required=True)
-args = parser.parse_args()
-
-host, port = (args.i, args.p)
-
-if (not host or not port):
-    print("Enter host and port as such: <host> <port>")
-    sys.exit(1)
-
-# Hardcode:
-#board = "11111...../2222....../3333....../444......./55......../........../........../........../........../.........."
-#board =  "1........./........../........../........../........../........../........../........../........../.........."
-# cli input:
-# board = input("\nPlease enter your ship positions:\n")
-
-# Real:
-board = initialize_board()
-logger.info("Initialized player board information.")
-
-#action, value = sys.argv[3], sys.argv[4]
-request = b"0" + board.encode("utf-8") 
-start_game_connection(host, port, request)
-
-print("Connected to the server!")
-logger.info("Connected to the server at %s on port %s", host, port)
-
-try:
-    while True:
-        events = sel.select(timeout=1)
-        for key, mask in events:
-            client = key.data
-            try:
-                # Checks if the client is reading or writing, and if the server sent us any data
-                client.process(mask)
-            except Exception:
-                print(
-                    "main: error: exception for",
-                    f"{client}:\n{traceback.format_exc()}",
-                )
-                logger.error(
-                    "main: error: exception for %s: %s",
-                    client, traceback.format_exc()
-                )
-                client.close()
-        # If there are still sockets open then continue the program
-        if not sel.get_map():
-            break
-except KeyboardInterrupt:
-    print("caught keyboard interrupt, exiting")
-    logger.info("Caught keyboard interrupt, exiting program")
-finally:
-    sel.close()
\ No newline at end of file
+def main():
+    global host, port, board, computer, watch, auto_place, resuming
+    # Set up logging for client
+    setup_logging("client.log")
+
+    print("\nWelcome to Battleship!")
+    logger.info("Starting program.")
+
+    parser = argparse.ArgumentParser(description='Server for Battleship terminal game')
+    parser.add_argument('-i', help='Server IP', required=True)
+    parser.add_argument('-p', help='Server port', required=True)
+    parser.add_argument('--auto-place', action='store_true', help='Place your ships at random instead of one by one')
+    parser.add_argument('--watch', nargs='?', const='', metavar='MATCH', help="Watch a match instead of playing (default: the newest one)")
+    parser.add_argument('--ansi', action='store_true', help='Keep both boards side by side at the top of the terminal and redraw only the cells that change')
+    parser.add_argument('--computer', nargs='?', const='medium', choices=['easy', 'medium', 'hard'], help='Play against the computer (default difficulty: medium)')
+    args = parser.parse_args()
+
+    host, port = (args.i, args.p)
+    auto_place = args.auto_place
+    computer = args.computer
+    watch = args.watch
+    # Escape codes only make sense on a terminal
+    renderer.ansi = args.ansi and sys.stdout.isatty()
+
+    if (not host or not port):
+        print("Enter host and port as such: <host> <port>")
+        sys.exit(1)
+
+    # Hardcode:
+    #board = "11111...../2222....../3333....../444......./55......../........../........../........../........../.........."
+    #board =  "1........./........../........../........../........../........../........../........../........../.........."
+    # cli input:
+    # board = input("\nPlease enter your ship positions:\n")
+
+    if watch is not None:
+        start_game_connection(host, port, ("9" + watch).encode("utf-8"))
+    else:
+        # Real:
+        board = initialize_board(auto_place)
+        logger.info("Initialized player board information.")
+
+        #action, value = sys.argv[3], sys.argv[4]
+        start_game_connection(host, port, join_request(board))
+
+    print("Connected to the server!")
+    logger.info("Connected to the server at %s on port %s", host, port)
+
+    try:
+        while True:
+            # Wake up in time for the next try at resuming the game
+            timeout = 1 if resuming is None else max(0, min(1, resume_at - time.monotonic()))
+            events = sel.select(timeout=timeout)
+            for key, mask in events:
+                client = key.data
+                try:
+                    # Checks if the client is reading or writing, and if the server sent us any data
+                    client.process(mask)
+                except Exception:
+                    print(
+                        "main: error: exception for",
+                        f"{client}:\n{traceback.format_exc()}",
+                    )
+                    logger.error(
+                        "main: error: exception for %s: %s",
+                        client, traceback.format_exc()
+                    )
+                    client.close()
+            if resuming is not None and time.monotonic() >= resume_at:
+                client, resuming = resuming, None
+                client.resume()
+            # If there are still sockets open (or one is about to be) then continue the program
+            if not sel.get_map() and resuming is None:
+                break
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+        logger.info("Caught keyboard interrupt, exiting program")
+    finally:
+        sel.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,970 @@
+#!/usr/bin/env python3
+
+# Game logic shared by every server engine.
+# A PlayerSession handles one player's messages and leaves the socket handling to the engine, which only has to
+# feed it complete messages (message_decode) and provide queue_message, write, close and close_when_flushed.
+
+import logging
+import random
+import secrets
+import time
+from collections import deque
+from itertools import islice
+
+import metrics
+from board import Board, CELL_COUNT, EMPTY_BOARD, SHIP_TYPES, fleet_error, random_board
+from log_pipeline import echo, log_received, log_sent
+from timers import TimingWheel
+from protocol import encode_frame, parse_join, parse_delta, parse_request, computer_difficulty, delta_message, snapshot_message, ATTACK, DELTA_FEATURE, JOIN, PLAY_AGAIN, RESUME, RESYNC, SPECTATE
+
+try:
+    import ai
+except ImportError:
+    # The computer opponent needs NumPy
+    ai = None
+
+logger = logging.getLogger(__name__)
+
+# Bad requests (and resyncs, the one request a client can send whenever it likes) a connection can make at once, and
+# how many a second it gets back. A connection that runs out is disconnected.
+ERROR_BUDGET = 10
+ERROR_REFILL = 1.0
+# What spectators see of a board nobody has joined with yet
+EMPTY_WATERS = EMPTY_BOARD.encode("utf-8")
+# Messages kept per seat for a player who reconnects with their resume token, a few turns' worth
+REPLAY_SIZE = 64
+
+class Match:
+    # boards holds each player's Board (their ships positions, and their enemies hits and misses, see board.py)
+    # connections holds each player's PlayerSession, in the same seat order
+    def __init__(self, match_id):
+        self.match_id = match_id
+        self.connections = []
+        # Written to the lobby's journal, if it has one
+        self.journaled = True
+        # The match's running timeout, waiting for players or for the next move
+        self.timer = None
+        # Connections watching the match (see PlayerSession.watch), and the messages for them made during this read
+        self.spectators = set()
+        self.spectator_messages = []
+        # Counts the board updates sent to spectators, like board_seq does for a player
+        self.spectator_seq = 0
+        # Framed snapshot of both boards for spectators, made once per board change
+        self.spectator_snapshot = None
+        # Per seat: resume token (None when they can't resume), messages sent since the token and the last
+        # REPLAY_SIZE of them, see PlayerSession.resume_session
+        self.tokens = [None, None]
+        self.sent = [0, 0]
+        self.replay = [deque(maxlen=REPLAY_SIZE), deque(maxlen=REPLAY_SIZE)]
+        # Seats whose connection dropped, held for them until the lobby's resume_grace runs out
+        self.absent = set()
+        self.reset_game_data()
+
+    def reset_game_data(self):
+        self.boards = []
+        self.first = 0
+        self.second = 1
+        self.first_wants_to_play_again = False
+        self.second_wants_to_play_again = False
+        self.shots = 0
+        # Someone won, as opposed to the match being called off
+        self.finished = False
+
+    def tell_spectators(self, req):
+        if self.spectators:
+            self.spectator_messages.append(req)
+
+    def snapshot_for_spectators(self):
+        # Spectators see what each player knows about the other's fleet, the hits and misses, never the ships
+        if self.spectator_snapshot is None:
+            waters = [bytes(board.attack_text) for board in self.boards] + [EMPTY_WATERS] * (2 - len(self.boards))
+            self.spectator_snapshot = encode_frame(snapshot_message(0, self.spectator_seq, waters[0], waters[1]))
+        return self.spectator_snapshot
+
+    def flush_spectators(self):
+        # Frame the messages once and hand the same bytes to every spectator, however many there are
+        if not self.spectator_messages:
+            return
+        data = b"".join([encode_frame(req) for req in self.spectator_messages])
+        for req in self.spectator_messages:
+            metrics.messages_out[req[0]] += len(self.spectators)
+        self.spectator_messages.clear()
+        for spectator in self.spectators:
+            spectator.queue_shared(data)
+            spectator.write()
+
+class Lobby:
+    # Pairs incoming joins into independent matches. Every seated connection maps to
+    # its (match, seat) so the connection handling code never has to search for it.
+    # journal is a journal.Journal every match event is written to, or None.
+    # The timeouts are in seconds, None for never: turn_timeout for a move (then on_timeout, "forfeit" or "random"
+    # for a random move), join_timeout for an opponent to show up and idle_timeout for a connection that sends nothing.
+    # The limits are None for no limit: max_connections open at once, max_per_ip from one address, max_matches
+    # running (or waiting for a player) at once and max_spectators watching one match.
+    # resume_grace is how long a seat is held for a player whose connection dropped, None to end the match right away.
+    def __init__(self, journal=None, turn_timeout=None, join_timeout=None, idle_timeout=None, on_timeout="forfeit",
+                 max_connections=None, max_per_ip=None, max_matches=None, max_spectators=None, resume_grace=None):
+        self.matches = {}
+        self.seats = {}
+        self.waiting = None
+        self.next_match_id = 0
+        self.journal = journal
+        # board -> [(match, seat)] of seats in matches rebuilt from the journal that nobody has come back to yet
+        self.unclaimed = {}
+        # Work to run once the engine is done with the current read, see call_soon
+        self.deferred = deque()
+        # The engine advances it from its event loop
+        self.timers = TimingWheel()
+        self.turn_timeout = turn_timeout
+        self.join_timeout = join_timeout
+        self.idle_timeout = idle_timeout
+        self.on_timeout = on_timeout
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_matches = max_matches
+        self.max_spectators = max_spectators
+        self.resume_grace = resume_grace
+        # resume token -> (match, seat)
+        self.sessions = {}
+        # Open connections, in total and per address
+        self.connection_count = 0
+        self.ip_connections = {}
+
+    def seat_player(self, connection, board):
+        if self.waiting is None:
+            self.waiting = Match(self.next_match_id)
+            self.matches[self.next_match_id] = self.waiting
+            self.next_match_id += 1
+            self.set_timer(self.waiting, self.join_timeout, self.join_timed_out, self.waiting)
+        match = self.waiting
+        seat = len(match.connections)
+        match.boards.append(Board(board))
+        match.connections.append(connection)
+        match.tokens[seat] = self.new_token(connection)
+        self.seats[connection] = (match, seat)
+        if len(match.connections) == 2:
+            # Match is full, the next join starts a new one
+            self.waiting = None
+        if self.journal is not None:
+            # With the token, so they can get the seat back after a restart (see restore)
+            self.journal.join(match.match_id, seat, board, match.tokens[seat])
+        return match, seat
+
+    def new_token(self, connection):
+        # The token a player gets back into their seat with, handed out when the game starts (see
+        # PlayerSession.hand_out_tokens). None if the server doesn't hold seats or they can't come back.
+        if self.resume_grace is None or not connection.resumable:
+            return None
+        return secrets.token_hex(16)
+
+    def seat_against_computer(self, connection, board, computer):
+        # A match of its own with the computer in the second seat. It isn't journaled, the computer
+        # couldn't come back to it after a restart.
+        match = Match(self.next_match_id)
+        match.journaled = False
+        self.matches[self.next_match_id] = match
+        self.next_match_id += 1
+        for seat, (player, player_board) in enumerate(((connection, board), (computer, computer.board))):
+            match.boards.append(Board(player_board))
+            match.connections.append(player)
+            match.tokens[seat] = self.new_token(player)
+            self.seats[player] = (match, seat)
+        return match
+
+    def admit_connection(self, ip):
+        # The engine asks before setting anything up for a new connection, returns why it can't come in or None
+        if self.max_connections is not None and self.connection_count >= self.max_connections:
+            return "The server is full. Try again later."
+        if self.max_per_ip is not None and self.ip_connections.get(ip, 0) >= self.max_per_ip:
+            return "Too many connections from your address."
+        self.add_connection(ip)
+        return None
+
+    def add_connection(self, ip):
+        self.connection_count += 1
+        self.ip_connections[ip] = self.ip_connections.get(ip, 0) + 1
+
+    def connection_closed(self, ip):
+        self.connection_count -= 1
+        count = self.ip_connections.pop(ip) - 1
+        if count:
+            self.ip_connections[ip] = count
+
+    def is_full(self, computer=False):
+        # A join that needs a new match (every game against the computer does) when there are max_matches already
+        if self.max_matches is None:
+            return False
+        return (computer or self.waiting is None) and len(self.matches) >= self.max_matches
+
+    def match_to_watch(self, match_id):
+        # The match a spectator asked for, the newest one if they didn't say, returns (match, why they can't watch)
+        if match_id is None:
+            match = next(reversed(self.matches.values()), None)
+            if match is None:
+                return None, "No matches are being played right now."
+        else:
+            match = self.matches.get(match_id)
+            if match is None:
+                return None, "There is no match " + str(match_id) + "."
+        if self.max_spectators is not None and len(match.spectators) >= self.max_spectators:
+            return None, "Too many people are watching that match."
+        return match, None
+
+    def dismiss_spectators(self, match):
+        if not match.spectators:
+            return
+        if not match.finished:
+            match.tell_spectators(b"50The match was called off.")
+        match.flush_spectators()
+        for spectator in match.spectators:
+            spectator.watching = None
+            spectator.close_when_flushed()
+        match.spectators.clear()
+
+    def set_timer(self, match, delay, callback, *args):
+        # Replace the match's timeout, a delay of None just cancels it
+        if match.timer is not None:
+            match.timer.cancel()
+        match.timer = None if delay is None else self.timers.schedule(delay, callback, *args)
+
+    def join_timed_out(self, match):
+        # Nobody came to play in time, send whoever did home
+        if self.matches.get(match.match_id) is not match:
+            return
+        echo("Match", match.match_id, "timed out waiting for players.")
+        for seat, connection in enumerate(match.connections):
+            if connection is not None:
+                connection.queue_message(("5" + str(seat) + "No opponent joined in time. Try again later.").encode("utf-8"))
+                connection.write()
+        self.end_match(match)
+
+    def resume_timed_out(self, match, seat):
+        # The player who dropped didn't come back in time, the match ends like any other disconnect
+        if self.matches.get(match.match_id) is not match or seat not in match.absent:
+            return
+        echo("Player", seat + 1, "in match", match.match_id, "didn't come back.")
+        logger.info("Player %s didn't come back to match %s. Ending the match.", seat + 1, match.match_id)
+        other = 1 - seat
+        if other not in match.absent:
+            connection = match.connections[other]
+            connection.queue_message(("5" + str(other) + "Player " + str(seat + 1) + " didn't come back. Ending the match.").encode("utf-8"))
+            connection.write()
+        self.end_match(match)
+
+    def call_soon(self, callback):
+        # Run callback after the engine has finished handling the current message, instead of in the middle of it
+        self.deferred.append(callback)
+
+    def run_deferred(self):
+        while self.deferred:
+            self.deferred.popleft()()
+
+    def restore(self, journaled_matches):
+        # Rebuild matches that were being played when the server stopped (see journal.py). Each seat goes back
+        # to the player who resumes with its token, or for a seat journaled without one, to the first player who
+        # joins with the same board.
+        for journaled in journaled_matches:
+            match = Match(journaled.match_id)
+            match.connections = [None, None]
+            match.boards = [Board(board) for board in journaled.boards]
+            match.first = journaled.first
+            match.second = 1 - journaled.first
+            for seat, cell in journaled.shots:
+                match.boards[1 - seat].shoot(cell)
+            match.shots = len(journaled.shots)
+            self.matches[match.match_id] = match
+            self.next_match_id = max(self.next_match_id, match.match_id + 1)
+            # Dropped if the players don't come back
+            self.set_timer(match, self.join_timeout, self.join_timed_out, match)
+            for seat, board in enumerate(journaled.boards):
+                token = journaled.tokens[seat]
+                if token is not None:
+                    match.tokens[seat] = token
+                    self.sessions[token] = (match, seat)
+                else:
+                    self.unclaimed.setdefault(board, []).append((match, seat))
+        if journaled_matches:
+            logger.info("Restored %s matches from the journal", len(journaled_matches))
+
+    def reclaim_seat(self, connection, board):
+        # Seat a player in a restored match that has their board and no token, returns (match, seat) or (None, None)
+        seats = self.unclaimed.get(board)
+        if not seats:
+            return None, None
+        match, seat = seats.pop(0)
+        if not seats:
+            del self.unclaimed[board]
+        match.connections[seat] = connection
+        self.seats[connection] = (match, seat)
+        return match, seat
+
+    def find(self, connection):
+        return self.seats.get(connection, (None, None))
+
+    def end_match(self, match):
+        # Tear down a single match, closing its connections without touching any other game
+        logger.info("Match %s ended, %s matches still running.", match.match_id, len(self.matches) - 1)
+        if self.journal is not None and match.journaled:
+            self.journal.end(match.match_id)
+        self.set_timer(match, None, None)
+        # A restored match can end before both players came back
+        for board, seats in list(self.unclaimed.items()):
+            seats[:] = [(other, seat) for other, seat in seats if other is not match]
+            if not seats:
+                del self.unclaimed[board]
+        self.dismiss_spectators(match)
+        for token in match.tokens:
+            self.sessions.pop(token, None)
+        for seat, connection in enumerate(match.connections):
+            if connection is None:
+                continue
+            self.seats.pop(connection, None)
+            if seat in match.absent:
+                # Closed when it dropped
+                continue
+            if match.finished and connection.resumable:
+                # Someone won, so the players stay connected and can ask for another game (see play_again)
+                connection.match = connection.seat = None
+                continue
+            connection.stop_idle_timer()
+            # Let anything still queued (like the game end message) go out before closing
+            connection.close_when_flushed()
+        match.connections = []
+        self.matches.pop(match.match_id, None)
+        if self.waiting is match:
+            self.waiting = None
+
+class PlayerSession:
+    def __init__(self, lobby, addr):
+        self.lobby = lobby
+        self.addr = addr
+        # Messages made while handling a read, addressed to a seat by their second character
+        self.send_buffer = []
+        self.closing = False
+        self.match = None
+        self.seat = None
+        # The match they are watching as a spectator
+        self.watching = None
+        # Spectator updates were dropped because they fell behind, they get a snapshot once they catch up
+        self.stale = False
+        # Board delta mode, negotiated in the join message
+        self.delta_updates = False
+        self.board_seq = 0
+        # What the player sent to join, kept so they can be moved to another worker (see workers.py)
+        self.join_data = None
+        self.request = None
+        self.response_created = False
+        # Token bucket for bad requests, see ERROR_BUDGET
+        self.error_budget = ERROR_BUDGET
+        self.error_time = time.monotonic()
+        # When they last sent anything, for the idle timeout
+        self.last_heard = lobby.timers.now
+        self.idle_timer = None
+        # Gets a resume token when a game starts, see hand_out_tokens
+        self.resumable = True
+        self.watch_idle(lobby.idle_timeout)
+
+    # Engines provide these
+    def queue_message(self, req):
+        raise NotImplementedError
+
+    def write(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def close_when_flushed(self):
+        raise NotImplementedError
+
+    def queue_shared(self, data):
+        # Already framed bytes shared with other connections, for spectators. Slow spectators skip these and get
+        # catch_up() instead of falling further behind.
+        raise NotImplementedError
+
+    def queued_bytes(self):
+        # Bytes waiting to be sent to the player, for the metrics
+        return 0
+
+    def join_game(self, data, rejoining=False):
+        # rejoining is for a waiting player moved here from another worker, they already got the waiting message
+        board, features = parse_join(data)
+        error = fleet_error(board)
+        if error is not None:
+            echo("Rejected the board from", self.addr, "-", error)
+            self.refuse("Invalid board. " + error)
+            return
+        self.join_data = data
+        self.delta_updates = DELTA_FEATURE in features
+        if self.lobby.unclaimed:
+            # Coming back to a match that was running when the server stopped
+            self.match, self.seat = self.lobby.reclaim_seat(self, board)
+            if self.match is not None:
+                self.resume_match()
+                return
+        difficulty = computer_difficulty(features)
+        if self.lobby.is_full(difficulty is not None and ai is not None):
+            logger.info("Turned %s away, %s matches running", self.addr, len(self.lobby.matches))
+            self.refuse("The server is full. Try again later.")
+            return
+        if difficulty is not None and ai is not None:
+            # Single player, the computer takes the other seat right away
+            computer = ComputerPlayer(self.lobby, difficulty)
+            self.match = self.lobby.seat_against_computer(self, board, computer)
+            self.seat = 0
+            computer.match, computer.seat = self.match, 1
+            logger.info("Match %s: %s is playing the computer (%s)", self.match.match_id, self.addr, computer.difficulty)
+            self.start_game()
+            return
+        self.match, self.seat = self.lobby.seat_player(self, board)
+        p = self.match
+        if len(p.connections) == 1:
+            if rejoining:
+                return
+            if difficulty is not None:
+                self.request = ("00" + "Playing the computer isn't available on this server.").encode("utf-8")
+                self.send_buffer.append(self.request)
+            self.request = ("00" + "Waiting for Player 2").encode("utf-8")
+            self.send_buffer.append(self.request)
+        else:
+            self.start_game()
+
+    def play_again(self, data):
+        # Another game on the same connection, with the fleet from the last one unless they sent a new one. They go
+        # back in the lobby like any other join, so whoever is waiting (often their last opponent) plays them next.
+        if data is None:
+            if self.join_data is None:
+                self.reject(PLAY_AGAIN, "Send a board, there is no last game to take it from.")
+                return
+            data = self.join_data
+        logger.info("%s asked to play again", self.addr)
+        self.board_seq = 0
+        self.join_game(data)
+
+    def refuse(self, reason):
+        # Never seated, so this goes straight to the connection instead of through dispatch
+        self.queue_message(("50" + reason).encode("utf-8"))
+        self.write()
+        self.close_when_flushed()
+
+    def start_game(self):
+        p = self.match
+        self.hand_out_tokens()
+        # Send a message to each player saying the game is starting
+        self.request = ("00" + "All players are here. Game Starting...").encode("utf-8")
+        self.send_buffer.append(self.request)
+        self.request = ("01" + "All players are here. Game Starting...").encode("utf-8")
+        self.send_buffer.append(self.request)
+
+        # Determine which player is going first
+        if random.randint(0,1) == 0: # if 0, player 2 goes first
+            p.first = 1
+            p.second = 0
+        if self.lobby.journal is not None and p.journaled:
+            self.lobby.journal.first(p.match_id, p.first)
+
+        # Delta clients keep their own copy of the boards, so give them a snapshot to start from
+        for seat in (0, 1):
+            if p.connections[seat].delta_updates:
+                self.send_snapshot(seat)
+
+        # Send an info request to starting player asking for info, and a message to the other playing saying waiting for player 1's move
+        self.request = ("0" + str(p.second) + "Player " + str(p.first + 1) + " is going first. Waiting for their move...").encode("utf-8")
+        self.send_buffer.append(self.request)
+        self.request = ("1" + str(p.first) + "You are going first! Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+        self.send_buffer.append(self.request)
+        self.lobby.set_timer(p, self.lobby.turn_timeout, p.connections[p.first].turn_timed_out)
+        p.tell_spectators(("00" + "Player " + str(p.first + 1) + " is going first.").encode("utf-8"))
+
+    def hand_out_tokens(self):
+        # A token for each player to get back into the match with if their connection drops. It has to be the first
+        # message of the game, the player counts the messages after it and sends the count back with the token.
+        # The tokens were made when they sat down (see Lobby.new_token).
+        p = self.match
+        for seat in (0, 1):
+            token = p.tokens[seat]
+            if token is not None:
+                # Whatever they got while waiting for an opponent doesn't count
+                p.sent[seat] = 0
+                p.replay[seat].clear()
+                self.lobby.sessions[token] = (p, seat)
+                self.send_buffer.append(("8" + str(seat) + token).encode("utf-8"))
+
+    def resume_match(self):
+        # Seated back in a match restored from the journal, pick the game up once both players are here
+        p = self.match
+        if p.connections[1 - self.seat] is None:
+            self.request = ("0" + str(self.seat) + "Rejoined your match. Waiting for Player " + str(2 - self.seat) + " to come back...").encode("utf-8")
+            self.send_buffer.append(self.request)
+            return
+        for seat in (0, 1):
+            self.request = ("0" + str(seat) + "All players are back. Resuming the game...").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.send_boards(seat)
+        # Turns alternate, so the number of shots so far says whose move it is
+        shooter = p.first if p.shots % 2 == 0 else p.second
+        self.request = ("0" + str(1 - shooter) + "Waiting for Player " + str(shooter + 1) + "'s move...").encode("utf-8")
+        self.send_buffer.append(self.request)
+        self.request = ("1" + str(shooter) + "Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+        self.send_buffer.append(self.request)
+        self.lobby.set_timer(p, self.lobby.turn_timeout, p.connections[shooter].turn_timed_out)
+
+    def pass_turn(self, cell):
+        start = time.perf_counter_ns()
+        p = self.match
+        current_player = self.seat
+        target = 1 - current_player
+        target_board = p.boards[target]
+        hit, sunk = target_board.shoot(cell)
+        p.shots += 1
+        p.spectator_seq += 1
+        p.spectator_snapshot = None
+        p.tell_spectators(delta_message(current_player, p.spectator_seq, "3", cell, hit, sunk))
+        if self.lobby.journal is not None and p.journaled:
+            self.lobby.journal.shot(p.match_id, current_player, cell, hit, sunk)
+
+        # Send the player inputting the attack their updated attack board
+        attacker = p.connections[current_player]
+        if attacker.delta_updates:
+            attacker.board_seq += 1
+            self.request = delta_message(current_player, attacker.board_seq, "3", cell, hit, sunk)
+        else:
+            self.request = ("3" + str(current_player)).encode("utf-8") + target_board.attack_text
+        self.send_buffer.append(self.request)
+        # Send the other player their updated ship board
+        defender = p.connections[target]
+        if defender.delta_updates:
+            defender.board_seq += 1
+            self.request = delta_message(target, defender.board_seq, "2", cell, hit, sunk)
+        else:
+            self.request = ("2" + str(target)).encode("utf-8") + target_board.ship_text
+        self.send_buffer.append(self.request)
+
+        # CHECK GAME STATE (is the game over, has a ship been sunk, etc.)
+        end_game = self.check_game_state(current_player, target, sunk)
+        if end_game:
+            self.end_game(current_player, target)
+        else:
+            # Request attack move from the other player
+            self.request = ("1" + str(target) + "Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.lobby.set_timer(p, self.lobby.turn_timeout, p.connections[target].turn_timed_out)
+        metrics.shot_seconds.record(time.perf_counter_ns() - start)
+
+    def check_game_state(self, current_player, target, sunk):
+        # The board keeps a count of unhit cells per ship, so the shot already told us if it sank a ship
+        # Delta clients already got the sunk ship in their board update
+        p = self.match
+        if sunk is not None:
+            #Telling attacker
+            if not p.connections[current_player].delta_updates:
+                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s " + SHIP_TYPES[sunk] + "!").encode("utf-8")
+                self.send_buffer.append(self.request)
+            #Telling target
+            if not p.connections[target].delta_updates:
+                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your " + SHIP_TYPES[sunk] + "!").encode("utf-8")
+                self.send_buffer.append(self.request)
+        #all target's ships sunk?
+        return p.boards[target].all_sunk()
+
+    def send_snapshot(self, seat):
+        # Full copy of a player's ship board and attack board, for delta clients joining or resyncing
+        p = self.match
+        self.request = snapshot_message(seat, p.connections[seat].board_seq, p.boards[seat].ship_text, p.boards[1 - seat].attack_text)
+        self.send_buffer.append(self.request)
+
+    def send_boards(self, seat):
+        # Both of a player's boards, however they asked to get them
+        p = self.match
+        if p.connections[seat].delta_updates:
+            self.send_snapshot(seat)
+        else:
+            self.request = ("2" + str(seat)).encode("utf-8") + p.boards[seat].ship_text
+            self.send_buffer.append(self.request)
+            self.request = ("3" + str(seat)).encode("utf-8") + p.boards[1 - seat].attack_text
+            self.send_buffer.append(self.request)
+
+    def resume_session(self, value):
+        # A player whose connection dropped is back on this one, with their resume token and how many messages they
+        # got after it. They get the ones they missed from the replay buffer and carry on where they were.
+        token, seen = value
+        p, seat = self.lobby.sessions.get(token, (None, None))
+        if p is None:
+            self.refuse("That game is over.")
+            return
+        old = p.connections[seat]
+        if old is None:
+            # Their seat in a match restored from the journal, nobody has taken it back yet
+            self.reclaim_session(p, seat, token)
+            return
+        if seat in p.absent:
+            p.absent.discard(seat)
+        else:
+            # The old connection hasn't noticed it is dead yet, close it without ending the match
+            self.lobby.seats.pop(old, None)
+            old.match = old.seat = None
+            old.closing = True
+            old.stop_idle_timer()
+            old.close()
+        p.connections[seat] = self
+        self.lobby.seats[self] = (p, seat)
+        self.match, self.seat = p, seat
+        self.delta_updates = old.delta_updates
+        self.board_seq = old.board_seq
+        self.join_data = old.join_data
+        missed = p.sent[seat] - seen
+        replay = p.replay[seat]
+        if 0 <= missed <= len(replay):
+            for req in islice(replay, len(replay) - missed, None):
+                log_sent(req, self.addr)
+                self.queue_message(req)
+        else:
+            # Further back than the replay buffer goes: the token again, so they start counting over, and the
+            # whole game instead
+            missed = None
+            p.sent[seat] = 0
+            replay.clear()
+            self.queue_message(("8" + str(seat) + token).encode("utf-8"))
+            self.send_boards(seat)
+            if self.my_turn():
+                self.request = ("1" + str(seat) + "Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+            else:
+                self.request = ("0" + str(seat) + "Waiting for Player " + str(2 - seat) + "'s move...").encode("utf-8")
+            self.send_buffer.append(self.request)
+        echo("Player", seat + 1, "is back in match", p.match_id, "from", self.addr)
+        logger.info("Player %s resumed match %s from %s, %s", seat + 1, p.match_id, self.addr,
+                    "sent everything again" if missed is None else "replayed " + str(missed) + " messages")
+        shooter = p.first if p.shots % 2 == 0 else p.second
+        if shooter == seat:
+            self.request = ("0" + str(1 - seat) + "Player " + str(seat + 1) + " is back.").encode("utf-8")
+        else:
+            # Asked again, a move they tried while the game was on hold was turned down
+            self.request = ("1" + str(shooter) + "Player " + str(seat + 1) + " is back. Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+        self.send_buffer.append(self.request)
+        if p.absent:
+            # The other player is away too, the game stays on hold until they're back or their grace runs out
+            self.request = ("0" + str(seat) + "Waiting for Player " + str(2 - seat) + " to come back...").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.lobby.set_timer(p, self.lobby.resume_grace, self.lobby.resume_timed_out, p, min(p.absent))
+        else:
+            self.lobby.set_timer(p, self.lobby.turn_timeout, p.connections[shooter].turn_timed_out)
+        self.write()
+
+    def reclaim_session(self, p, seat, token):
+        # Back in a restored match with the token. Nothing this server sent them can be replayed, so the token
+        # again to count from and then the game like a rejoin with the board (see resume_match).
+        p.connections[seat] = self
+        self.lobby.seats[self] = (p, seat)
+        self.match, self.seat = p, seat
+        echo("Player", seat + 1, "is back in restored match", p.match_id, "from", self.addr)
+        logger.info("Player %s took their seat in restored match %s back from %s", seat + 1, p.match_id, self.addr)
+        self.send_buffer.append(("8" + str(seat) + token).encode("utf-8"))
+        self.resume_match()
+
+    def resync(self):
+        if self.watching is not None:
+            self.queue_shared(self.watching.snapshot_for_spectators())
+            self.write()
+            return
+        if not self.in_game():
+            return
+        self.send_snapshot(self.seat)
+
+    def watch(self, match_id):
+        # Spectator, sent every board change of the match until it ends
+        match, error = self.lobby.match_to_watch(match_id)
+        if error is not None:
+            self.refuse(error)
+            return
+        self.watching = match
+        match.spectators.add(self)
+        # They only listen, the match ending is what closes the connection
+        self.stop_idle_timer()
+        logger.info("%s is watching match %s, %s spectators", self.addr, match.match_id, len(match.spectators))
+        if len(match.connections) < 2:
+            self.queue_message(("00" + "Watching match " + str(match.match_id) + ". Waiting for Player 2...").encode("utf-8"))
+        else:
+            self.queue_message(("00" + "Watching match " + str(match.match_id) + ".").encode("utf-8"))
+        self.queue_shared(match.snapshot_for_spectators())
+        self.write()
+
+    def catch_up(self):
+        # Called by the engine once a spectator that fell behind has sent everything it had
+        self.stale = False
+        if self.watching is not None:
+            metrics.messages_out[ord("7")] += 1
+            self.queue_shared(self.watching.snapshot_for_spectators())
+
+    def stop_watching(self):
+        if self.watching is not None:
+            self.watching.spectators.discard(self)
+            self.watching = None
+
+    def end_game(self, current_player, target):
+        self.match.finished = True
+        self.match.tell_spectators(("40" + "Player " + str(current_player + 1) + " won!").encode("utf-8"))
+        # Telling player who sent the final attack
+        self.request = ("4" + str(current_player) + "You Win!").encode("utf-8")
+        self.send_buffer.append(self.request)
+        #Telling target
+        self.request = ("4" + str(target) + "You Lose!").encode("utf-8")
+        self.send_buffer.append(self.request)
+
+    def message_decode(self, data):
+        log_received(data, self.addr)
+        self.last_heard = self.lobby.timers.now
+        action, value, error = parse_request(data)
+        if error is None:
+            error = self.request_error(action)
+        if error is not None:
+            self.reject(action, error)
+            return
+        if action == JOIN:
+            self.join_game(value)
+        elif action == ATTACK:
+            self.pass_turn(value)
+        elif action == SPECTATE:
+            self.watch(value)
+        elif action == RESUME:
+            self.resume_session(value)
+        elif action == PLAY_AGAIN:
+            self.play_again(value)
+        else:
+            # Resyncs come out of the same budget as errors, so they can't be used to flood the server with snapshots
+            if self.spend_error_budget():
+                self.kick("Too many invalid requests.")
+                return
+            self.resync()
+
+    def in_game(self):
+        # Seated in a match both players are in
+        p = self.match
+        return p is not None and len(p.connections) == 2 and None not in p.connections
+
+    def request_error(self, action):
+        # Requests that are well formed but can't be handled right now
+        if self.watching is not None:
+            if action != RESYNC:
+                return "You are watching a match."
+        elif action == JOIN or action == SPECTATE or action == RESUME or action == PLAY_AGAIN:
+            if self.match is not None:
+                return "You already joined a game."
+        elif action == ATTACK:
+            if not self.in_game():
+                return "The game hasn't started."
+            if not self.my_turn():
+                return "It isn't your turn."
+            if self.match.absent:
+                return "Waiting for Player " + str(2 - self.seat) + " to come back."
+        return None
+
+    def my_turn(self):
+        # Turns alternate, so the number of shots so far says whose move it is
+        p = self.match
+        return self.seat == (p.first if p.shots % 2 == 0 else p.second)
+
+    def spend_error_budget(self):
+        # True when the connection is out of budget
+        now = time.monotonic()
+        self.error_budget = min(ERROR_BUDGET, self.error_budget + (now - self.error_time) * ERROR_REFILL) - 1
+        self.error_time = now
+        return self.error_budget < 0
+
+    def reject(self, action, error):
+        logger.info("Rejected a request from %s: %s", self.addr, error)
+        if self.spend_error_budget():
+            self.kick("Too many invalid requests.")
+            return
+        seat = 0 if self.seat is None else self.seat
+        self.request = ("0" + str(seat) + "Invalid request. " + error).encode("utf-8")
+        if not self.in_game():
+            # Can't go through dispatch without a match to address it in
+            self.queue_message(self.request)
+            self.write()
+            return
+        self.send_buffer.append(self.request)
+        if action == ATTACK and self.my_turn() and not self.match.absent:
+            # Ask again, they still have to make their move
+            self.request = ("1" + str(seat) + "Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
+            self.send_buffer.append(self.request)
+
+    def kick(self, reason):
+        echo("Disconnecting", self.addr, "-", reason)
+        seat = 0 if self.seat is None else self.seat
+        self.request = ("5" + str(seat) + reason + " Disconnecting.").encode("utf-8")
+        self.stop_watching()
+        # Kicked out for good, their seat isn't held for them
+        self.resumable = False
+        if self.in_game():
+            # Ends their match like any other disconnect
+            self.send_buffer.append(self.request)
+            self.disconnected()
+            return
+        self.queue_message(self.request)
+        self.write()
+        if self.match is None:
+            self.close_when_flushed()
+        else:
+            self.lobby.end_match(self.match)
+
+    def turn_timed_out(self):
+        # They didn't make their move in time
+        if not self.in_game() or not self.my_turn():
+            return
+        p = self.match
+        target = 1 - self.seat
+        echo("Player", self.seat + 1, "in match", p.match_id, "ran out of time.")
+        if self.lobby.on_timeout == "random":
+            shot = p.boards[target].hits | p.boards[target].misses
+            self.request = ("0" + str(self.seat) + "You ran out of time, so a random tile was picked for you.").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.pass_turn(random.choice([cell for cell in range(CELL_COUNT) if not shot >> cell & 1]))
+        else:
+            self.request = ("0" + str(target) + "Player " + str(self.seat + 1) + " ran out of time.").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.request = ("0" + str(self.seat) + "You ran out of time.").encode("utf-8")
+            self.send_buffer.append(self.request)
+            self.end_game(target, self.seat)
+        self.dispatch()
+        self.lobby.run_deferred()
+
+    def watch_idle(self, delay):
+        if delay is not None:
+            self.idle_timer = self.lobby.timers.schedule(delay, self.check_idle)
+
+    def stop_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def check_idle(self):
+        # Sending anything doesn't move the timer, it is checked here once it runs out instead
+        self.idle_timer = None
+        if self.closing:
+            return
+        quiet = self.lobby.timers.now - self.last_heard
+        if quiet < self.lobby.idle_timeout:
+            self.watch_idle(self.lobby.idle_timeout - quiet)
+            return
+        self.kick("Idle for too long.")
+
+    def disconnected(self):
+        self.stop_idle_timer()
+        self.stop_watching()
+        # Client disconnected, only their own match is affected
+        if self.match is None or len(self.match.connections) < 2 or None in self.match.connections:
+            # Nobody else is seated with them, just drop the match/connection
+            if self.match is not None:
+                self.lobby.end_match(self.match)
+            else:
+                self.close()
+            return
+        p = self.match
+        if self.resumable and p.tokens[self.seat] is not None:
+            # Held even when the other player is away too, the match ends once the grace runs out
+            self.hold_seat()
+            return
+        disconnected = self.seat
+        playerNumber = 1 - disconnected
+        self.request = ("5" + str(playerNumber) + "Player " + str(disconnected + 1) + " disconnected from the game. Ending the match.").encode("utf-8")
+        self.send_buffer.append(self.request)
+        # Log and print disconnect error
+        logger.info("Player " + str(disconnected + 1) + " disconnected from match " + str(self.match.match_id) + ". Ending the match.")
+        echo("Player " + str(disconnected + 1) + " disconnected from match " + str(self.match.match_id) + ". Ending the match.")
+        self.dispatch()
+
+    def hold_seat(self):
+        # Keep the match going for resume_grace seconds, the game waits until they come back with their token
+        p = self.match
+        seat = self.seat
+        p.absent.add(seat)
+        self.lobby.seats.pop(self, None)
+        self.close()
+        # Replaces the turn timer, the clock starts again when they're back
+        self.lobby.set_timer(p, self.lobby.resume_grace, self.lobby.resume_timed_out, p, seat)
+        self.request = ("0" + str(1 - seat) + "Player " + str(seat + 1) + " lost their connection. Waiting for them to come back...").encode("utf-8")
+        self.send_buffer.append(self.request)
+        logger.info("Player %s lost their connection to match %s. Holding their seat for %s seconds.", seat + 1, p.match_id, self.lobby.resume_grace)
+        echo("Player", seat + 1, "lost their connection to match", p.match_id, "- holding their seat.")
+        self.dispatch()
+
+    # Hands every message made while handling the last read to the connection it is addressed to
+    def dispatch(self):
+        endMatch = False
+        receivers = []
+        p = self.match
+        for req in self.send_buffer:
+            # Get the player that the request is being sent to
+            seat = req[1] - 48
+            connection = p.connections[seat]
+            if p.tokens[seat] is not None and req[:1] != b"8":
+                # Numbered from the token on, and kept in case they have to resume
+                p.sent[seat] += 1
+                p.replay[seat].append(req)
+
+            # See if the server sent a game end or match close message, even to a player who is away
+            if req[:1] == b"4" or req[:1] == b"5":
+                endMatch = True
+
+            if seat in p.absent:
+                continue
+            log_sent(req, connection.addr)
+            connection.queue_message(req)
+            if connection not in receivers:
+                receivers.append(connection)
+
+        # Clear after all requests have been queued
+        self.send_buffer.clear()
+
+        # Try to send right away, a connection only waits for the socket if it is full
+        for connection in receivers:
+            connection.write()
+        if self.match is not None:
+            self.match.flush_spectators()
+
+        # If the match is over, tear down only this match and leave the rest running
+        if endMatch:
+            echo("Match", self.match.match_id, "over, closing its connections.")
+            self.lobby.end_match(self.match)
+
+class ComputerPlayer(PlayerSession):
+    # The computer's seat in a single player match. It reads the same messages a client would (it asks for delta
+    # updates, so every shot comes back as one "6" message) and answers attack requests with ai.Targeting.
+    def __init__(self, lobby, difficulty):
+        super().__init__(lobby, "computer")
+        self.difficulty = difficulty if difficulty in ai.DIFFICULTIES else "medium"
+        self.targeting = ai.Targeting(self.difficulty)
+        self.board = random_board()
+        self.delta_updates = True
+        # Nothing to reconnect
+        self.resumable = False
+
+    def watch_idle(self, delay):
+        # The computer is never idle
+        pass
+
+    def queue_message(self, req):
+        action = req[:1]
+        if action == b"1":
+            # Our move, made once the engine is done with the message that asked for it
+            self.lobby.call_soon(self.take_turn)
+        elif action == b"6":
+            seq, board_type, cell, mark, sunk = parse_delta(req[2:].decode("utf-8"))
+            if board_type == "3":
+                self.targeting.record(cell, mark == "x", sunk)
+
+    def take_turn(self):
+        if self.closing or self.match is None or not self.match.connections:
+            return
+        cell = self.targeting.next_cell()
+        self.message_decode(("1" + "ABCDEFGHIJ"[cell % 10] + str(cell // 10 + 1)).encode("utf-8"))
+        self.dispatch()
+
+    def write(self):
+        pass
+
+    def close(self):
+        self.closing = True
+
+    def close_when_flushed(self):
+        self.closing = True
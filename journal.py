@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Append-only match journal (python server.py -p <port> --journal <dir>).
+# Every match event is appended to the newest segment file in the journal directory, so if the server dies the
+# matches that were still being played can be rebuilt from it on the next start.
+#
+# Records are written by a background thread, the event loop only puts them on a queue. The thread writes everything
+# that piled up since its last write in one go and fsyncs once for all of it (group commit), at most once every
+# COMMIT_INTERVAL seconds.
+#
+# Record layout, all big-endian:
+# | crc32 (4 bytes) | payload length (2 bytes) | kind (1 byte) | match id (4 bytes) | seat (1 byte) | payload |
+# The crc covers everything after itself, so a record cut short by a crash is found and ignored.
+#
+# Segments are rotated once they reach SEGMENT_SIZE. Old segments are compacted by keeping only the records of matches
+# that haven't ended, which the server does on every start and can be run by hand on a live journal:
+#   python journal.py compact <dir>
+#   python journal.py dump <dir>
+
+import argparse
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("!IHBIB")
+# Start of the part of the header covered by the crc
+CRC_START = 4
+SEGMENT_SUFFIX = ".journal"
+SEGMENT_SIZE = 16 * 1024 * 1024
+COMMIT_INTERVAL = 0.005
+
+# Record kinds
+JOIN = 1 # payload is the player's board, then ":" and their resume token if they got one
+FIRST = 2 # seat goes first
+SHOT = 3 # seat shot at the other board, payload is cell, hit, sunk ship (NO_SHIP if none)
+END = 4 # match is over
+NO_SHIP = 0xFF
+
+KIND_NAMES = {JOIN: "join", FIRST: "first", SHOT: "shot", END: "end"}
+
+def encode_record(kind, match_id, seat, payload=b""):
+    body = RECORD.pack(0, len(payload), kind, match_id, seat)[CRC_START:] + payload
+    return struct.pack("!I", zlib.crc32(body)) + body
+
+def segment_paths(directory):
+    # Segment files in the order they were written
+    names = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+def segment_number(path):
+    return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+
+def segment_path(directory, number):
+    return os.path.join(directory, "%08d%s" % (number, SEGMENT_SUFFIX))
+
+def read_segment(path):
+    """Yield (kind, match_id, seat, payload, raw record) for every whole record in a segment file."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + RECORD.size <= len(data):
+                crc, length, kind, match_id, seat = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + length
+                if end > len(data) or zlib.crc32(data[offset + CRC_START:end]) != crc:
+                    # The write this record was part of never finished
+                    logger.warning("Journal segment %s is cut short at byte %s", path, offset)
+                    return
+                yield kind, match_id, seat, data[offset + RECORD.size:end], data[offset:end]
+                offset = end
+
+class JournaledMatch:
+    # What the journal knows about one match
+    def __init__(self, match_id):
+        self.match_id = match_id
+        self.boards = [None, None]
+        # Resume tokens, None for a seat that didn't get one (or was journaled before tokens were)
+        self.tokens = [None, None]
+        self.first = None
+        # (seat, cell) of every shot, in order
+        self.shots = []
+        self.ended = False
+        self.records = []
+
+    def in_progress(self):
+        return not self.ended and self.first is not None and None not in self.boards
+
+def scan(paths, keep_records=False):
+    """Read segments in order and return {match_id: JournaledMatch}."""
+    matches = {}
+    for path in paths:
+        for kind, match_id, seat, payload, raw in read_segment(path):
+            match = matches.get(match_id)
+            if match is None:
+                match = matches[match_id] = JournaledMatch(match_id)
+            if keep_records:
+                match.records.append(raw)
+            if kind == JOIN and seat < 2:
+                board, _, token = bytes(payload).decode("utf-8").partition(":")
+                match.boards[seat] = board
+                match.tokens[seat] = token or None
+            elif kind == FIRST:
+                match.first = seat
+            elif kind == SHOT:
+                match.shots.append((seat, payload[0]))
+            elif kind == END:
+                match.ended = True
+    return matches
+
+def recover(directory):
+    """Matches that were still being played when the journal was last written, oldest first."""
+    matches = scan(segment_paths(directory))
+    return [match for match in matches.values() if match.in_progress()]
+
+def compact(directory, keep_newest=1):
+    """Replace every segment but the newest keep_newest with one holding only the matches that haven't ended. With
+    keep_newest=0 (nothing is writing to the journal) only the matches that can still be restored are kept."""
+    paths = segment_paths(directory)
+    if keep_newest:
+        paths = paths[:-keep_newest]
+    if not paths:
+        return 0
+    matches = scan(paths, keep_records=True)
+    replaced = len(paths)
+    # The compacted segment takes the number of the last one it replaces, so it still sorts before newer segments
+    target = paths[-1]
+    temporary = target + ".tmp"
+    kept = 0
+    with open(temporary, "wb") as f:
+        for match in matches.values():
+            # A live journal may still get the rest of a match that hasn't started, a stopped one never will
+            if match.in_progress() if not keep_newest else not match.ended:
+                f.write(b"".join(match.records))
+                kept += 1
+        f.flush()
+        os.fsync(f.fileno())
+    if kept:
+        os.replace(temporary, target)
+        paths.pop()
+    else:
+        os.remove(temporary)
+    for path in paths:
+        os.remove(path)
+    logger.info("Compacted %s journal segments into %s, kept %s of %s matches", replaced, target, kept, len(matches))
+    return kept
+
+class Journal:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, commit_interval=COMMIT_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.records = queue.SimpleQueue()
+        paths = segment_paths(directory)
+        self.next_segment = segment_number(paths[-1]) + 1 if paths else 1
+        self.file = None
+        self.open_segment()
+        self.thread = threading.Thread(target=self.write_records, name="journal", daemon=True)
+        self.thread.start()
+
+    def open_segment(self):
+        # Every server run starts its own segment, so a cut short record is always at the end of an old one
+        path = segment_path(self.directory, self.next_segment)
+        self.next_segment += 1
+        self.file = open(path, "ab")
+        logger.info("Writing match journal to %s", path)
+
+    def append(self, kind, match_id, seat, payload=b""):
+        # Called from the event loop, never waits on the disk
+        self.records.put(encode_record(kind, match_id, seat, payload))
+
+    def join(self, match_id, seat, board, token=None):
+        if token is not None:
+            board += ":" + token
+        self.append(JOIN, match_id, seat, board.encode("utf-8"))
+
+    def first(self, match_id, seat):
+        self.append(FIRST, match_id, seat)
+
+    def shot(self, match_id, seat, cell, hit, sunk):
+        self.append(SHOT, match_id, seat, bytes((cell, hit, NO_SHIP if sunk is None else sunk)))
+
+    def end(self, match_id):
+        self.append(END, match_id, 0)
+
+    def write_records(self):
+        stopping = False
+        while not stopping:
+            started = time.monotonic()
+            batch = [self.records.get()]
+            # Take everything else that came in meanwhile, it all shares one fsync
+            while True:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                stopping = True
+            self.file.write(b"".join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.file.tell() >= self.segment_size:
+                self.file.close()
+                self.open_segment()
+            # Let the next batch build up instead of paying for an fsync per record
+            wait = self.commit_interval - (time.monotonic() - started)
+            if wait > 0 and not stopping:
+                time.sleep(wait)
+        self.file.close()
+
+    def close(self):
+        """Write out and fsync everything still queued."""
+        self.records.put(None)
+        self.thread.join()
+
+def open_journal(directory):
+    """Recover the matches left in a journal directory, compact it, and start a new segment. Returns (journal, matches)."""
+    os.makedirs(directory, exist_ok=True)
+    matches = recover(directory)
+    compact(directory, keep_newest=0)
+    return Journal(directory), matches
+
+def dump(directory):
+    for path in segment_paths(directory):
+        print(path)
+        for kind, match_id, seat, payload, raw in read_segment(path):
+            if kind == SHOT:
+                payload = "cell %s hit %s sunk %s" % (payload[0], payload[1], payload[2] if payload[2] != NO_SHIP else "-")
+            else:
+                payload = bytes(payload).decode("utf-8")
+            print("  match", match_id, KIND_NAMES.get(kind, kind), "seat", seat, payload)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact or print a server match journal')
+    parser.add_argument('command', choices=['compact', 'dump'])
+    parser.add_argument('directory', help='Journal directory given to server.py --journal')
+    parser.add_argument('--all', action='store_true', help="Compact the newest segment too, only when the server isn't running")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'compact':
+        compact(args.directory, keep_newest=0 if args.all else 1)
+    else:
+        dump(args.directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Logging setup shared by the server and the client.
+# Log records are put on a bounded queue and formatted and written to the log file by a background thread
+# (QueueHandler/QueueListener), so a slow disk never blocks the event loop. If the queue is full the record is
+# dropped and counted instead of waiting for room.
+#
+# Every message in and out is logged on the "traffic" logger, so its level can be set on its own
+# (ex. --log-level traffic=WARNING) and it can be sampled (--traffic-sample 100 logs 1 in 100 messages).
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s: %(message)s'
+LOG_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+QUEUE_SIZE = 10000
+
+traffic_logger = logging.getLogger("traffic")
+
+# Set by --quiet, skips everything the server would print to stdout
+quiet = False
+# Log one in this many traffic messages
+traffic_sample = 1
+traffic_count = 0
+
+handler = None
+listener = None
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never waits on a full queue, counts the record as dropped instead
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        # Leave formatting to the listener thread. Callers pass immutable arguments (bytes, str, tuples),
+        # so the record can be formatted later without changing.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+            return
+        if self.unreported:
+            # There is room again, say how much was lost
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": "log_pipeline", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "Dropped %s log records because the log queue was full (%s in total)",
+                    "args": (self.unreported, self.dropped),
+                }))
+                self.unreported = 0
+            except queue.Full:
+                pass
+
+class LogWriter(logging.handlers.QueueListener):
+    # The background thread writing the queued records to the log file
+    def enqueue_sentinel(self):
+        # Wait for room when stopping, the thread is still emptying the queue
+        self.queue.put(self._sentinel)
+
+def parse_level(value):
+    # "DEBUG", "info", or "traffic=WARNING" -> (logger name or None for the root logger, level number)
+    name, _, level = value.rpartition("=")
+    level = logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level in {repr(value)}.")
+    return name or None, level
+
+def setup_logging(filename, levels=(), sample=1, queue_size=QUEUE_SIZE, be_quiet=False):
+    """Log to filename from a background thread. levels holds "LEVEL" or "logger=LEVEL" strings."""
+    global handler, listener, quiet, traffic_sample
+    quiet = be_quiet
+    traffic_sample = max(1, sample)
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = LogWriter(handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(handler)
+    for value in levels:
+        name, level = parse_level(value)
+        logging.getLogger(name).setLevel(level)
+
+def after_fork():
+    # The listener thread doesn't survive fork(), so a child process needs its own queue and thread
+    global listener
+    if handler is None:
+        return
+    handler.queue = queue.Queue(handler.queue.maxsize)
+    listener = LogWriter(handler.queue, *listener.handlers, respect_handler_level=True)
+    listener.start()
+
+def stop_logging():
+    # Write out whatever is still queued
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+def echo(*args):
+    if not quiet:
+        print(*args)
+
+def log_received(data, addr):
+    global traffic_count
+    traffic_count += 1
+    if not quiet:
+        print("received ", repr(bytes(data)), "from", addr)
+    if traffic_count % traffic_sample == 0 and traffic_logger.isEnabledFor(logging.INFO):
+        traffic_logger.info("received %r from %s", bytes(data), addr)
+
+def log_sent(req, addr):
+    global traffic_count
+    traffic_count += 1
+    if not quiet:
+        print("sending  ", repr(req), "to", addr)
+    if traffic_count % traffic_sample == 0 and traffic_logger.isEnabledFor(logging.INFO):
+        traffic_logger.info("Sent %r to %s", req, addr)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Counters and latency histograms for the server, served in the Prometheus text format with --metrics-port.
+# Recording is a list or integer increment, or Histogram.record() for a duration in nanoseconds (perf_counter_ns), so
+# it is cheap enough to leave on all the time. Gauges (matches, connections, queues) are only computed when scraped.
+#
+#   curl http://127.0.0.1:<metrics port>/metrics
+#
+# The port speaks just enough HTTP for Prometheus and curl. Anything that isn't an HTTP request gets the plain text.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Messages and bytes, by action type (the message's first byte)
+messages_in = [0] * 256
+messages_out = [0] * 256
+bytes_in = 0
+bytes_out = 0
+
+# Sub-buckets per power of two, 16 keeps every bucket within about 6% of the values in it
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+# Quantiles exported next to every histogram
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+class Histogram:
+    # HDR style: values below SUB_BUCKETS get a bucket each, and every power of two above that is split into
+    # SUB_BUCKETS equal buckets. Exported as a Prometheus histogram with power of two bucket bounds, which line up
+    # with the fine buckets, plus the quantiles worked out from the fine buckets.
+    def __init__(self, name, help_text, scale=1e-9, max_bits=40):
+        self.name = name
+        self.help_text = help_text
+        # Multiplies the recorded values when they are exported, 1e-9 for nanoseconds to seconds
+        self.scale = scale
+        self.counts = [0] * ((max_bits + 1) * SUB_BUCKETS)
+        self.last = len(self.counts) - 1
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value < SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BITS - 1
+            index = ((shift + 1) << SUB_BITS) + (value >> shift) - SUB_BUCKETS
+        self.counts[index if index < self.last else self.last] += 1
+
+    def bucket_top(self, index):
+        # Largest value that lands in the bucket
+        if index < SUB_BUCKETS:
+            return index
+        shift = (index >> SUB_BITS) - 1
+        return ((SUB_BUCKETS + (index & (SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+    def quantile(self, fraction):
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bucket_top(index)
+        return self.bucket_top(self.last)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} histogram")
+        seen = 0
+        # Every SUB_BUCKETS fine buckets from SUB_BUCKETS on cover one power of two
+        for index, count in enumerate(self.counts):
+            seen += count
+            if index + 1 >= SUB_BUCKETS and (index + 1) % SUB_BUCKETS == 0 and index < self.last:
+                lines.append(f'{self.name}_bucket{{le="{(self.bucket_top(index) + 1) * self.scale:g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.total * self.scale:g}")
+        lines.append(f"{self.name}_count {self.count}")
+        lines.append(f"# HELP {self.name}_quantile {self.help_text}, quantiles since the server started")
+        lines.append(f"# TYPE {self.name}_quantile gauge")
+        for fraction in QUANTILES:
+            lines.append(f'{self.name}_quantile{{quantile="{fraction}"}} {self.quantile(fraction) * self.scale:g}')
+
+shot_seconds = Histogram("battleship_shot_seconds", "Time to handle one shot in pass_turn")
+loop_busy_seconds = Histogram("battleship_loop_busy_seconds", "Time spent handling the events of one select() call")
+loop_events = Histogram("battleship_loop_events", "Events returned by one select() call", scale=1, max_bits=20)
+loop_lag_seconds = Histogram("battleship_loop_lag_seconds", "How late the event loop ran a timer")
+HISTOGRAMS = [shot_seconds, loop_busy_seconds, loop_events, loop_lag_seconds]
+
+# name -> (help, function returning the current value), see add_gauge
+gauges = {}
+
+def add_gauge(name, help_text, function):
+    gauges[name] = (help_text, function)
+
+def render():
+    """Everything in the Prometheus text exposition format."""
+    lines = []
+    for name, counts, help_text in (("battleship_messages_received_total", messages_in, "Messages received, by action type"),
+                                    ("battleship_messages_sent_total", messages_out, "Messages sent, by action type")):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for action, count in enumerate(counts):
+            if count:
+                label = chr(action) if 32 < action < 127 and action not in (34, 92) else f"0x{action:02x}"
+                lines.append(f'{name}{{type="{label}"}} {count}')
+    for name, value, help_text in (("battleship_bytes_received_total", bytes_in, "Message bytes received"),
+                                   ("battleship_bytes_sent_total", bytes_out, "Message bytes sent")):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    for histogram in HISTOGRAMS:
+        if histogram.count:
+            histogram.render(lines)
+    for name, (help_text, function) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {function()}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def response(request):
+    """The reply to whatever a scraper sent: an HTTP response for an HTTP request, the bare text otherwise."""
+    body = render()
+    if not request.startswith(b"GET ") and not request.startswith(b"HEAD "):
+        return body
+    if not request.split(b" ", 2)[1].startswith(b"/metrics") and request.split(b" ", 2)[1] != b"/":
+        return b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+    header = ("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body)).encode("utf-8")
+    return header + (body if request.startswith(b"GET ") else b"")
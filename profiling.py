@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Profiling a running server (python server.py -p <port> --profile-dir <dir>), switched on and off with signals:
+#   kill -USR1 <pid>   start the CPU profiler, send it again to stop it and write the results
+#   kill -USR2 <pid>   start tracing memory allocations, send it again to write the biggest changes since then
+# With --workers, signal the parent process to profile every worker, or a worker's pid for just that one.
+#
+# The CPU profiler is cProfile, or with --profiler sample a thread that looks at what the event loop is running every
+# few milliseconds, which costs much less and writes stacks in the folded format flame graph tools read. While it runs
+# the message handlers are timed too. Nothing is hooked into the server until a signal comes in, so leaving
+# --profile-dir on costs nothing.
+#
+# The work is done from the event loop, not the signal handler: a signal can land while the main thread holds a lock
+# (the log queue's, for one), and taking it again from the handler would hang the server.
+
+import cProfile
+import collections
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import metrics
+from log_pipeline import echo
+
+logger = logging.getLogger(__name__)
+
+# Handlers timed while the CPU profiler runs, the ones a connection class doesn't have are skipped
+HANDLERS = ("join_game", "pass_turn", "play_again", "write")
+SAMPLE_INTERVAL = 0.005
+# Frames deeper than this are left off a sampled stack
+MAX_STACK_DEPTH = 64
+# Allocation sites listed in a memory report
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 10
+
+directory = None
+profiler_type = "cprofile"
+connection_class = None
+profiler = None
+handler_timings = {}
+# name -> what the connection class had for it before it was wrapped (None if it was inherited)
+wrapped = {}
+memory_baseline = None
+
+def install(profile_dir, profiler="cprofile", connections=None):
+    """Get ready to profile on SIGUSR1 and SIGUSR2, connections is the engine's connection class whose handlers get timed."""
+    global directory, profiler_type, connection_class
+    os.makedirs(profile_dir, exist_ok=True)
+    directory = profile_dir
+    profiler_type = profiler
+    connection_class = connections
+    # Ignored until the event loop starts listening for them, see SignalListener and server_asyncio.serve
+    for signum in SIGNALS:
+        signal.signal(signum, ignore_signal)
+
+def ignore_signal(signum, frame):
+    pass
+
+class SignalListener:
+    # Lets the selectors loop handle the signals: Python writes the number of every signal that comes in to a socket
+    # (signal.set_wakeup_fd), which wakes up select() and is read here
+    def __init__(self):
+        self.sock, self.wakeup = socket.socketpair()
+        self.sock.setblocking(False)
+        self.wakeup.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup.fileno())
+
+    def process(self, mask):
+        try:
+            data = self.sock.recv(64)
+        except BlockingIOError:
+            return
+        for signum in data:
+            # Other signals (SIGINT, SIGTERM) end up here too and are handled by their own handlers
+            if signum in SIGNALS:
+                SIGNALS[signum]()
+
+def report_path(kind, extension):
+    return os.path.join(directory, "%s-%d-%s.%s" % (kind, os.getpid(), time.strftime("%Y%m%d-%H%M%S"), extension))
+
+# ---------------- CPU ----------------
+
+class Sampler:
+    # Wakes up every interval and counts the stack the main thread is in, for a fraction of cProfile's overhead
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def enable(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="profiling-sampler", daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump_stats(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+def toggle_cpu_profile():
+    global profiler
+    if profiler is None:
+        profiler = Sampler() if profiler_type == "sample" else cProfile.Profile()
+        time_handlers()
+        profiler.enable()
+        echo("started the %s profiler" % profiler_type)
+        logger.info("Started the %s profiler", profiler_type)
+        return
+    profiler.disable()
+    untime_handlers()
+    path = report_path("cpu", "folded" if profiler_type == "sample" else "prof")
+    profiler.dump_stats(path)
+    profiler = None
+    handlers_path = report_path("handlers", "txt")
+    write_handler_timings(handlers_path)
+    echo("wrote", path, "and", handlers_path)
+    logger.info("Wrote CPU profile %s and handler timings %s", path, handlers_path)
+
+def time_handlers():
+    handler_timings.clear()
+    if connection_class is None:
+        return
+    for name in HANDLERS:
+        handler = getattr(connection_class, name, None)
+        if handler is None:
+            continue
+        wrapped[name] = connection_class.__dict__.get(name)
+        timing = handler_timings[name] = metrics.Histogram(name, name)
+        setattr(connection_class, name, timed(handler, timing))
+
+def timed(handler, timing):
+    def timed_handler(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            timing.record(time.perf_counter_ns() - start)
+    return timed_handler
+
+def untime_handlers():
+    for name, handler in wrapped.items():
+        if handler is None:
+            delattr(connection_class, name)
+        else:
+            setattr(connection_class, name, handler)
+    wrapped.clear()
+
+def write_handler_timings(path):
+    with open(path, "w") as f:
+        f.write("%-12s %10s %12s %10s %10s %10s %10s\n" % ("handler", "calls", "total ms", "mean us", "p50 us", "p99 us", "p999 us"))
+        for name, timing in handler_timings.items():
+            mean = timing.total / timing.count / 1000 if timing.count else 0
+            f.write("%-12s %10d %12.3f %10.1f %10.1f %10.1f %10.1f\n" % (
+                name, timing.count, timing.total / 1e6, mean, timing.quantile(0.5) / 1000,
+                timing.quantile(0.99) / 1000, timing.quantile(0.999) / 1000))
+
+# ---------------- Memory ----------------
+
+def toggle_memory_trace():
+    global memory_baseline
+    if memory_baseline is None:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        memory_baseline = tracemalloc.take_snapshot()
+        echo("started tracing memory allocations")
+        logger.info("Started tracing memory allocations")
+        return
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Leave out tracemalloc's own bookkeeping
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    changes = snapshot.filter_traces(ignore).compare_to(memory_baseline.filter_traces(ignore), "traceback")
+    memory_baseline = None
+    path = report_path("memory", "txt")
+    with open(path, "w") as f:
+        total = sum(change.size_diff for change in changes)
+        f.write("%+.1f KiB allocated and still held since tracing started, biggest changes first\n" % (total / 1024))
+        for change in changes[:TOP_ALLOCATIONS]:
+            f.write("\n%+.1f KiB in %+d blocks (%.1f KiB in %d blocks now)\n" % (
+                change.size_diff / 1024, change.count_diff, change.size / 1024, change.count))
+            for line in change.traceback.format(most_recent_first=True):
+                f.write(line + "\n")
+    echo("wrote", path)
+    logger.info("Wrote memory allocation report %s", path)
+
+SIGNALS = {signal.SIGUSR1: toggle_cpu_profile, signal.SIGUSR2: toggle_memory_trace}
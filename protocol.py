@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Shared message framing and message helpers for the server and the client.
+# Every message on the wire is a 2 byte big-endian length followed by that many bytes of payload:
+# | length (2 bytes) | action type | player number (server only) | data |
+
+import struct
+
+from board import BOARD_SIZE, EMPTY_BOARD
+
+HEADER = struct.Struct("!H")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 0xFFFF
+RECV_SIZE = 4096
+
+def encode_frame(payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame payload of {len(payload)} bytes is larger than {MAX_FRAME_SIZE}.")
+    return HEADER.pack(len(payload)) + payload
+
+class FrameDecoder:
+    # Incremental decoder over one reusable receive buffer. Reads go straight into the
+    # buffer with recv_into, and complete frames are handed out as memoryview slices of it,
+    # so nothing is copied until the caller decodes the payload. A frame split across reads
+    # waits in the buffer for the rest, and several frames coalesced into one read all come out.
+    def __init__(self, size=RECV_SIZE * 2):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not yet handed out as a frame
+        self.end = 0 # first free byte
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        """Read from sock into the buffer, returns the number of bytes read (0 means the peer closed)."""
+        self.make_room(size)
+        count = sock.recv_into(self.view[self.end:self.end + size])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """Append bytes that were already read by someone else (ex. an asyncio transport)."""
+        self.make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def make_room(self, size):
+        # Frames handed out earlier are only valid until the next read, so unread bytes can be moved freely
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            # Not enough room even after compacting, grow into a new buffer
+            new_size = len(self.buffer)
+            while pending + size > new_size:
+                new_size *= 2
+            buffer = bytearray(new_size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def frames(self):
+        """Yield every complete frame in the buffer as a memoryview, valid until the next read."""
+        while self.end - self.start >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(self.buffer, self.start)
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                # Only part of this frame has arrived so far
+                break
+            frame = self.view[self.start + HEADER_SIZE:frame_end]
+            self.start = frame_end
+            yield frame
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+
+# ---------------- Board delta updates ----------------
+# Clients that add ";delta" after the board in their join message get board changes as small
+# delta messages instead of a full board after every shot:
+#   "6" + player + seq + ":" + board type ("2" ship board, "3" attack board) + cell (2 digits) + mark + sunk ship ("0" for none)
+# and a full snapshot of both boards when the game starts or when they ask for a resync:
+#   "7" + player + seq + ":" + ship board + attack board
+# seq counts the board updates sent to that player, so a client can tell when it missed one.
+
+DELTA_FEATURE = "delta"
+# Play the computer instead of waiting for another player (see ComputerPlayer in game.py)
+COMPUTER_FEATURE = "ai"
+
+# ---------------- Spectators ----------------
+# A client that sends "9" + match number (or just "9" for the newest match) instead of joining watches that match.
+# It gets a snapshot of both players' waters, hits and misses but never ships:
+#   "7" + "0" + seq + ":" + Player 1's waters + Player 2's waters
+# then a delta for every shot, where player is the seat that fired, at the other player's waters:
+#   "6" + player + seq + ":3" + cell (2 digits) + mark + sunk ship
+# and "0" info messages, "4" when someone wins and "5" if the match is called off. It can send "3" for a new snapshot.
+
+# ---------------- Resuming a game ----------------
+# When a server holds seats for players who drop (--resume-grace), the first message of every game is
+#   "8" + player + resume token (32 hex digits)
+# and the client counts every message it gets after it. If its connection drops, it connects again and sends
+#   "5" + token + ":" + count
+# instead of joining, and gets the messages it missed. When the server no longer has all of them, it sends the token
+# message again (start counting over) followed by both boards and whose move it is.
+
+def parse_join(data):
+    """Split join data into the board and the set of features the client asked for."""
+    board, _, features = data.partition(";")
+    return board, set(features.split(",")) if features else set()
+
+def computer_difficulty(features):
+    """The difficulty asked for with the "ai" join feature ("ai" or "ai=hard"), or None to play another person."""
+    for feature in features:
+        name, _, level = feature.partition("=")
+        if name == COMPUTER_FEATURE:
+            return level or "medium"
+    return None
+
+def delta_message(player, seq, board_type, cell, hit, sunk):
+    sunk_ship = 0 if sunk is None else sunk + 1
+    return ("6%d%d:%s%02d%s%d" % (player, seq, board_type, cell, "x" if hit else "o", sunk_ship)).encode("utf-8")
+
+def snapshot_message(player, seq, ship_text, attack_text):
+    return ("7%d%d:" % (player, seq)).encode("utf-8") + ship_text + attack_text
+
+def parse_delta(info):
+    """Parse the data of a "6" message, returns (seq, board type, cell, mark, sunk ship index or None)."""
+    seq, _, delta = info.partition(":")
+    sunk_ship = int(delta[4])
+    return int(seq), delta[0], int(delta[1:3]), delta[3], (sunk_ship - 1 if sunk_ship else None)
+
+def parse_snapshot(info):
+    """Parse the data of a "7" message, returns (seq, ship board, attack board)."""
+    seq, _, boards = info.partition(":")
+    half = len(boards) // 2
+    return int(seq), boards[:half], boards[half:]
+
+# ---------------- Client requests ----------------
+# Every request from a client is checked against REQUESTS before the game code sees it, so a bad one comes back as an
+# error string instead of raising somewhere in the middle of a turn.
+JOIN = ord("0")
+ATTACK = ord("1")
+PLAY_AGAIN = ord("2")
+RESYNC = ord("3")
+RESUME = ord("5")
+SPECTATE = ord("9")
+# Longest ";features" part of a join, ex. ";delta,ai=medium"
+MAX_FEATURES_SIZE = 64
+TOKEN_SIZE = 32
+# "A1" -> 0 ... "J10" -> 99, the letter can be lowercase
+ATTACK_CELLS = {(letter + str(row + 1)).encode("utf-8"): row * BOARD_SIZE + column
+                for row in range(BOARD_SIZE) for column, letters in enumerate(zip("ABCDEFGHIJ", "abcdefghij")) for letter in letters}
+
+def parse_join_payload(payload):
+    if not payload.isascii():
+        return None, "The board has to be plain text."
+    return payload.decode("ascii"), None
+
+def parse_attack_payload(payload):
+    cell = ATTACK_CELLS.get(payload)
+    if cell is None:
+        return None, "Pick a tile from A1 to J10."
+    return cell, None
+
+def parse_play_again_payload(payload):
+    # Nothing to play with the same fleet as last time, or a board (and features) like a join
+    if not payload:
+        return None, None
+    return parse_join_payload(payload)
+
+def parse_resync_payload(payload):
+    return None, None
+
+def parse_spectate_payload(payload):
+    if not payload:
+        return None, None
+    if not payload.isdigit():
+        return None, "Give the number of the match to watch."
+    return int(payload), None
+
+def parse_resume_payload(payload):
+    token, _, seen = payload.partition(b":")
+    if len(token) != TOKEN_SIZE or not token.isascii() or not seen.isdigit():
+        return None, "Send a resume token and a message count."
+    return (token.decode("ascii"), int(seen)), None
+
+# action -> (shortest payload, longest payload, payload parser returning (value, error))
+REQUESTS = {
+    JOIN: (len(EMPTY_BOARD), len(EMPTY_BOARD) + MAX_FEATURES_SIZE, parse_join_payload),
+    ATTACK: (2, 3, parse_attack_payload),
+    PLAY_AGAIN: (0, len(EMPTY_BOARD) + MAX_FEATURES_SIZE, parse_play_again_payload),
+    RESYNC: (0, 0, parse_resync_payload),
+    SPECTATE: (0, 9, parse_spectate_payload),
+    RESUME: (TOKEN_SIZE + 2, TOKEN_SIZE + 10, parse_resume_payload),
+}
+
+def parse_request(data):
+    """Check a client request, returns (action, value, error). value is the join data as text for a join (and
+    a play again, None to keep the last fleet), the cell for an attack and the match number (or None) for a spectator, (token, count) for a resume, error is None for a good request and says what's wrong otherwise."""
+    if not data:
+        return None, None, "Empty message."
+    action = data[0]
+    rule = REQUESTS.get(action)
+    if rule is None:
+        return action, None, "Unknown action."
+    shortest, longest, parse_payload = rule
+    if not shortest <= len(data) - 1 <= longest:
+        return action, None, "Wrong message length."
+    value, error = parse_payload(bytes(data[1:]))
+    return action, value, error
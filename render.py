@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Terminal rendering of boards for the client.
+# Every frame is built in one string and written with one write() call, instead of a print() per cell.
+#
+# Renderer has two modes:
+#   plain  prints the boards that changed since the last frame, side by side when there is more than one
+#   ansi   keeps the boards side by side at the top of the terminal and only redraws the cells that changed, while
+#          messages and prompts scroll underneath them (a scroll region)
+
+import atexit
+import shutil
+import sys
+
+from board import BOARD_SIZE, EMPTY_BOARD
+
+HEADER = "   " + "".join(letter + " " for letter in "ABCDEFGHIJ")
+ROW_LABELS = ["%-3d" % (row + 1) for row in range(BOARD_SIZE)]
+# Width of a board on screen, and the space between boards side by side
+BOARD_WIDTH = len(HEADER)
+GAP = 4
+# Title, column labels and one line per row
+FRAME_LINES = 2 + BOARD_SIZE
+# Row length in the board string, the "/" included
+ROW_STRIDE = BOARD_SIZE + 1
+# The ansi mode needs room for the boards and a few lines of messages under them
+MIN_ANSI_LINES = FRAME_LINES + 4
+
+def board_lines(board):
+    return [HEADER] + [ROW_LABELS[row] + " ".join(cells) + " " for row, cells in enumerate(board.split("/"))]
+
+def format_board(board):
+    """The board with its row and column labels, as one string."""
+    return "\n".join(board_lines(board)) + "\n"
+
+def print_board(board):
+    sys.stdout.write(format_board(board))
+
+def layout(boards):
+    # Column each board starts at, wide enough for the board and its title
+    columns = []
+    column = 0
+    for title, board in boards:
+        columns.append(column)
+        column += max(BOARD_WIDTH, len(title)) + GAP
+    return columns
+
+def format_boards(boards):
+    """(title, board) pairs side by side, as one string."""
+    columns = layout(boards)
+    lines = [[] for _ in range(FRAME_LINES)]
+    for (title, board), column in zip(boards, columns):
+        for line, text in zip(lines, [title] + board_lines(board)):
+            # Pad whatever is on the line so far out to where this board starts
+            line.append(" " * (column - sum(len(part) for part in line)) + text)
+    return "".join("".join(line).rstrip() + "\n" for line in lines)
+
+class Renderer:
+    def __init__(self, ansi=False):
+        self.ansi = ansi
+        # The (title, board) pairs drawn last
+        self.last = None
+        # Terminal lines, for the scroll region in ansi mode
+        self.height = None
+
+    def draw(self, boards):
+        """Draw (title, board) pairs, board is the board string or None for one that is still empty."""
+        boards = [(title, EMPTY_BOARD if board is None else board) for title, board in boards]
+        if self.ansi:
+            frame = self.ansi_frame(boards)
+        else:
+            frame = self.plain_frame(boards)
+        self.last = boards
+        if frame:
+            sys.stdout.write(frame)
+            sys.stdout.flush()
+
+    def plain_frame(self, boards):
+        if self.last is not None and len(self.last) == len(boards):
+            boards = [board for board, last in zip(boards, self.last) if board != last]
+        return format_boards(boards) if boards else ""
+
+    def ansi_frame(self, boards):
+        if self.last is None or [title for title, board in self.last] != [title for title, board in boards]:
+            return self.full_frame(boards)
+        parts = []
+        for (title, board), (_, last), column in zip(boards, self.last, layout(boards)):
+            for index, (old, new) in enumerate(zip(last, board)):
+                if old != new:
+                    row, cell = divmod(index, ROW_STRIDE)
+                    # Below the title and column labels, and past the row label and the spaces between cells
+                    parts.append("\x1b[%d;%dH%s" % (row + 3, column + 4 + cell * 2, new))
+        if not parts:
+            return ""
+        # Put the cursor back wherever the messages underneath left it
+        return "\x1b7" + "".join(parts) + "\x1b8"
+
+    def full_frame(self, boards):
+        self.height = shutil.get_terminal_size().lines
+        if self.height < MIN_ANSI_LINES:
+            # Too small to keep the boards on screen, print them like the plain mode does
+            self.ansi = False
+            return format_boards(boards)
+        if self.last is None:
+            atexit.register(self.close)
+        lines = format_boards(boards).splitlines()
+        # Messages scroll in the lines under the boards, the boards stay put
+        parts = ["\x1b[%d;%dr" % (FRAME_LINES + 2, self.height)]
+        for row, line in enumerate(lines + [""]):
+            parts.append("\x1b[%d;1H%s\x1b[K" % (row + 1, line))
+        parts.append("\x1b[%d;1H" % self.height)
+        return "".join(parts)
+
+    def close(self):
+        # Give the whole terminal back
+        if self.ansi and self.height is not None:
+            sys.stdout.write("\x1b[r\x1b[%d;1H\n" % self.height)
+            sys.stdout.flush()
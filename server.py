@@ -1,64 +1,47 @@
 #!/usr/bin/env python3
 
 import sys
+import errno
 import socket
 import selectors
 import traceback
 import logging
-import random
 import argparse
-
-class ServerData:
-    # players holds 3 things in the list
-    # Ship positions board holds your ships positions, and your enemies hits and misses
-    # | ship positions board | board containing hits and misses | socket |
-    players = []
-
-    # "Carrier", "Battleship", "Cruiser", "Submarine", "Destroyer" sunk flags in that order for each player.
-    ship_sunk_flags = [[False, False, False, False, False],[False, False, False, False, False]]
-    first = 0
-    second = 1
-    first_wants_to_play_again = False
-    second_wants_to_play_again = False
-    reset_game = False
-
-    def reset_game_data(self):
-        self.players = []
-        self.ship_sunk_flags = [[False, False, False, False, False],[False, False, False, False, False]]
-        self.first = 0
-        self.second = 1
-        self.first_wants_to_play_again = False
-        self.second_wants_to_play_again = False
-        self.reset_game = False
-
-class ClientConnection:
+import signal
+import time
+from collections import deque
+from itertools import islice
+
+import metrics
+import profiling
+import upgrade
+import workers
+from game import Lobby, PlayerSession
+from journal import open_journal
+from log_pipeline import echo, setup_logging
+from protocol import FrameDecoder, encode_frame
+
+class ClientConnection(PlayerSession):
+    # Selectors engine: one non-blocking socket driven by the main select() loop below
     def __init__(self, sel, sock, addr):
+        super().__init__(lobby, addr)
         self.sel = sel
         self.sock = sock
-        self.addr = addr
-        self.recv_buffer = b""
-        self.send_buffer = []
-        self.request = None
-        self.response_created = False
-        self.empty_board = "........../........../........../........../........../........../........../........../........../.........."
-        self.letters_to_numbers = {
-            'A': 0,
-            'B': 1,
-            'C': 2,
-            'D': 3,
-            'E': 4,
-            'F': 5,
-            'G': 6,
-            'H': 7,
-            'I': 8,
-            'J': 9
-        }
+        self.recv_buffer = FrameDecoder()
+        # Framed bytes waiting to go out on this socket, the first one may be a partially sent memoryview
+        self.out_queue = deque()
+        # Bytes in out_queue, kept up to date so checking it doesn't mean adding up the whole queue
+        self.queued = 0
+        self.events_mode = "r"
 
     def close(self):
-        print("closing connection to", self.addr)
+        if self.sock is not None:
+            # Frees its place under the connection limits
+            self.lobby.connection_closed(self.addr[0])
+        echo("closing connection to", self.addr)
         logger.info("Closed connection to %s", self.addr)
         try:
-            self.selector.unregister(self.sock)
+            self.sel.unregister(self.sock)
         except Exception as e:
             print(
                 f"error: selector.unregister() exception for",
@@ -95,232 +78,128 @@ class ClientConnection:
         else:
             raise ValueError(f"Invalid events mask mode {repr(mode)}.")
         self.sel.modify(self.sock, events, data=self)
-    
-    def join_game(self, data):
-        p.players.append([data, self.empty_board, self.sock])
-        if len(p.players) == 1:
-            self.request = ("00" + "Waiting for Player 2").encode("utf-8")
-            self.send_buffer.append(self.request) 
-        else:
-            # Send a message to each player saying the game is starting
-            self.request = ("00" + "All players are here. Game Starting...").encode("utf-8")
-            self.send_buffer.append(self.request) 
-            self.request = ("01" + "All players are here. Game Starting...").encode("utf-8")
-            self.send_buffer.append(self.request) 
-
-            # Determine which player is going first
-            if random.randint(0,1) == 0: # if 0, player 2 goes first
-                p.first = 1
-                p.second = 0
-
-            # Send an info request to starting player asking for info, and a message to the other playing saying waiting for player 1's move
-            self.request = ("0" + str(p.second) + "Player " + str(p.first + 1) + " is going first. Waiting for their move...").encode("utf-8")
-            self.send_buffer.append(self.request)
-            self.request = ("1" + str(p.first) + "You are going first! Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
-            self.send_buffer.append(self.request)
-
-    def pass_turn(self, data):
-        if(p.players[0][2] == self.sock):
-            current_player = 0
-            target = 1
-        else:
-            current_player = 1
-            target = 0
-        vertical = int(data[1:]) - 1
-        horizontal = self.letters_to_numbers[data[0].upper()]
-        index = (vertical * 11) + horizontal
-        index_value = p.players[target][0][index].lower()
-        if index_value != "." and index_value != "o":
-            #hit
-            updated_target_ship_board = p.players[target][0][:index] + "x" + p.players[target][0][index + 1:]
-            updated_current_player_attack_board = p.players[current_player][1][:index] + "x" + p.players[current_player][1][index + 1:]
-            p.players[target][0] = updated_target_ship_board
-            p.players[current_player][1] = updated_current_player_attack_board
+        self.events_mode = mode
+
+    def update_events(self):
+        # Only ask for EVENT_WRITE while there is something waiting to be sent, and skip the
+        # modify() call entirely when the mask isn't changing
+        if self.closing:
+            mode = "w"
+        elif self.out_queue:
+            mode = "rw"
         else:
-            #miss
-            updated_target_ship_board = p.players[target][0][:index] + "o" + p.players[target][0][index + 1:]
-            updated_current_player_attack_board = p.players[current_player][1][:index] + "o" + p.players[current_player][1][index + 1:]
-            p.players[target][0] = updated_target_ship_board
-            p.players[current_player][1] = updated_current_player_attack_board
-
-        # Send the player inputting the attack their updated attack board
-        self.request = ("3" + str(current_player) + p.players[current_player][1]).encode("utf-8")
-        self.send_buffer.append(self.request)
-        # Send the other player their updated ship board
-        self.request = ("2" + str(target) + p.players[target][0]).encode("utf-8")
-        self.send_buffer.append(self.request)
-
-        # CHECK GAME STATE (is the game over, has a ship been sunk, etc.)
-        end_game = self.check_game_state(current_player, target)
-        if end_game:
-            self.end_game(current_player, target)
-
-        # Request attack move from the other player
-        self.request = ("1" + str(target) + "Please enter which tile you would like to attack (Ex. A1):").encode("utf-8")
-        self.send_buffer.append(self.request)
-
-    def check_game_state(self, current_player, target):
-        # Needs to check boards to see if any ships are completely sunk, or if all ships have been sunk
-        # "Carrier", "Battleship", "Cruiser", "Submarine", "Destroyer"
-        if '1' not in p.players[target][0]:
-            if not p.ship_sunk_flags[target][0]:
-                #Carrier Sunk
-                #Telling attacker
-                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s Carrier!").encode("utf-8")
-                self.send_buffer.append(self.request)
-                #Telling target
-                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your Carrier!").encode("utf-8")
-                self.send_buffer.append(self.request)
-
-                p.ship_sunk_flags[target][0] = True
-        if '2' not in p.players[target][0]:
-            if not p.ship_sunk_flags[target][1]:
-                #Battleship Sunk
-                #Telling attacker
-                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s Battleship!").encode("utf-8")
-                self.send_buffer.append(self.request)
-                #Telling target
-                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your Battleship!").encode("utf-8")
-                self.send_buffer.append(self.request)
-
-                p.ship_sunk_flags[target][1] = True
-        if '3' not in p.players[target][0]:
-            if not p.ship_sunk_flags[target][2]:
-                #Cruiser Sunk
-                #Telling attacker
-                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s Cruiser!").encode("utf-8")
-                self.send_buffer.append(self.request)
-                #Telling target
-                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your Cruiser!").encode("utf-8")
-                self.send_buffer.append(self.request)
-
-                p.ship_sunk_flags[target][2] = True
-        if '4' not in p.players[target][0]:
-            if not p.ship_sunk_flags[target][3]:
-                #Submarine Sunk
-                #Telling attacker
-                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s Submarine!").encode("utf-8")
-                self.send_buffer.append(self.request)
-                #Telling target
-                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your Submarine!").encode("utf-8")
-                self.send_buffer.append(self.request)
-
-                p.ship_sunk_flags[target][3] = True
-        if '5' not in p.players[target][0]:
-            if not p.ship_sunk_flags[target][4]:
-                #Destroyer Sunk
-                #Telling attacker
-                self.request = ("0" + str(current_player) + "You sunk Player " + str(target + 1) + "'s Destroyer!").encode("utf-8")
-                self.send_buffer.append(self.request)
-                #Telling target
-                self.request = ("0" + str(target) + "Player " + str(current_player + 1) + " sunk your Destroyer!").encode("utf-8")
-                self.send_buffer.append(self.request)
-
-                p.ship_sunk_flags[target][4] = True
-        #all target's ships sunk?
-        if False not in p.ship_sunk_flags[target]:
-            return True
-        else: 
-            return False
-        
-    def end_game(self, current_player, target):
-        # Telling player who sent the final attack
-        self.request = ("4" + str(current_player) + "You Win!").encode("utf-8")
-        self.send_buffer.append(self.request)
-        #Telling target
-        self.request = ("4" + str(target) + "You Lose!").encode("utf-8")
-        self.send_buffer.append(self.request)
-
-    def message_decode(self, data):
-        readable = data.decode("utf-8")
-        if readable[0] == "0":
-            self.join_game(readable[1:])
-        elif readable[0] == "1":
-            self.pass_turn(readable[1:])
-        elif readable[0] == "2":
-            self.play_again(readable[1:])
-        else:
-            pass
-            # error!
+            mode = "r"
+        if mode != self.events_mode:
+            self.set_selector_events_mask(mode)
 
     def read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            count = self.recv_buffer.recv_into(self.sock)
         except BlockingIOError as error:
-            pass
-        else:
+            return
+        except ConnectionError:
+            # Reset by the peer, same as a clean disconnect for us
+            count = 0
+
+        if not count:
+            self.disconnected()
+            return
+
+        # process every complete message, a partial one stays buffered until the rest arrives
+        for data in self.recv_buffer.frames():
             if data:
-                # process data
-                print("received ", repr(data), "from", self.sock.getpeername())
-                logger.info("received %s from %s", repr(data), self.sock.getpeername())
-                self.message_decode(data)
-            else:
-                # Client disconnected # IMPORTANT -- Update so if one person is connected, they can disconnect without breaking things
-                if p.players[0][2] == self.sock:
-                    playerNumber = 1
-                    disconnected = 0
-                else:
-                    playerNumber = 0
-                    disconnected = 1
-                self.request = ("5" + str(playerNumber + 1) + "Player " + str(disconnected + 1) + " disconnected from the game. Stopping the server.").encode("utf-8")
-                self.send_buffer.append(self.request)
-                # Log and print disconnect error
-                logger.info("Player " + str(disconnected + 1) + " disconnected from the game. Stopping the server.")
-                print("Player " + str(disconnected + 1) + " disconnected from the game. Stopping the server.")
-            
-        self.set_selector_events_mask("w") # We read the data, we're writing now
-
-    # Sends data to specified client
+                metrics.messages_in[data[0]] += 1
+                metrics.bytes_in += len(data)
+            self.message_decode(data)
+            if self.closing:
+                break
+        self.dispatch()
+        # Moves the computer opponent made in reply
+        self.lobby.run_deferred()
+
+    def queue_message(self, req):
+        if self.sock is None or self.closing:
+            return
+        metrics.messages_out[req[0]] += 1
+        metrics.bytes_out += len(req)
+        # Prefix the message with its length so the client can split it back out
+        frame = encode_frame(req)
+        self.out_queue.append(frame)
+        self.queued += len(frame)
+
+    def queue_shared(self, data):
+        if self.sock is None or self.closing or self.stale:
+            return
+        metrics.bytes_out += len(data)
+        if self.out_queue and self.queued + len(data) > SPECTATOR_QUEUE_LIMIT:
+            # Too far behind, drop all but the first buffer (it may be partly sent already) and send a snapshot once
+            # the socket has taken that
+            head = self.out_queue.popleft()
+            self.out_queue.clear()
+            self.out_queue.append(head)
+            self.queued = len(head)
+            self.stale = True
+            return
+        # Appended as is, every spectator's queue holds the same bytes object
+        self.out_queue.append(data)
+        self.queued += len(data)
+
+    # Sends as much of the outbound queue as the socket will take, the unsent tail waits for the next EVENT_WRITE
     def write(self):
-        stopServer = False
-        for req in self.send_buffer: # if there is something to send
-            # Add character that shows its the end of the message to each request
-            decodedReq = req.decode("utf-8")
-            decodedReq = decodedReq + "~"
-            req = decodedReq.encode("utf-8")
-            # Get the player that the request is being sent to
-            player = p.players[int(req.decode("utf-8")[1])]
-            print("sending  ", repr(req), "to", player[2].getpeername())
-            logger.info("Sent %s to %s", repr(req), player[2].getpeername())
+        while self.out_queue:
             try:
-                # Send the data to the specified player
-                player[2].send(req)
+                if SENDMSG:
+                    # One vectored write for everything queued instead of one send() per message
+                    sent = self.sock.sendmsg(list(islice(self.out_queue, IOV_MAX)))
+                else:
+                    sent = self.sock.send(self.out_queue[0])
             except BlockingIOError:
-                # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
-            else:
-                pass
-
-            # See if the server sent a server reset message
-            if decodedReq[0] == "4":
-                p.reset_game = True
-
-            # See if the server sent a server close message
-            if decodedReq[0] == "5":
-                stopServer = True
-        
-        # Clear after all requests have been sent
-        self.send_buffer.clear()
-
-        if len(self.send_buffer) == 0:
-            self.set_selector_events_mask("r") # We sent all our data, listen for a response now
-        
-        # If the server sent a server close message to any player, then stop the server
-        if stopServer:
-            print("Client disconnected, closing application.")
-            logger.info("Client disconnected, close application.")
-            sys.exit()
-
-    def get_request_data(self): # This is for later, in case we need it
-        if self.request == None:
-            pass
+                # Resource temporarily unavailable (errno EWOULDBLOCK), keep the rest for later
+                break
+            except OSError as e:
+                # The peer is gone, reading from the socket will notice and end the match
+                logger.info("Dropping %s queued messages for %s: %s", len(self.out_queue), self.addr, repr(e))
+                self.out_queue.clear()
+                self.queued = 0
+                break
+            self.queued -= sent
+            while sent:
+                head = self.out_queue[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    self.out_queue.popleft()
+                else:
+                    # Keep the unsent tail without copying it
+                    self.out_queue[0] = memoryview(head)[sent:]
+                    sent = 0
+
+        if self.closing and not self.out_queue:
+            self.close()
+            return
+        if self.stale and not self.out_queue:
+            self.catch_up()
+            self.write()
+            return
+        self.update_events()
+
+    def queued_bytes(self):
+        return self.queued
+
+    def close_when_flushed(self):
+        self.closing = True
+        if self.out_queue:
+            self.update_events()
+        else:
+            self.close()
 
     def process(self, mask):
+        if self.sock is None:
+            # Closed earlier in this same select() batch when its match ended
+            return
         if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE:
-            self.get_request_data()
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
             self.write()
 
 
@@ -328,65 +207,409 @@ class ClientConnection:
 # ========== START OF THE SERVER PROGRAM ==========
 sel = selectors.DefaultSelector()
 
-# Configure logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename="server.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
-# Data structure to hold player values
-p = ServerData()
+# sendmsg() isn't available on every platform (ex. Windows), fall back to one send() per message there
+SENDMSG = hasattr(socket.socket, "sendmsg")
+# Most systems won't take more buffers than this in one sendmsg() call
+IOV_MAX = 1024
+# Unsent bytes a spectator can have before its updates are dropped for a snapshot later
+SPECTATOR_QUEUE_LIMIT = 64 * 1024
+
+# Pairs players into matches and tracks every running match
+lobby = Lobby()
+# Lobby keyword arguments from the command line (timeouts and limits), for the lobbies made in each worker
+lobby_options = {}
+# Connections the kernel queues up for us to accept
+BACKLOG = 1024
+listen_backlog = BACKLOG
+# Most connections accepted for one readiness event, so a connection storm can't hold up the running matches
+ACCEPT_BATCH = 128
+# How long to stop accepting when we are out of file descriptors
+ACCEPT_PAUSE = 0.5
+# A metrics scraper that hasn't sent its request and taken the reply by then is hung up on
+METRICS_TIMEOUT = 5.0
+
+def raise_open_file_limit():
+    # Every player is one socket, so thousands of matches need far more fds than the usual soft limit of 1024
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logger.info("Raised open file limit from %s to %s", soft, hard)
+    except (ImportError, ValueError, OSError) as e:
+        logger.info("Could not raise open file limit: %s", repr(e))
 
 def accept_wrapper(sock):
-    conn, addr = sock.accept()  # Should be ready to read
-    print("accepted connection from", addr)
-    # Log connection
-    logger.info("Accepted connection from %s on port %s", addr[0], addr[1])
-    conn.setblocking(False)
-    clientConnection = ClientConnection(sel, conn, addr)
-    sel.register(conn, selectors.EVENT_READ, data=clientConnection)
-
-parser = argparse.ArgumentParser(description='Server for Battleship terminal game')
-parser.add_argument('-p', help='Listening port', required=True)
-args = parser.parse_args()
-
-host, port = '0.0.0.0', int(args.p)
-lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-# Avoid bind() exception: OSError: [Errno 48] Address already in use
-lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-lsock.bind((host, port))
-lsock.listen()
-print("listening on", (host, port))
-logger.info("Listening for connections from %s on port %s", host, port)
-lsock.setblocking(False)
-sel.register(lsock, selectors.EVENT_READ, data=None)
-
-try:
-    while True:
-        if p.reset_game:
-            logger.info("Game ended, reset server.")
-            print("Game ended, resetting server.")
-            print("listening on", (host, port))
-            sel.unregister(p.players[0][2])
-            sel.unregister(p.players[1][2])
-            p.reset_game_data()
-        events = sel.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                accept_wrapper(key.fileobj)
+    # Take every connection that is waiting, up to ACCEPT_BATCH, the rest come up again on the next select()
+    for _ in range(ACCEPT_BATCH):
+        try:
+            conn, addr = sock.accept()  # Should be ready to read
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # Out of file descriptors or memory. The listening socket stays readable, so stop watching it for a
+                # moment instead of spinning on it
+                logger.error("Can't accept connections (%s), pausing for %ss", repr(e), ACCEPT_PAUSE)
+                sel.unregister(sock)
+                lobby.timers.schedule(ACCEPT_PAUSE, sel.register, sock, selectors.EVENT_READ, None)
+                return
+            logger.info("accept() failed: %s", repr(e))
+            continue
+        reason = lobby.admit_connection(addr[0])
+        if reason is not None:
+            refuse_connection(conn, addr, reason)
+            continue
+        echo("accepted connection from", addr)
+        # Log connection
+        logger.info("Accepted connection from %s on port %s", addr[0], addr[1])
+        conn.setblocking(False)
+        # A turn is a few small frames over more than one write, don't let Nagle hold them back for the ACK. The
+        # option stays with the socket, so connections handed to a worker or a new process keep it.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        clientConnection = ClientConnection(sel, conn, addr)
+        sel.register(conn, selectors.EVENT_READ, data=clientConnection)
+
+def refuse_connection(conn, addr, reason):
+    # Tell them why and hang up, without setting anything up for the connection
+    logger.info("Refused connection from %s: %s", addr[0], reason)
+    try:
+        conn.setblocking(False)
+        conn.send(encode_frame(("50" + reason).encode("utf-8")))
+        # Read whatever they sent already, closing with unread data would reset the connection before they see why
+        conn.recv(4096)
+    except OSError:
+        pass
+    conn.close()
+
+class MetricsListener:
+    # --metrics-port, answers each connection with the metrics (see metrics.py) and closes it
+    def __init__(self, sock):
+        self.sock = sock
+
+    def process(self, mask):
+        for _ in range(ACCEPT_BATCH):
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            conn.setblocking(False)
+            sel.register(conn, selectors.EVENT_READ, data=MetricsRequest(conn))
+
+class MetricsRequest:
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = b""
+        self.reply = None
+        # Outside the connection limits, so it can't be left open for good
+        self.timer = lobby.timers.schedule(METRICS_TIMEOUT, self.close)
+
+    def process(self, mask):
+        if self.reply is None:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            self.request += data
+            # Answer once the request line is in, or the other end is done sending
+            if data and b"\n" not in self.request and len(self.request) < 8192:
+                return
+            self.reply = memoryview(metrics.response(self.request))
+            sel.modify(self.sock, selectors.EVENT_WRITE, data=self)
+        try:
+            sent = self.sock.send(self.reply)
+        except BlockingIOError:
+            return
+        except OSError:
+            sent = len(self.reply)
+        self.reply = self.reply[sent:]
+        if not self.reply:
+            self.close()
+
+    def close(self):
+        self.timer.cancel()
+        if self.sock.fileno() != -1:
+            sel.unregister(self.sock)
+            self.sock.close()
+
+def add_lobby_gauges():
+    # Looked up when scraped, so they follow the lobby global
+    metrics.add_gauge("battleship_matches", "Matches running or waiting for players", lambda: len(lobby.matches))
+    metrics.add_gauge("battleship_waiting_players", "Players waiting for an opponent", lambda: len(lobby.waiting.connections) if lobby.waiting else 0)
+    metrics.add_gauge("battleship_seated_players", "Players seated in a match", lambda: len(lobby.seats))
+    metrics.add_gauge("battleship_connections", "Open player connections", lambda: lobby.connection_count)
+    metrics.add_gauge("battleship_pending_timers", "Timeouts scheduled", lambda: lobby.timers.count)
+    metrics.add_gauge("battleship_outbound_queue_bytes", "Bytes waiting to be sent, over every seated player", lambda: sum(connection.queued_bytes() for connection in lobby.seats))
+    metrics.add_gauge("battleship_outbound_queue_max_bytes", "Bytes waiting to be sent to the furthest behind seated player", lambda: max((connection.queued_bytes() for connection in lobby.seats), default=0))
+
+def adopt_connection(sock, data):
+    # A waiting player handed over from another worker, seat them here as if they had just joined
+    addr = sock.getpeername()
+    # Already let in by the worker it came from
+    lobby.add_connection(addr[0])
+    clientConnection = ClientConnection(sel, sock, addr)
+    sel.register(sock, selectors.EVENT_READ, data=clientConnection)
+    clientConnection.join_game(data, rejoining=True)
+    clientConnection.dispatch()
+
+def take_connection(sock, addr):
+    # A connection handed over by the server this one is taking over from (see upgrade.py). sock is None for a
+    # player whose connection dropped, their seat is held until they resume.
+    clientConnection = ClientConnection(sel, sock, addr)
+    if sock is None:
+        clientConnection.stop_idle_timer()
+    else:
+        lobby.add_connection(addr[0])
+        sel.register(sock, selectors.EVENT_READ, data=clientConnection)
+    return clientConnection
+
+def take_over(path):
+    # --take-over: get the listening socket, the players and their matches from the server running with
+    # --upgrade-socket path, returns the listening socket
+    start = time.perf_counter()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(upgrade.HANDOFF_TIMEOUT)
+    conn.connect(path)
+    state, sockets = upgrade.receive_state(conn)
+    sessions = upgrade.restore(state, sockets, lobby, take_connection)
+    for session in sessions:
+        if isinstance(session, ClientConnection) and session.sock is not None:
+            # Send whatever the old server hadn't got out yet
+            if session.closing:
+                session.close_when_flushed()
             else:
-                clientConnection = key.data
-                try:
-                    clientConnection.process(mask)
-                except Exception:
-                    print(
-                        "main: error: exception for",
-                        f"{clientConnection}:\n{traceback.format_exc()}",
-                    )
-                    logger.error(
-                        "main: error: exception for %s:%s",
-                        clientConnection, traceback.format_exc()
-                    )
-except KeyboardInterrupt:
-    print("caught keyboard interrupt, exiting")
-    logger.info("Keyboard interrupt, closing program")
-finally:
-    sel.close()
+                session.update_events()
+    conn.sendall(b"K")
+    # The old server lets go of the port and the journal before it answers
+    conn.recv(1)
+    conn.close()
+    elapsed = (time.perf_counter() - start) * 1000
+    print("took over", len(sockets) - 1, "connections and", len(lobby.matches), "matches in", "%.1f" % elapsed, "ms")
+    logger.info("Took over %s connections and %s matches in %.1f ms", len(sockets) - 1, len(lobby.matches), elapsed)
+    return sockets[0]
+
+def hand_off(conn, lsock, msock, handoff):
+    # --upgrade-socket: a new server asked for everything we have (see upgrade.py). Nothing else runs until it
+    # has it, returns True once it took over.
+    start = time.perf_counter()
+    connections = [key.data for key in sel.get_map().values() if isinstance(key.data, ClientConnection)]
+    state, sockets = upgrade.capture(lobby, connections, lsock)
+    if not upgrade.send_state(conn, state, sockets):
+        print("the new server didn't take over, carrying on")
+        logger.error("The new server didn't take over, carrying on")
+        return False
+    # The new server has its own copies of the sockets, closing ours doesn't hang up on anyone
+    for sock in sockets:
+        try:
+            sel.unregister(sock)
+        except KeyError:
+            # The listening socket, while accepting is paused
+            pass
+        sock.close()
+    for connection in connections:
+        connection.sock = None
+    if msock is not None:
+        sel.unregister(msock)
+        msock.close()
+    if lobby.journal is not None:
+        lobby.journal.close()
+        lobby.journal = None
+    handoff.close()
+    conn.sendall(b"D")
+    elapsed = (time.perf_counter() - start) * 1000
+    print("handed", len(sockets) - 1, "connections and", len(lobby.matches), "matches to the new server in", "%.1f" % elapsed, "ms")
+    logger.info("Handed %s connections and %s matches to the new server in %.1f ms", len(sockets) - 1, len(lobby.matches), elapsed)
+    return True
+
+def create_listening_socket(host, port, reuse_port=False):
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Avoid bind() exception: OSError: [Errno 48] Address already in use
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker listens on the same port and the kernel balances new connections between them
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    lsock.listen(listen_backlog)
+    print("listening on", (host, port))
+    logger.info("Listening for connections from %s on port %s", host, port)
+    return lsock
+
+def run_selectors(host, port, control=None, metrics_port=None, upgrade_path=None, lsock=None):
+    # control is this process's socket to the coordinator when running as one of several --workers
+    # lsock is the listening socket when it came from the server we took over from
+    global lobby, sel
+    if control is not None:
+        # An epoll selector created before fork() is shared with every other worker, each one needs its own
+        sel.close()
+        sel = selectors.DefaultSelector()
+    if lsock is None:
+        lsock = create_listening_socket(host, port, reuse_port=control is not None)
+    lsock.setblocking(False)
+    sel.register(lsock, selectors.EVENT_READ, data=None)
+    if control is not None:
+        worker = workers.Worker(control, adopt_connection, lobby_options)
+        lobby = worker.lobby
+        sel.register(control, selectors.EVENT_READ, data=worker)
+    msock = None
+    if metrics_port is not None:
+        msock = create_listening_socket("127.0.0.1", metrics_port)
+        msock.setblocking(False)
+        sel.register(msock, selectors.EVENT_READ, data=MetricsListener(msock))
+    handoff = None
+    if upgrade_path is not None:
+        handoff = upgrade.UpgradeListener(upgrade_path, lambda conn: hand_off(conn, lsock, msock, handoff))
+        sel.register(handoff.sock, selectors.EVENT_READ, data=handoff)
+    if profiling.directory is not None:
+        signals = profiling.SignalListener()
+        sel.register(signals.sock, selectors.EVENT_READ, data=signals)
+
+    try:
+        while handoff is None or not handoff.handed_off:
+            # Sleep until the next timeout is due at the latest
+            events = sel.select(timeout=lobby.timers.timeout())
+            start = time.perf_counter_ns()
+            for key, mask in events:
+                if handoff is not None and handoff.handed_off:
+                    # Everything belongs to the new server now
+                    break
+                if key.data is None:
+                    accept_wrapper(key.fileobj)
+                else:
+                    clientConnection = key.data
+                    try:
+                        clientConnection.process(mask)
+                    except Exception:
+                        print(
+                            "main: error: exception for",
+                            f"{clientConnection}:\n{traceback.format_exc()}",
+                        )
+                        logger.error(
+                            "main: error: exception for %s:%s",
+                            clientConnection, traceback.format_exc()
+                        )
+            if handoff is not None and handoff.handed_off:
+                break
+            lobby.timers.advance()
+            metrics.loop_events.record(len(events))
+            metrics.loop_busy_seconds.record(time.perf_counter_ns() - start)
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+        logger.info("Keyboard interrupt, closing program")
+    finally:
+        if handoff is not None:
+            handoff.close()
+        sel.close()
+
+def stop_server(signum, frame):
+    # Stop on SIGTERM the same way as on Ctrl-C, so the log records still queued get written out
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description='Server for Battleship terminal game')
+    parser.add_argument('-p', help='Listening port', required=True)
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors', help='Event loop the server runs on (default: selectors)')
+    parser.add_argument('--uvloop', action='store_true', help='With --engine asyncio, use uvloop if it is installed')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes sharing the port (selectors engine only, default: 1)')
+    parser.add_argument('--journal', metavar='DIR', help='Write every match event to a journal in DIR, and pick up the matches left in it on start')
+    parser.add_argument('--turn-timeout', type=float, default=60, metavar='SECONDS', help='Time a player has for each move, 0 for no limit (default: 60)')
+    parser.add_argument('--on-timeout', choices=['forfeit', 'random'], default='forfeit', help='What happens when a player runs out of time: they lose, or a random tile is picked for them (default: forfeit)')
+    parser.add_argument('--join-timeout', type=float, default=300, metavar='SECONDS', help='Time a player waits for an opponent before being sent away, 0 for no limit (default: 300)')
+    parser.add_argument('--idle-timeout', type=float, default=600, metavar='SECONDS', help='Disconnect connections that send nothing for this long, 0 for no limit (default: 600)')
+    parser.add_argument('--backlog', type=int, default=BACKLOG, help=f'Connections the kernel queues up before they are accepted (default: {BACKLOG})')
+    parser.add_argument('--max-connections', type=int, default=0, help='Turn new connections away past this many, 0 for no limit (per worker with --workers, default: 0)')
+    parser.add_argument('--max-per-ip', type=int, default=0, help='Connections allowed from one address, 0 for no limit (per worker with --workers, default: 0)')
+    parser.add_argument('--max-matches', type=int, default=0, help='Matches running or waiting for a player at once, 0 for no limit (per worker with --workers, default: 0)')
+    parser.add_argument('--max-spectators', type=int, default=0, help='People who can watch one match, 0 for no limit (default: 0)')
+    parser.add_argument('--resume-grace', type=float, default=30, metavar='SECONDS', help='Hold a seat this long for a player whose connection drops, 0 to end the match right away (default: 30)')
+    parser.add_argument('--upgrade-socket', metavar='PATH', help='Listen on the Unix socket PATH for a new server to hand the port and every running match to (selectors engine only, not with --workers)')
+    parser.add_argument('--take-over', action='store_true', help='Take the port and every running match over from the server listening on --upgrade-socket, then listen there for the next upgrade')
+    parser.add_argument('--metrics-port', type=int, help='Serve counters and latency histograms in the Prometheus text format on this port (127.0.0.1 only, not with --workers)')
+    parser.add_argument('--profile-dir', metavar='DIR', help='Let SIGUSR1 (CPU profile and handler timings) and SIGUSR2 (memory allocations) profile the running server, with the results written to DIR')
+    parser.add_argument('--profiler', choices=['cprofile', 'sample'], default='cprofile', help='CPU profiler SIGUSR1 starts: cProfile, or a sampling profiler that costs less (default: cprofile)')
+    parser.add_argument('--quiet', action='store_true', help="Don't print connections and messages to stdout")
+    parser.add_argument('--log-level', action='append', default=[], metavar='[LOGGER=]LEVEL',
+                        help='Log level for every logger or just one, ex. --log-level INFO --log-level traffic=WARNING (repeatable)')
+    parser.add_argument('--traffic-sample', type=int, default=1, metavar='N', help='Log only 1 in N messages sent and received (default: 1)')
+    parser.add_argument('--log-queue-size', type=int, default=10000, help='Log records held for the log writer thread before new ones are dropped (default: 10000)')
+    args = parser.parse_args()
+
+    # Configure logging, the log file is written from a background thread
+    try:
+        setup_logging("server.log", args.log_level, args.traffic_sample, args.log_queue_size, args.quiet)
+    except ValueError as e:
+        parser.error(str(e))
+
+    signal.signal(signal.SIGTERM, stop_server)
+
+    if args.journal and args.workers > 1:
+        # Every worker has its own match ids and players move between workers, so there is no one journal to write
+        parser.error("--journal can't be used with --workers")
+    if args.metrics_port is not None and args.workers > 1:
+        # Each worker has its own numbers, and one port can't show them all
+        parser.error("--metrics-port can't be used with --workers")
+    if args.upgrade_socket and (args.engine == 'asyncio' or args.workers > 1):
+        # Only the selectors loop can stop between two events to pass its sockets on
+        parser.error("--upgrade-socket only works with the selectors engine and one process")
+    if args.take_over and not args.upgrade_socket:
+        parser.error("--take-over needs the --upgrade-socket of the running server")
+
+    global lobby, listen_backlog
+    listen_backlog = args.backlog
+    lobby_options.update(
+        turn_timeout=args.turn_timeout or None,
+        join_timeout=args.join_timeout or None,
+        idle_timeout=args.idle_timeout or None,
+        on_timeout=args.on_timeout,
+        max_connections=args.max_connections or None,
+        max_per_ip=args.max_per_ip or None,
+        max_matches=args.max_matches or None,
+        max_spectators=args.max_spectators or None,
+        resume_grace=args.resume_grace or None,
+    )
+    journal = None
+    if args.journal and not args.take_over:
+        journal, journaled_matches = open_journal(args.journal)
+    lobby = Lobby(journal, **lobby_options)
+    if journal is not None:
+        lobby.restore(journaled_matches)
+        print("restored", len(journaled_matches), "matches from", args.journal)
+
+    if args.metrics_port is not None:
+        add_lobby_gauges()
+
+    if args.engine == 'asyncio':
+        import server_asyncio
+    if args.profile_dir:
+        profiling.install(args.profile_dir, args.profiler, server_asyncio.AsyncioConnection if args.engine == 'asyncio' else ClientConnection)
+
+    host, port = '0.0.0.0', int(args.p)
+    raise_open_file_limit()
+    lsock = None
+    if args.take_over:
+        try:
+            lsock = take_over(args.upgrade_socket)
+        except (OSError, ValueError) as e:
+            print("couldn't take over from the server on", args.upgrade_socket + ":", e)
+            logger.error("Couldn't take over from the server on %s: %s", args.upgrade_socket, repr(e))
+            sys.exit(1)
+        if args.journal:
+            # Opened once the old server has closed it. The matches left in it came over with the sockets already.
+            journal, _ = open_journal(args.journal)
+            lobby.journal = journal
+    try:
+        if args.engine == 'asyncio':
+            server_asyncio.run(host, port, args.uvloop, lobby, args.backlog, args.metrics_port)
+        elif args.workers > 1:
+            workers.run(host, port, args.workers, run_selectors)
+        else:
+            run_selectors(host, port, metrics_port=args.metrics_port, upgrade_path=args.upgrade_socket, lsock=lsock)
+    finally:
+        if journal is not None:
+            journal.close()
+
+if __name__ == "__main__":
+    main()
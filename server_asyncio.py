@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# asyncio engine for the server (python server.py -p <port> --engine asyncio).
+# Runs the same game logic as the selectors engine (see game.py) on asyncio transports. The transport takes care of
+# partial writes and buffering, and tells us through pause_writing/resume_writing when a client stops keeping up.
+
+import asyncio
+import logging
+import traceback
+
+import metrics
+import profiling
+from game import Lobby, PlayerSession
+from log_pipeline import echo
+from protocol import FrameDecoder, encode_frame
+
+logger = logging.getLogger(__name__)
+
+# Once this much is buffered for a client that isn't reading, the transport pauses us
+WRITE_HIGH_WATER = 64 * 1024
+# A metrics scraper that hasn't sent its request and taken the reply by then is hung up on
+METRICS_TIMEOUT = 5.0
+
+class AsyncioConnection(PlayerSession, asyncio.Protocol):
+    def __init__(self, lobby):
+        super().__init__(lobby, None)
+        self.transport = None
+        self.recv_buffer = FrameDecoder()
+        # Framed messages not handed to the transport yet, either made during this read or held back while paused
+        self.out_queue = []
+        self.paused = False
+        # Turned away by the lobby's connection limits
+        self.refused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        reason = self.lobby.admit_connection(self.addr[0])
+        if reason is not None:
+            # Tell them why and hang up, without setting anything up for the connection
+            logger.info("Refused connection from %s: %s", self.addr[0], reason)
+            self.refused = True
+            self.closing = True
+            self.stop_idle_timer()
+            transport.write(encode_frame(("50" + reason).encode("utf-8")))
+            transport.close()
+            return
+        transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        echo("accepted connection from", self.addr)
+        # Log connection
+        logger.info("Accepted connection from %s on port %s", self.addr[0], self.addr[1])
+
+    def data_received(self, data):
+        self.recv_buffer.feed(data)
+        try:
+            # process every complete message, a partial one stays buffered until the rest arrives
+            for frame in self.recv_buffer.frames():
+                if frame:
+                    metrics.messages_in[frame[0]] += 1
+                    metrics.bytes_in += len(frame)
+                self.message_decode(frame)
+                if self.closing:
+                    break
+            self.dispatch()
+            # Moves the computer opponent made in reply
+            self.lobby.run_deferred()
+        except Exception:
+            print(
+                "main: error: exception for",
+                f"{self}:\n{traceback.format_exc()}",
+            )
+            logger.error(
+                "main: error: exception for %s:%s",
+                self, traceback.format_exc()
+            )
+
+    def connection_lost(self, exc):
+        if not self.refused:
+            self.lobby.connection_closed(self.addr[0])
+            if not self.closing:
+                self.disconnected()
+        self.transport = None
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.stale:
+            self.catch_up()
+        self.write()
+
+    def queue_message(self, req):
+        if self.transport is None or self.closing:
+            return
+        metrics.messages_out[req[0]] += 1
+        metrics.bytes_out += len(req)
+        # Prefix the message with its length so the client can split it back out
+        self.out_queue.append(encode_frame(req))
+
+    def queue_shared(self, data):
+        if self.transport is None or self.closing or self.stale:
+            return
+        if self.paused:
+            # The transport already holds more than WRITE_HIGH_WATER for them, skip updates until it drains and
+            # send a snapshot then
+            self.out_queue.clear()
+            self.stale = True
+            return
+        metrics.bytes_out += len(data)
+        self.out_queue.append(data)
+
+    def write(self):
+        # Hand everything queued to the transport in one call, unless the client is behind
+        if self.out_queue and not self.paused and self.transport is not None:
+            self.transport.writelines(self.out_queue)
+            self.out_queue.clear()
+
+    def close(self):
+        echo("closing connection to", self.addr)
+        logger.info("Closed connection to %s", self.addr)
+        if self.transport is not None:
+            self.transport.close()
+
+    def queued_bytes(self):
+        buffered = self.transport.get_write_buffer_size() if self.transport is not None else 0
+        return buffered + sum(len(frame) for frame in self.out_queue)
+
+    def close_when_flushed(self):
+        self.closing = True
+        if self.transport is not None:
+            if self.out_queue:
+                self.transport.writelines(self.out_queue)
+                self.out_queue.clear()
+            # The transport sends whatever it still has buffered before closing the socket
+            self.close()
+
+class TimerDriver:
+    # Drives the lobby's timing wheel with a loop.call_later for the next tick that has something to do. A timer
+    # scheduled for sooner moves it earlier, so timers are as punctual as on the selectors loop, which asks the wheel
+    # for its select timeout every time round.
+    def __init__(self, loop, lobby):
+        self.loop = loop
+        self.lobby = lobby
+        self.handle = None
+        # Wheel clock time the handle is set for
+        self.due = None
+        lobby.timers.on_schedule = self.timer_scheduled
+        self.arm()
+
+    def timer_scheduled(self, due):
+        if self.handle is None or due < self.due:
+            self.arm_at(due)
+
+    def arm(self):
+        timeout = self.lobby.timers.timeout()
+        if timeout is None:
+            self.cancel()
+        else:
+            self.arm_at(self.lobby.timers.clock() + timeout)
+
+    def arm_at(self, due):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.due = due
+        self.handle = self.loop.call_later(max(0.0, due - self.lobby.timers.clock()), self.run)
+
+    def run(self):
+        self.handle = None
+        # How late the loop got back to us, the asyncio version of a slow loop iteration
+        metrics.loop_lag_seconds.record(max(0, int((self.lobby.timers.clock() - self.due) * 1e9)))
+        self.lobby.timers.advance()
+        self.lobby.run_deferred()
+        self.arm()
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+class MetricsProtocol(asyncio.Protocol):
+    # --metrics-port, answers each connection with the metrics (see metrics.py) and closes it
+    def __init__(self):
+        self.transport = None
+        self.request = b""
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Outside the connection limits, so it can't be left open for good
+        self.timer = asyncio.get_running_loop().call_later(METRICS_TIMEOUT, transport.abort)
+
+    def connection_lost(self, exc):
+        self.timer.cancel()
+
+    def data_received(self, data):
+        self.request += data
+        # Answer once the request line is in
+        if b"\n" in self.request or len(self.request) >= 8192:
+            self.reply()
+
+    def eof_received(self):
+        self.reply()
+
+    def reply(self):
+        if not self.transport.is_closing():
+            self.transport.write(metrics.response(self.request))
+            self.transport.close()
+
+async def serve(host, port, lobby, backlog, metrics_port=None):
+    loop = asyncio.get_running_loop()
+    # asyncio accepts up to backlog connections each time the listening socket is ready
+    server = await loop.create_server(lambda: AsyncioConnection(lobby), host, port, reuse_address=True, backlog=backlog)
+    print("listening on", (host, port))
+    logger.info("Listening for connections from %s on port %s", host, port)
+    if metrics_port is not None:
+        await loop.create_server(MetricsProtocol, "127.0.0.1", metrics_port, reuse_address=True)
+        print("serving metrics on", ("127.0.0.1", metrics_port))
+    if profiling.directory is not None:
+        for signum, toggle in profiling.SIGNALS.items():
+            loop.add_signal_handler(signum, toggle)
+    timers = TimerDriver(loop, lobby)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        timers.cancel()
+        lobby.timers.on_schedule = None
+
+def run(host, port, use_uvloop=False, lobby=None, backlog=100, metrics_port=None):
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop isn't installed, using the default asyncio event loop")
+            logger.info("uvloop isn't installed, using the default asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using the uvloop event loop")
+
+    # Pairs players into matches and tracks every running match
+    if lobby is None:
+        lobby = Lobby()
+    try:
+        asyncio.run(serve(host, port, lobby, backlog, metrics_port))
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+        logger.info("Keyboard interrupt, closing program")
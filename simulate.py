@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Batch game engine for offline simulation, plays many games at once with NumPy (python simulate.py -n 1000000).
+# Follows the same rules as the server (see pass_turn and check_game_state in game.py and Board in board.py):
+# players take turns one shot each whatever the shot hit, shooting a cell again changes nothing, a ship sinks when all
+# its cells are hit, and the game ends as soon as every ship that was placed on the target board is sunk.
+#
+# Every game is a row in the arrays:
+#   ships  (N, 2, 100) uint8, ship number (1-5, 0 for water) on each cell of each player's board, cell = row * 10 + column
+#   shots  (N, 2, S) cells each player fires at, in order
+#   first  (N,) seat that shoots first
+# play() runs all the games in lockstep, one turn per step, touching only the games that are still going.
+# BatchGames.step() is there for strategies that pick their next shot from what their last ones hit.
+
+import argparse
+import time
+
+import numpy as np
+
+from board import Board, CELL_COUNT, EMPTY_BOARD, PLACEMENTS, SHIP_LENGTHS, cell_to_text_index
+
+SHIP_COUNT = len(SHIP_LENGTHS)
+# Where each cell is in the "/"-separated board string
+TEXT_INDEX = np.array([cell_to_text_index(cell) for cell in range(CELL_COUNT)])
+NO_WINNER = -1
+
+def placement_masks(length):
+    # Every way to put a ship of this length on the board (board.PLACEMENTS), one row of cells per placement
+    return np.array([[mask >> cell & 1 for cell in range(CELL_COUNT)] for mask in PLACEMENTS[length]], dtype=bool)
+
+def random_layouts(count, rng):
+    """count boards, (count, 100) ship numbers, with the client's fleet placed at random without overlaps."""
+    ships = np.zeros((count, CELL_COUNT), dtype=np.uint8)
+    occupied = np.zeros((count, CELL_COUNT), dtype=bool)
+    for ship, length in enumerate(SHIP_LENGTHS, 1):
+        masks = placement_masks(length)
+        todo = np.arange(count)
+        while todo.size:
+            chosen = masks[rng.integers(0, len(masks), todo.size)]
+            clash = (occupied[todo] & chosen).any(axis=1)
+            placed = todo[~clash]
+            occupied[placed] |= chosen[~clash]
+            ships[placed] += chosen[~clash].astype(np.uint8) * ship
+            # Try again for the boards where it landed on another ship
+            todo = todo[clash]
+    return ships
+
+def layouts_from_boards(boards):
+    """Ship numbers, (len(boards), 100), from board strings in the protocol format."""
+    text = np.frombuffer("".join(boards).encode("utf-8"), dtype=np.uint8).reshape(len(boards), len(EMPTY_BOARD))
+    cells = text[:, TEXT_INDEX]
+    is_ship = (cells >= ord("1")) & (cells <= ord("5"))
+    return np.where(is_ship, cells - ord("0"), 0).astype(np.uint8)
+
+def board_from_layout(layout):
+    """The board string for one row of ship numbers."""
+    text = bytearray(EMPTY_BOARD.encode("utf-8"))
+    for cell in np.flatnonzero(layout):
+        text[cell_to_text_index(int(cell))] = ord("0") + int(layout[cell])
+    return text.decode("utf-8")
+
+def random_shots(count, rng):
+    """(count, 2, 100) every cell once per player, in random order."""
+    cells = np.broadcast_to(np.arange(CELL_COUNT, dtype=np.uint8), (count, 2, CELL_COUNT))
+    return rng.permuted(cells, axis=2)
+
+def sequential_shots(count):
+    """(count, 2, 100) A1, B1, ... J10 for every player."""
+    return np.broadcast_to(np.arange(CELL_COUNT, dtype=np.uint8), (count, 2, CELL_COUNT))
+
+class BatchGames:
+    # The per-game state is kept in flat arrays and indexed with one computed index per shot,
+    # which is a lot cheaper than NumPy's multi-dimensional fancy indexing
+    def __init__(self, ships, first):
+        count = len(ships)
+        self.count = count
+        self.ships = np.ascontiguousarray(ships, dtype=np.uint8).reshape(-1)
+        # Seat whose turn it is
+        self.shooter = np.asarray(first, dtype=np.intp).copy()
+        self.hit_cells = np.zeros(count * 2 * CELL_COUNT, dtype=bool)
+        # Unhit cells of every ship, and ships still afloat, per player
+        cells_left = np.zeros((count, 2, SHIP_COUNT), dtype=np.int16)
+        for ship in range(SHIP_COUNT):
+            cells_left[:, :, ship] = (ships == ship + 1).sum(axis=2)
+        # A ship that was never placed can't be sunk, so it doesn't count towards the game ending
+        self.ships_left = (cells_left > 0).sum(axis=2).reshape(-1)
+        self.cells_left = cells_left.reshape(-1)
+        self.winner = np.full(count, NO_WINNER, dtype=np.int8)
+        self.turns = np.zeros(count, dtype=np.int32)
+        # Games still being played
+        self.active = np.arange(count)
+
+    def step(self, cells):
+        """The player whose turn it is in every unfinished game shoots at cells[game].
+        Returns (hit, sunk) for all games, sunk is the sunk ship's index or -1."""
+        hit = np.zeros(self.count, dtype=bool)
+        sunk = np.full(self.count, -1, dtype=np.int8)
+        games = self.active
+        if not games.size:
+            return hit, sunk
+        shooter = self.shooter[games]
+        target = 1 - shooter
+        board = games * 2 + target
+        cell = board * CELL_COUNT + np.asarray(cells)[games]
+        ship = self.ships[cell]
+        is_hit = ship > 0
+        hit[games] = is_hit
+        # Only the first hit on a cell does any damage
+        damage = np.flatnonzero(is_hit & ~self.hit_cells[cell])
+        self.hit_cells[cell[damage]] = True
+        damaged_ship = ship[damage].astype(np.intp) - 1
+        ship_slot = board[damage] * SHIP_COUNT + damaged_ship
+        left = self.cells_left[ship_slot] - 1
+        self.cells_left[ship_slot] = left
+        sinking = left == 0
+        sunk[games[damage[sinking]]] = damaged_ship[sinking]
+        self.ships_left[board[damage[sinking]]] -= 1
+
+        self.turns[games] += 1
+        over = self.ships_left[board] == 0
+        self.winner[games[over]] = shooter[over]
+        # Every shot passes the turn
+        self.shooter[games] = target
+        self.active = games[~over]
+        return hit, sunk
+
+def play(ships, shots, first):
+    """Play every game until it ends or its shots run out. Returns (winner, turns) per game, winner is -1 for games
+    that ran out of shots."""
+    games = BatchGames(ships, first)
+    cells = np.zeros(len(ships), dtype=np.intp)
+    shot_count = shots.shape[2]
+    shots = np.ascontiguousarray(shots).reshape(-1)
+    for turn in range(2 * shot_count):
+        active = games.active
+        if not active.size:
+            break
+        # Turns alternate, so both players are on their (turn // 2)th shot
+        cells[active] = shots[(active * 2 + games.shooter[active]) * shot_count + turn // 2]
+        games.step(cells)
+    return games.winner, games.turns
+
+def play_with_boards(ships, shots, first):
+    """The same games played one shot at a time with the server's Board, to check play() against."""
+    winners, turns = [], []
+    for game in range(len(ships)):
+        boards = [Board(board_from_layout(ships[game, seat])) for seat in (0, 1)]
+        shooter, winner, turn = int(first[game]), NO_WINNER, 0
+        for shot in range(shots.shape[2]):
+            for _ in (0, 1):
+                target = 1 - shooter
+                boards[target].shoot(int(shots[game, shooter, shot]))
+                turn += 1
+                if boards[target].all_sunk():
+                    winner = shooter
+                    break
+                shooter = target
+            if winner != NO_WINNER:
+                break
+        winners.append(winner)
+        turns.append(turn)
+    return np.array(winners), np.array(turns)
+
+def main():
+    parser = argparse.ArgumentParser(description='Play many Battleship games at once with NumPy')
+    parser.add_argument('-n', type=int, default=1000000, help='Games to play (default: 1000000)')
+    parser.add_argument('--chunk', type=int, default=20000, help='Games played at once, small enough to stay in the CPU cache (default: 20000)')
+    parser.add_argument('--shots', choices=['random', 'sequential'], default='random', help='Shot order for both players (default: random)')
+    parser.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+    parser.add_argument('--verify', type=int, default=0, metavar='K', help="Also play the first K games with the server's Board and compare")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    start = time.perf_counter()
+    played = first_wins = total_turns = unfinished = 0
+    mismatches = 0
+    while played < args.n:
+        count = min(args.chunk, args.n - played)
+        ships = random_layouts(count * 2, rng).reshape(count, 2, CELL_COUNT)
+        shots = random_shots(count, rng) if args.shots == 'random' else sequential_shots(count)
+        first = rng.integers(0, 2, count)
+        winner, turns = play(ships, shots, first)
+        if played == 0 and args.verify:
+            # Not counted in the time
+            verify_start = time.perf_counter()
+            k = min(args.verify, count)
+            check_winner, check_turns = play_with_boards(ships[:k], shots[:k], first[:k])
+            mismatches = int(((check_winner != winner[:k]) | (check_turns != turns[:k])).sum())
+            start += time.perf_counter() - verify_start
+        first_wins += int((winner == first).sum())
+        unfinished += int((winner == NO_WINNER).sum())
+        total_turns += int(turns.sum())
+        played += count
+    elapsed = time.perf_counter() - start
+
+    print(f"games: {played}, {elapsed:.2f}s, {played / elapsed * 60:,.0f} games/min")
+    print(f"average shots per game: {total_turns / played:.2f}, first player wins: {first_wins / played:.1%}, unfinished: {unfinished}")
+    if args.verify:
+        print(f"checked {min(args.verify, args.chunk, args.n)} games against board.Board: {mismatches} mismatches")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Hierarchical timing wheel for the server's timeouts (turn deadlines, lobby waits, idle connections).
+# Time is cut into ticks of TICK seconds. Level 0 has a slot for each of the next SLOTS ticks, level 1 a slot for each
+# of the next SLOTS blocks of SLOTS ticks, and so on. A timer goes in the slot of the level its deadline falls in,
+# and when level 0 comes round to the start of a block, the timers in that block's higher level slot move down.
+# Scheduling and cancelling a timer is one set add/discard, however many timers are pending, and a timer moves down
+# at most LEVELS - 1 times before it runs.
+#
+# The event loop asks timeout() how long it can sleep and calls advance() when it wakes up. A loop that doesn't ask
+# again after every event can set on_schedule to hear about timers due sooner than it planned to wake up.
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+TICK = 0.1
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+# 64 ** 4 ticks of 0.1s is about 19 days, anything later waits in the last slot and moves down from there
+LEVELS = 4
+MAX_TICKS = 1 << (SLOT_BITS * LEVELS)
+
+class Timer:
+    __slots__ = ("wheel", "deadline", "callback", "args", "bucket")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        # Tick the timer is due on
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        # The slot the timer is in, None once it has run or been cancelled
+        self.bucket = None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+            self.wheel.count -= 1
+
+class TimingWheel:
+    def __init__(self, tick=TICK, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.start = clock()
+        # Time as of the last advance(), cheap to read for anyone who wants a recent clock
+        self.now = self.start
+        # Ticks since start that have been run
+        self.ticks = 0
+        self.levels = [[set() for slot in range(SLOTS)] for level in range(LEVELS)]
+        self.count = 0
+        # Called with the clock time a newly scheduled timer is due
+        self.on_schedule = None
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) in delay seconds (rounded up to the next tick), returns a Timer that can be cancelled."""
+        # Count from the real time, the wheel may be a little behind if the loop hasn't advanced it yet
+        deadline = max(self.ticks + 1, -int(-(self.clock() + delay - self.start) // self.tick))
+        timer = Timer(self, deadline, callback, args)
+        self.place(timer)
+        self.count += 1
+        if self.on_schedule is not None:
+            self.on_schedule(self.start + deadline * self.tick)
+        return timer
+
+    def place(self, timer):
+        distance = min(timer.deadline - self.ticks, MAX_TICKS - 1)
+        level = 0
+        while distance >= SLOTS << (SLOT_BITS * level):
+            level += 1
+        target = self.ticks + distance
+        timer.bucket = self.levels[level][(target >> (SLOT_BITS * level)) & SLOT_MASK]
+        timer.bucket.add(timer)
+
+    def timeout(self):
+        """Seconds until the next tick with something to do, None if no timers are pending."""
+        if not self.count:
+            return None
+        # At the latest, the start of the next block, when timers move down from the higher levels
+        next_tick = (self.ticks | SLOT_MASK) + 1
+        level_0 = self.levels[0]
+        for tick in range(self.ticks + 1, next_tick):
+            if level_0[tick & SLOT_MASK]:
+                next_tick = tick
+                break
+        return max(0.0, self.start + next_tick * self.tick - self.clock())
+
+    def advance(self):
+        """Run every timer that is due."""
+        self.now = self.clock()
+        target = int((self.now - self.start) / self.tick)
+        while self.ticks < target:
+            if not self.count:
+                # Nothing pending, nothing to move down or run on the way
+                self.ticks = target
+                break
+            self.ticks += 1
+            if not self.ticks & SLOT_MASK:
+                self.cascade()
+            bucket = self.levels[0][self.ticks & SLOT_MASK]
+            while bucket:
+                timer = bucket.pop()
+                if timer.deadline > self.ticks:
+                    # Was too far off for the top level when it was scheduled
+                    self.place(timer)
+                    continue
+                timer.bucket = None
+                self.count -= 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception("Timer callback %r failed", timer.callback)
+
+    def cascade(self):
+        # A new block is starting on every level whose lower bits are all zero, move their timers down, top level first
+        for level in range(LEVELS - 1, 0, -1):
+            if self.ticks & ((1 << (SLOT_BITS * level)) - 1):
+                continue
+            bucket = self.levels[level][(self.ticks >> (SLOT_BITS * level)) & SLOT_MASK]
+            moving = list(bucket)
+            bucket.clear()
+            for timer in moving:
+                self.place(timer)
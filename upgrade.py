@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# Hot upgrade for the selectors engine. A server started with
+#   python server.py -p <port> --upgrade-socket PATH
+# listens on the Unix socket PATH, and starting the new version with
+#   python server.py -p <port> --upgrade-socket PATH --take-over
+# moves everything over to it: the old process sends its listening socket and every player's socket (SCM_RIGHTS) with
+# the state of every match, then exits. New connections wait in the listening socket's backlog meanwhile, so none are
+# refused, and players only see a short pause.
+#
+# Over the Unix socket:
+#   old -> new: state length (4 bytes) + state (JSON), then the sockets in batches of FD_BATCH, one byte per batch
+#   new -> old: "K" once it has rebuilt everything
+#   old -> new: "D" once it has let go of its copies of the sockets, the journal and the metrics port
+# If the new process goes away before its "K" the old one carries on as if nothing happened, and a new process that
+# doesn't get its "D" exits without serving anyone.
+#
+# Timeouts start over in the new process, a player mid-turn gets the whole --turn-timeout again.
+
+import base64
+import json
+import logging
+import os
+import socket
+import struct
+from collections import deque
+
+from board import Board, CELL_COUNT
+from game import REPLAY_SIZE, ComputerPlayer, Match
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_VERSION = 1
+LENGTH = struct.Struct("!I")
+# Sockets sent with one message, Linux takes at most 253
+FD_BATCH = 200
+HANDOFF_TIMEOUT = 10.0
+
+class UpgradeListener:
+    # The old process's side, in the selectors loop. hand_off(conn) does the handover and returns True once the new
+    # process has taken over.
+    def __init__(self, path, hand_off):
+        if os.path.exists(path):
+            # Left behind by a server that didn't get to clean up
+            os.unlink(path)
+        self.path = path
+        self.hand_off = hand_off
+        self.handed_off = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.sock.setblocking(False)
+
+    def process(self, mask):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.settimeout(HANDOFF_TIMEOUT)
+        try:
+            self.handed_off = self.hand_off(conn)
+        except OSError as e:
+            logger.error("Upgrade failed, carrying on: %s", repr(e))
+        finally:
+            conn.close()
+
+    def close(self):
+        if self.sock.fileno() != -1:
+            self.sock.close()
+            os.unlink(self.path)
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode("ascii")
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+# ---------------- Old process ----------------
+
+def capture(lobby, connections, listening):
+    """Everything the new process needs, as (state, sockets). connections are the engine's open connections, which
+    need sock, addr, recv_buffer and out_queue (see server.ClientConnection)."""
+    sockets = [listening]
+    records = []
+    index = {}
+
+    def add(session):
+        if session is None:
+            return None
+        if session not in index:
+            index[session] = len(records)
+            record = {
+                "addr": list(session.addr) if isinstance(session.addr, tuple) else session.addr,
+                "sock": None,
+                "delta": session.delta_updates,
+                "seq": session.board_seq,
+                "join": session.join_data,
+                "resumable": session.resumable,
+                "closing": session.closing,
+                "stale": session.stale,
+            }
+            if isinstance(session, ComputerPlayer):
+                record["computer"] = session.difficulty
+                record["board"] = session.board
+            elif getattr(session, "sock", None) is not None:
+                record["sock"] = len(sockets)
+                sockets.append(session.sock)
+                buffer = session.recv_buffer
+                # A message that only partly arrived, the rest comes in on the new process's socket
+                record["in"] = encode_bytes(buffer.view[buffer.start:buffer.end])
+                record["out"] = encode_bytes(b"".join(bytes(data) for data in session.out_queue))
+            records.append(record)
+        return index[session]
+
+    for connection in connections:
+        add(connection)
+    matches = []
+    for match in lobby.matches.values():
+        matches.append({
+            "id": match.match_id,
+            "journaled": match.journaled,
+            "boards": [board.state() for board in match.boards],
+            "first": match.first,
+            "shots": match.shots,
+            "finished": match.finished,
+            "players": [add(connection) for connection in match.connections],
+            "tokens": match.tokens,
+            "sent": match.sent,
+            # Only for a player who dropped. Anyone connected who resumes later with a count from before the upgrade
+            # gets the whole game again instead, see PlayerSession.resume_session
+            "replay": [[encode_bytes(req) for req in replay] if seat in match.absent else [] for seat, replay in enumerate(match.replay)],
+            "absent": sorted(match.absent),
+            "spectators": [add(spectator) for spectator in match.spectators],
+            "spectator_seq": match.spectator_seq,
+        })
+    state = {
+        "version": HANDOFF_VERSION,
+        "next_match_id": lobby.next_match_id,
+        "waiting": None if lobby.waiting is None else lobby.waiting.match_id,
+        "unclaimed": [[board, match.match_id, seat] for board, seats in lobby.unclaimed.items() for match, seat in seats],
+        "connections": records,
+        "matches": matches,
+        "sockets": len(sockets),
+    }
+    return state, sockets
+
+def send_state(conn, state, sockets):
+    """Send the state and sockets to the new process, returns True once it says it has them."""
+    data = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    conn.sendall(LENGTH.pack(len(data)) + data)
+    for start in range(0, len(sockets), FD_BATCH):
+        socket.send_fds(conn, [b"F"], [sock.fileno() for sock in sockets[start:start + FD_BATCH]])
+    return conn.recv(1) == b"K"
+
+# ---------------- New process ----------------
+
+def receive_state(conn):
+    """The state and sockets from the old process, the listening socket first."""
+    header = recv_exactly(conn, LENGTH.size)
+    (length,) = LENGTH.unpack(header)
+    state = json.loads(recv_exactly(conn, length))
+    if state.get("version") != HANDOFF_VERSION:
+        raise ValueError("The running server sent handoff version %s, this one reads %s" % (state.get("version"), HANDOFF_VERSION))
+    fds = []
+    while len(fds) < state["sockets"]:
+        message, batch, flags, addr = socket.recv_fds(conn, 1, FD_BATCH)
+        if not message:
+            raise ConnectionError("The running server stopped in the middle of the handoff")
+        fds.extend(batch)
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    for sock in sockets:
+        sock.setblocking(False)
+    return state, sockets
+
+def recv_exactly(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The running server stopped in the middle of the handoff")
+        data += chunk
+    return bytes(data)
+
+def restore_targeting(computer, board):
+    # Show the computer its shots at the board again: the misses, the hits, and last the cell that sank each ship
+    sinking = {}
+    for ship, mask in enumerate(board.ship_masks):
+        if mask and board.is_sunk(ship):
+            sinking[mask.bit_length() - 1] = ship
+    for cell in range(CELL_COUNT):
+        if board.misses >> cell & 1:
+            computer.targeting.record(cell, False)
+        elif board.hits >> cell & 1 and cell not in sinking:
+            computer.targeting.record(cell, True)
+    for cell, ship in sinking.items():
+        computer.targeting.record(cell, True, ship)
+
+def restore(state, sockets, lobby, adopt):
+    """Rebuild the lobby from the state. adopt(sock, addr) makes an engine connection for sock, or a closed one if
+    sock is None (a player whose connection dropped)."""
+    sessions = []
+    for record in state["connections"]:
+        addr = tuple(record["addr"]) if isinstance(record["addr"], list) else record["addr"]
+        if "computer" in record:
+            session = ComputerPlayer(lobby, record["computer"])
+            session.board = record["board"]
+        else:
+            sock = None if record["sock"] is None else sockets[record["sock"]]
+            session = adopt(sock, addr)
+            if sock is not None:
+                session.recv_buffer.feed(decode_bytes(record["in"]))
+                out = decode_bytes(record["out"])
+                if out:
+                    session.out_queue.append(out)
+                    session.queued += len(out)
+        session.delta_updates = record["delta"]
+        session.board_seq = record["seq"]
+        session.join_data = record["join"]
+        session.resumable = record["resumable"]
+        session.stale = record["stale"]
+        session.closing = record["closing"]
+        sessions.append(session)
+
+    for saved in state["matches"]:
+        match = Match(saved["id"])
+        match.journaled = saved["journaled"]
+        match.boards = [Board.from_state(board) for board in saved["boards"]]
+        match.first = saved["first"]
+        match.second = 1 - saved["first"]
+        match.shots = saved["shots"]
+        match.finished = saved["finished"]
+        match.tokens = saved["tokens"]
+        match.sent = saved["sent"]
+        match.replay = [deque((decode_bytes(req) for req in replay), maxlen=REPLAY_SIZE) for replay in saved["replay"]]
+        match.absent = set(saved["absent"])
+        match.spectator_seq = saved["spectator_seq"]
+        match.connections = [None if player is None else sessions[player] for player in saved["players"]]
+        lobby.matches[match.match_id] = match
+        for seat, session in enumerate(match.connections):
+            if session is None:
+                continue
+            session.match, session.seat = match, seat
+            if seat not in match.absent:
+                lobby.seats[session] = (match, seat)
+            if isinstance(session, ComputerPlayer):
+                restore_targeting(session, match.boards[1 - seat])
+        for seat, token in enumerate(match.tokens):
+            if token is not None:
+                lobby.sessions[token] = (match, seat)
+        for spectator in saved["spectators"]:
+            sessions[spectator].watching = match
+            match.spectators.add(sessions[spectator])
+        restart_timer(lobby, match)
+
+    lobby.next_match_id = state["next_match_id"]
+    lobby.waiting = None if state["waiting"] is None else lobby.matches.get(state["waiting"])
+    for board, match_id, seat in state["unclaimed"]:
+        lobby.unclaimed.setdefault(board, []).append((lobby.matches[match_id], seat))
+    return sessions
+
+def restart_timer(lobby, match):
+    # The same timeout the match was waiting on in the old process, from the start
+    if match.absent:
+        seat = min(match.absent)
+        lobby.set_timer(match, lobby.resume_grace, lobby.resume_timed_out, match, seat)
+    elif len(match.connections) < 2 or None in match.connections:
+        lobby.set_timer(match, lobby.join_timeout, lobby.join_timed_out, match)
+    elif not match.finished:
+        shooter = match.first if match.shots % 2 == 0 else match.second
+        lobby.set_timer(match, lobby.turn_timeout, match.connections[shooter].turn_timed_out)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Multi-core mode for the selectors engine (python server.py -p <port> --workers N).
+# The parent process forks N workers. Each worker opens its own listening socket on the same port with SO_REUSEPORT,
+# so the kernel spreads new connections across them, and runs its own lobby and match table.
+#
+# Players are paired inside their worker whenever possible. When two workers each have a lone waiting player, the
+# parent (the coordinator) asks one of them to hand its player over, and passes the socket to the other worker over
+# a Unix socket (SCM_RIGHTS), where it joins the waiting player's match.
+#
+# Control messages between a worker and the coordinator, one per datagram:
+#   worker -> coordinator: "W" I have a waiting player, "P" I don't anymore,
+#                          "H" + join data (+ the socket) handing over a waiting player, "N" nothing to hand over
+#   coordinator -> worker: "G" give your waiting player away, "A" + join data (+ the socket) adopt this player
+
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+
+import log_pipeline
+import profiling
+from game import Lobby
+
+logger = logging.getLogger(__name__)
+
+CONTROL_SIZE = 4096
+
+def send_control(control, message, fds=()):
+    if fds:
+        socket.send_fds(control, [message], fds)
+    else:
+        control.send(message)
+
+class ShardLobby(Lobby):
+    # A worker's lobby, which also keeps the coordinator up to date on whether it has someone waiting
+    def __init__(self, control, **options):
+        super().__init__(**options)
+        self.control = control
+
+    def seat_player(self, connection, board):
+        match, seat = super().seat_player(connection, board)
+        send_control(self.control, b"W" if seat == 0 else b"P")
+        return match, seat
+
+    def end_match(self, match):
+        was_waiting = self.waiting is match
+        super().end_match(match)
+        if was_waiting:
+            send_control(self.control, b"P")
+
+    def release(self, match):
+        # Forget a waiting match without closing its connection, so the player can move to another worker
+        self.set_timer(match, None, None)
+        self.dismiss_spectators(match)
+        for connection in match.connections:
+            self.seats.pop(connection, None)
+            connection.stop_idle_timer()
+        self.matches.pop(match.match_id, None)
+        if self.waiting is match:
+            self.waiting = None
+
+class Worker:
+    # Handles the coordinator's messages inside a worker's select() loop
+    def __init__(self, control, adopt, lobby_options):
+        self.control = control
+        # lobby_options are the Lobby keyword arguments (the timeouts) the server was started with
+        self.lobby = ShardLobby(control, **lobby_options)
+        # adopt(sock, join data) turns a socket from another worker into a seated connection
+        self.adopt = adopt
+
+    def process(self, mask):
+        message, fds, flags, addr = socket.recv_fds(self.control, CONTROL_SIZE, 1)
+        if message[:1] == b"G":
+            self.give_waiting_player()
+        elif message[:1] == b"A" and fds:
+            sock = socket.socket(fileno=fds[0])
+            sock.setblocking(False)
+            logger.info("Adopted a waiting player from another worker")
+            self.adopt(sock, message[1:].decode("utf-8"))
+
+    def give_waiting_player(self):
+        match = self.lobby.waiting
+        # Only hand over a player whose messages have all gone out, so nothing is lost on the way
+        if match is None or len(match.connections) != 1 or match.connections[0].out_queue:
+            send_control(self.control, b"N")
+            return
+        connection = match.connections[0]
+        self.lobby.release(match)
+        # It counts against the receiving worker's connection limits from now on
+        self.lobby.connection_closed(connection.addr[0])
+        connection.sel.unregister(connection.sock)
+        send_control(self.control, b"H" + connection.join_data.encode("utf-8"), [connection.sock.fileno()])
+        # The coordinator has its own copy of the socket now
+        connection.sock.close()
+        connection.sock = None
+        logger.info("Handed waiting player %s over to another worker", connection.addr)
+
+def stop_coordinator(signum, frame):
+    raise KeyboardInterrupt
+
+def run_coordinator(controls, children):
+    # Stop the workers too when the coordinator is told to stop
+    signal.signal(signal.SIGTERM, stop_coordinator)
+    # The workers do the profiling (see profiling.py), the coordinator passes the signals on to all of them
+    def forward_signal(signum, frame):
+        for pid in children:
+            os.kill(pid, signum)
+    if profiling.directory is not None:
+        for signum in profiling.SIGNALS:
+            signal.signal(signum, forward_signal)
+    sel = selectors.DefaultSelector()
+    for worker_id, control in enumerate(controls):
+        sel.register(control, selectors.EVENT_READ, data=worker_id)
+    # Workers that have a waiting player nobody has been promised to yet, in the order they reported it
+    waiting = []
+    # giver worker -> worker its waiting player is going to
+    handovers = {}
+
+    def pair_waiting_players():
+        while len(waiting) >= 2:
+            receiver = waiting.pop(0)
+            giver = waiting.pop()
+            handovers[giver] = receiver
+            send_control(controls[giver], b"G")
+
+    try:
+        while True:
+            for key, mask in sel.select(timeout=None):
+                worker_id = key.data
+                message, fds, flags, addr = socket.recv_fds(controls[worker_id], CONTROL_SIZE, 1)
+                if not message:
+                    logger.error("Worker %s closed its control socket", worker_id)
+                    sel.unregister(controls[worker_id])
+                    if worker_id in waiting:
+                        waiting.remove(worker_id)
+                    continue
+                action = message[:1]
+                if action == b"W":
+                    if worker_id not in waiting and worker_id not in handovers:
+                        waiting.append(worker_id)
+                    pair_waiting_players()
+                elif action == b"P":
+                    if worker_id in waiting:
+                        waiting.remove(worker_id)
+                elif action == b"H":
+                    # Nobody asked for this one, so send it back where it came from
+                    receiver = handovers.pop(worker_id, worker_id)
+                    send_control(controls[receiver], b"A" + message[1:], fds)
+                    for fd in fds:
+                        os.close(fd)
+                elif action == b"N":
+                    # The player left before they could be handed over, so the receiver may still be waiting
+                    receiver = handovers.pop(worker_id, None)
+                    if receiver is not None and receiver not in waiting and receiver not in handovers:
+                        waiting.insert(0, receiver)
+                    pair_waiting_players()
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, stopping workers")
+        logger.info("Keyboard interrupt, stopping workers")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+        sel.close()
+
+def run(host, port, count, serve):
+    """Fork count workers that each run serve(host, port, worker), then coordinate them until interrupted."""
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        print("--workers needs SO_REUSEPORT and fork(), which this platform doesn't have.")
+        sys.exit(1)
+
+    controls = []
+    children = []
+    for worker_id in range(count):
+        coordinator_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            for control in controls:
+                control.close()
+            coordinator_end.close()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            log_pipeline.after_fork()
+            logger.info("Worker %s started with pid %s", worker_id, os.getpid())
+            try:
+                serve(host, port, worker_end)
+            finally:
+                # os._exit skips atexit, so write out the queued log records first
+                log_pipeline.stop_logging()
+                os._exit(0)
+        worker_end.close()
+        controls.append(coordinator_end)
+        children.append(pid)
+
+    print("started", count, "workers on port", port)
+    logger.info("Started %s workers on port %s", count, port)
+    run_coordinator(controls, children)